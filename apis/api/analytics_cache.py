@@ -0,0 +1,76 @@
+"""
+Serialized response cache for the analytics layers
+"""
+
+import hashlib
+import threading
+from typing import Optional
+
+from cachetools import LRUCache
+
+DEFAULT_CACHE_MB = 256
+
+
+def make_etag(name: str, version: str) -> str:
+    """Strong ETag of an object version"""
+    return '"' + hashlib.sha1(f"{name}:{version}".encode()).hexdigest() + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Whether an If-None-Match header matches an ETag
+
+    Parameters
+    ----------
+    if_none_match : str or None
+        Value of the If-None-Match request header
+    etag : str
+        Current ETag of the resource
+
+    Returns
+    -------
+    matches : bool
+        True if the client copy is current
+    """
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or any(tag.removeprefix("W/") == etag for tag in tags)
+
+
+class ResponseCache:
+    """
+    Size bounded LRU cache of encoded responses, keyed on the object version
+
+    Parameters
+    ----------
+    max_mb : float, optional
+        Maximum size of the cached bodies in MB, by default 256
+    """
+
+    def __init__(self, max_mb: float = DEFAULT_CACHE_MB):
+        self._entries = LRUCache(
+            maxsize=int(max_mb * 1024 * 1024),
+            getsizeof=lambda entry: len(entry[1]),
+        )
+        self._lock = threading.Lock()
+
+    def get(self, key: str, version: str) -> Optional[bytes]:
+        """Cached body of a key, None if missing or from another version"""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or entry[0] != version:
+            return None
+        return entry[1]
+
+    def put(self, key: str, version: str, body: bytes) -> None:
+        """Cache the body of a key version, skipped if larger than the cache"""
+        with self._lock:
+            try:
+                self._entries[key] = (version, body)
+            except ValueError:
+                self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
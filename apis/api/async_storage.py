@@ -0,0 +1,89 @@
+"""
+Storage calls and serialization off the event loop, on bounded thread pools
+"""
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Iterator
+
+# Connections the minio client keeps open per host, so that every I/O thread
+# reuses a pooled connection
+DEFAULT_IO_WORKERS = 10
+DEFAULT_SERIALIZE_WORKERS = 2
+
+
+class AsyncStorage:
+    """
+    Awaitable access to a storage, for the async endpoints
+
+    Blocking storage calls run on a bounded pool of I/O threads, sharing the
+    connection pool of the storage client. CPU-heavy encoding runs on a
+    separate pool, so a large layer being serialized doesn't hold the I/O
+    threads, and neither blocks the event loop.
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object where the data is saved
+    io_workers : int, optional
+        Threads for storage calls, by default 10
+    serialize_workers : int, optional
+        Threads for serialization, by default 2
+    """
+
+    def __init__(
+        self,
+        storage,
+        io_workers: int = DEFAULT_IO_WORKERS,
+        serialize_workers: int = DEFAULT_SERIALIZE_WORKERS,
+    ):
+        self.storage = storage
+        self._io = ThreadPoolExecutor(
+            max_workers=io_workers, thread_name_prefix="storage-io"
+        )
+        self._serialize = ThreadPoolExecutor(
+            max_workers=serialize_workers, thread_name_prefix="serialize"
+        )
+
+    async def call(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Run a blocking function of the storage on the I/O pool
+
+        Parameters
+        ----------
+        func : callable
+            Function taking the storage as first argument, like find_layer
+        *args, **kwargs
+            Other arguments of the function
+
+        Returns
+        -------
+        Any
+            What the function returns
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._io, functools.partial(func, self.storage, *args, **kwargs)
+        )
+
+    async def serialize(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run a CPU-bound function, like GeoJSON encoding, on the serialization pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._serialize, functools.partial(func, *args, **kwargs)
+        )
+
+    async def iterate(self, iterator: Iterator[Any]) -> AsyncIterator[Any]:
+        """Items of a blocking iterator, like a file read in batches, on the I/O pool"""
+        loop = asyncio.get_running_loop()
+        done = object()
+        while True:
+            item = await loop.run_in_executor(self._io, next, iterator, done)
+            if item is done:
+                return
+            yield item
+
+    def shutdown(self) -> None:
+        self._io.shutdown(wait=False, cancel_futures=True)
+        self._serialize.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,214 @@
+"""
+Persisted spatial index and simplification levels of the analytics layers
+"""
+
+import hashlib
+import threading
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from cachetools import LRUCache
+
+from vector_layers import read_layer
+
+INDEX_PREFIX = "_index"
+# Zoom levels with precomputed simplified geometries, finer zooms use the
+# full geometries
+SIMPLIFICATION_ZOOMS = (4, 7, 10, 13)
+MAX_LOADED_LAYERS = 16
+
+_BOUNDS = ["_minx", "_miny", "_maxx", "_maxy"]
+
+
+def pixel_tolerance(zoom: int) -> float:
+    """Size in degrees of a 256 pixel tile pixel at a zoom level"""
+    return 360.0 / (256 * 2**zoom)
+
+
+def index_path(name: str, version: str) -> str:
+    """Storage path of the index of a layer version"""
+    digest = hashlib.sha1(version.encode()).hexdigest()[:16]
+    return f"{INDEX_PREFIX}/{name.rsplit('.', 1)[0]}-{digest}.parquet"
+
+
+@dataclass
+class LayerLevels:
+    """Layer properties, bounds, geometries per simplification level and STRtree"""
+
+    version: str
+    properties: pd.DataFrame
+    levels: dict
+    tree: shapely.STRtree
+
+    @property
+    def geometries(self) -> np.ndarray:
+        return self.levels[None]
+
+
+def _to_frame(gdf: gpd.GeoDataFrame) -> pd.DataFrame:
+    """Index table with bounds and WKB geometries of every level"""
+    geometries = gdf.geometry.to_numpy()
+    frame = pd.DataFrame(gdf.drop(columns=gdf.geometry.name))
+    frame[_BOUNDS] = shapely.bounds(geometries)
+    frame["_wkb"] = shapely.to_wkb(geometries)
+    for zoom in SIMPLIFICATION_ZOOMS:
+        frame[f"_wkb_z{zoom}"] = shapely.to_wkb(
+            shapely.simplify(geometries, pixel_tolerance(zoom), preserve_topology=True)
+        )
+    return frame
+
+
+def _from_frame(frame: pd.DataFrame, version: str) -> LayerLevels:
+    """Load an index table"""
+    levels = {None: shapely.from_wkb(frame["_wkb"].to_numpy())}
+    for zoom in SIMPLIFICATION_ZOOMS:
+        levels[zoom] = shapely.from_wkb(frame[f"_wkb_z{zoom}"].to_numpy())
+    boxes = shapely.box(*frame[_BOUNDS].to_numpy().T)
+    return LayerLevels(
+        version=version,
+        properties=frame.drop(
+            columns=_BOUNDS + ["_wkb"] + [f"_wkb_z{z}" for z in SIMPLIFICATION_ZOOMS]
+        ),
+        levels=levels,
+        tree=shapely.STRtree(boxes),
+    )
+
+
+def build_levels(storage, name: str, version: str) -> LayerLevels:
+    """
+    Build the index of a layer and persist it next to the layer
+
+    Previous versions of the index are deleted.
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object where the data is saved
+    name : str
+        Layer name
+    version : str
+        Version of the layer
+
+    Returns
+    -------
+    levels : LayerLevels
+        Index of the layer
+    """
+    gdf = read_layer(storage, name)
+    if gdf.crs is not None and gdf.crs != "EPSG:4326":
+        gdf = gdf.to_crs("EPSG:4326")
+    gdf = gdf[gdf.geometry.notna() & ~gdf.geometry.is_empty]
+    frame = _to_frame(gdf)
+    stem = name.rsplit(".", 1)[0]
+    for previous in storage.list(f"{INDEX_PREFIX}/{stem}-*.parquet"):
+        # Local storage matches the pattern in subfolders too
+        if previous.startswith(f"{INDEX_PREFIX}/"):
+            storage.delete(previous)
+    storage.create(frame, index_path(name, version))
+    return _from_frame(frame, version)
+
+
+class LayerLevelsCache:
+    """
+    Layer indexes loaded in memory, read from storage or built when missing
+
+    Parameters
+    ----------
+    max_layers : int, optional
+        Number of layer indexes kept in memory, by default 16
+    """
+
+    def __init__(self, max_layers: int = MAX_LOADED_LAYERS):
+        self._levels = LRUCache(maxsize=max_layers)
+        self._lock = threading.Lock()
+
+    def get(self, storage, name: str, version: str) -> LayerLevels:
+        """Index of a layer version"""
+        with self._lock:
+            levels = self._levels.get(name)
+        if levels is None or levels.version != version:
+            path = index_path(name, version)
+            if storage.exists(path):
+                levels = _from_frame(storage.read(path), version)
+            else:
+                levels = build_levels(storage, name, version)
+            with self._lock:
+                self._levels[name] = levels
+        return levels
+
+
+def parse_bbox(bbox: str) -> Tuple[float, float, float, float]:
+    """Parse a minx,miny,maxx,maxy bounding box"""
+    values = [float(value) for value in bbox.split(",")]
+    if len(values) != 4 or values[0] > values[2] or values[1] > values[3]:
+        raise ValueError("bbox must be minx,miny,maxx,maxy")
+    return tuple(values)
+
+
+def query_layer(
+    levels: LayerLevels,
+    bbox: Optional[Tuple[float, float, float, float]] = None,
+    tolerance: Optional[float] = None,
+    zoom: Optional[int] = None,
+    properties: Optional[List[str]] = None,
+    precision: Optional[int] = None,
+) -> gpd.GeoDataFrame:
+    """
+    Features of a layer filtered, simplified and projected
+
+    Parameters
+    ----------
+    levels : LayerLevels
+        Index of the layer
+    bbox : tuple, optional
+        Only features intersecting the (minx, miny, maxx, maxy) box, in EPSG:4326
+    tolerance : float, optional
+        Simplification tolerance in degrees
+    zoom : int, optional
+        Map zoom, uses the simplification level of about one pixel at that
+        zoom if no tolerance is given
+    properties : list of str, optional
+        Properties to return, all by default
+    precision : int, optional
+        Decimal places of the coordinates
+
+    Returns
+    -------
+    features : GeoDataFrame
+        The selected features
+    """
+    if properties is not None:
+        unknown = set(properties) - set(levels.properties.columns)
+        if unknown:
+            raise KeyError(f"Unknown properties: {', '.join(sorted(unknown))}")
+
+    rows = np.arange(len(levels.properties))
+    if bbox is not None:
+        rows = levels.tree.query(shapely.box(*bbox), predicate="intersects")
+        rows = np.sort(rows)
+        geometries = levels.geometries[rows]
+        rows = rows[shapely.intersects(geometries, shapely.box(*bbox))]
+
+    # Coarsest precomputed level at least as fine as the zoom or tolerance,
+    # only an explicit tolerance is applied exactly on top of it
+    level = None
+    target = tolerance or (pixel_tolerance(zoom) if zoom is not None else None)
+    if target:
+        finer = [z for z in SIMPLIFICATION_ZOOMS if pixel_tolerance(z) <= target]
+        level = min(finer) if finer else None
+    geometries = levels.levels[level][rows]
+    if tolerance:
+        geometries = shapely.simplify(geometries, tolerance, preserve_topology=True)
+    if precision is not None:
+        geometries = shapely.transform(
+            geometries, lambda coords: np.round(coords, precision)
+        )
+
+    frame = levels.properties.iloc[rows]
+    if properties is not None:
+        frame = frame[properties]
+    return gpd.GeoDataFrame(frame, geometry=geometries, crs="EPSG:4326")
@@ -5,26 +5,82 @@ Analytics API
 import argparse
 import json
 import os
+import sys
+from contextlib import asynccontextmanager
 from typing import Optional
 
 import uvicorn
-from fastapi import FastAPI, HTTPException, status
+from fastapi import FastAPI, HTTPException, Query, Request, status
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.responses import StreamingResponse
+from starlette.responses import Response, StreamingResponse
+from prometheus_client import REGISTRY
 from prometheus_fastapi_instrumentator import Instrumentator
 
 import geopandas as gpd
-import numpy as np
 import pandas as pd
 
 from spai.storage import Storage
 from spai.config import SPAIVars
-from spai.processing import read_raster
 from spai.image.xyz import get_image_data, get_tile_data, ready_image
 from spai.image.xyz.errors import ImageOutOfBounds
 
+# Modules shared with the pipeline, in the raster shared group of the project.
+# Deployed images have them next to main.py, already importable.
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+SHARED_DIR = os.path.normpath(os.path.join(ROOT, "shared", "raster"))
+if os.path.isdir(SHARED_DIR) and SHARED_DIR not in sys.path:
+    sys.path.append(SHARED_DIR)
+
+from async_storage import (
+    DEFAULT_IO_WORKERS,
+    DEFAULT_SERIALIZE_WORKERS,
+    AsyncStorage,
+)
+from analytics_cache import (
+    DEFAULT_CACHE_MB,
+    ResponseCache,
+    etag_matches,
+    make_etag,
+)
+from layer_levels import LayerLevelsCache, parse_bbox, query_layer
+from pipeline_metrics import PipelineStagesCollector
+from raster_stats import RasterStatsCache
+from stats_sidecar import object_version
+from status_watcher import DEFAULT_INTERVAL, StatusWatcher
+from streaming import (
+    ARROW_MEDIA_TYPE,
+    BATCH_SIZE,
+    DEFAULT_STREAM_MB,
+    GEOJSON_MEDIA_TYPE,
+    JSON_MEDIA_TYPE,
+    ArrowEncoder,
+    GeoJSONEncoder,
+    batch_frame,
+    layer_batches,
+    object_size,
+    to_arrow,
+    wants_arrow,
+)
+from tile_cache import (
+    DEFAULT_DISK_CACHE_MB,
+    DEFAULT_TILE_CACHE_MB,
+    TileCache,
+    tile_key,
+)
+from vector_layers import find_layer, read_layer
+from vector_tiles import MVT_MEDIA_TYPE, LayerIndexCache, encode_tile
+
 
-app = FastAPI(title="api")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await status_watcher.refresh()
+    status_watcher.start()
+    yield
+    await status_watcher.stop()
+    async_storage.shutdown()
+
+
+app = FastAPI(title="api", lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -37,6 +93,28 @@ Instrumentator().instrument(app).expose(app=app)
 
 storage = Storage()["data"]
 vars = SPAIVars()
+# Async endpoints reach the storage through bounded thread pools
+async_storage = AsyncStorage(
+    storage,
+    io_workers=vars["STORAGE_IO_WORKERS"] or DEFAULT_IO_WORKERS,
+    serialize_workers=vars["SERIALIZE_WORKERS"] or DEFAULT_SERIALIZE_WORKERS,
+)
+analytics_cache = ResponseCache(vars["ANALYTICS_CACHE_MB"] or DEFAULT_CACHE_MB)
+vector_tile_cache = ResponseCache(vars["VECTOR_TILE_CACHE_MB"] or DEFAULT_CACHE_MB)
+layer_indexes = LayerIndexCache()
+layer_levels = LayerLevelsCache()
+raster_stats = RasterStatsCache()
+pipeline_stages = PipelineStagesCollector(storage)
+REGISTRY.register(pipeline_stages)
+status_watcher = StatusWatcher(
+    async_storage, vars["STATUS_WATCH_INTERVAL"] or DEFAULT_INTERVAL
+)
+stream_bytes = (vars["ANALYTICS_STREAM_MB"] or DEFAULT_STREAM_MB) * 1024 * 1024
+tile_cache = TileCache(
+    vars["TILE_CACHE_MB"] or DEFAULT_TILE_CACHE_MB,
+    disk_path=vars["TILE_CACHE_DIR"],
+    disk_max_mb=vars["TILE_CACHE_DISK_MB"] or DEFAULT_DISK_CACHE_MB,
+)
 
 
 @app.get("/aoi")
@@ -56,39 +134,346 @@ def retrieve_aoi_id(scenario: str):
     return aoi_gdf
 
 
+def _encode_geojson(features: gpd.GeoDataFrame) -> bytes:
+    return features.to_json().encode()
+
+
+async def _stream_layer(name: str, encoder):
+    """Chunks of a stored layer, read and encoded batch by batch"""
+    batches = layer_batches(storage, name)
+    try:
+        async for batch in async_storage.iterate(batches):
+            chunk = await async_storage.serialize(encoder.encode, batch)
+            if chunk:
+                yield chunk
+        yield await async_storage.serialize(encoder.close)
+    finally:
+        # Releases the file, and its temporary copy from object storages. A
+        # batch still being read when the client left is released on collection
+        try:
+            await async_storage.serialize(batches.close)
+        except ValueError:
+            pass
+
+
 @app.get("/analytics/{file}")
-async def analytics(file: str):
+async def analytics(
+    file: str,
+    request: Request,
+    bbox: Optional[str] = None,
+    zoom: Optional[int] = Query(None, ge=0, le=24),
+    tolerance: Optional[float] = Query(None, gt=0),
+    properties: Optional[str] = None,
+    precision: Optional[int] = Query(None, ge=0, le=15),
+):
     """
     Return water quality analytics
 
+    The encoded GeoJSON is cached in memory per object version and query, and
+    clients sending a current ETag in If-None-Match get a 304 without a body.
+    Filtered and simplified responses are served from an index persisted
+    next to the layer, with precomputed simplification levels. Storage calls
+    and encoding run on thread pools, off the event loop.
+
+    Clients accepting application/vnd.apache.arrow.stream get an Arrow IPC
+    stream with a geoarrow.wkb geometry column instead. Whole layers larger
+    than ANALYTICS_STREAM_MB are streamed from the stored file in batches,
+    without being cached, so memory doesn't grow with the layer.
+
     Parameters
     ----------
     file : str
         Name of analytics file
+    request : Request
+        Incoming request, for the If-None-Match and Accept headers
+    bbox : str, optional
+        Only features intersecting minx,miny,maxx,maxy, in EPSG:4326
+    zoom : int, optional
+        Map zoom, features are simplified to about one pixel
+    tolerance : float, optional
+        Simplification tolerance in degrees, overrides zoom
+    properties : str, optional
+        Comma separated properties to return, all by default
+    precision : int, optional
+        Decimal places of the coordinates
+
+    Returns
+    -------
+    analytics : Response
+        GeoJSON or Arrow IPC with water quality analytics
+
+    Raises
+    ------
+    HTTPException
+        If analytics file doesn't exist
+    """
+    name = await async_storage.call(find_layer, file)
+    if name is None:
+        return {}
+    params = {
+        "bbox": bbox,
+        "zoom": zoom,
+        "tolerance": tolerance,
+        "properties": properties,
+        "precision": precision,
+    }
+    params = {key: value for key, value in params.items() if value is not None}
+    arrow = wants_arrow(request.headers.get("accept"))
+    media_type = ARROW_MEDIA_TYPE if arrow else GEOJSON_MEDIA_TYPE
+    key = name + "?" + "&".join(f"{k}={v}" for k, v in params.items())
+    if arrow:
+        key += "#arrow"
+    try:
+        version = await async_storage.call(object_version, name)
+        if version is None:
+            return {}
+        etag = make_etag(key, version)
+        headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept"}
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        body = analytics_cache.get(key, version)
+        if (
+            body is None
+            and not params
+            and await async_storage.call(object_size, name) > stream_bytes
+        ):
+            encoder = ArrowEncoder() if arrow else GeoJSONEncoder()
+            return StreamingResponse(
+                _stream_layer(name, encoder), media_type=media_type, headers=headers
+            )
+        if body is None:
+            if params:
+                levels = await async_storage.call(layer_levels.get, name, version)
+                try:
+                    features = await async_storage.serialize(
+                        query_layer,
+                        levels,
+                        bbox=parse_bbox(bbox) if bbox else None,
+                        tolerance=tolerance,
+                        zoom=zoom,
+                        properties=properties.split(",") if properties else None,
+                        precision=precision,
+                    )
+                except (KeyError, ValueError) as e:
+                    raise HTTPException(
+                        status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)
+                    )
+            else:
+                features = await async_storage.call(read_layer, name)
+            body = await async_storage.serialize(
+                to_arrow if arrow else _encode_geojson, features
+            )
+            analytics_cache.put(key, version, body)
+        return Response(body, media_type=media_type, headers=headers)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def _read_bytes(storage, name: str) -> bytes:
+    data = storage.read_file(name)
+    data = data if isinstance(data, (str, bytes)) else data.read()
+    return data.encode() if isinstance(data, str) else data
+
+
+async def _json_sidecar(name: str, request: Request) -> Response:
+    """JSON file saved by the pipeline, cached and served with an ETag"""
+    version = await async_storage.call(object_version, name)
+    if version is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail=f"{name} not found"
+        )
+    etag = make_etag(name, version)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    try:
+        body = analytics_cache.get(name, version)
+        if body is None:
+            body = await async_storage.call(_read_bytes, name)
+            analytics_cache.put(name, version, body)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return Response(body, media_type=JSON_MEDIA_TYPE, headers=headers)
+
+
+@app.get("/analytics/{file}/stats")
+async def analytics_stats(file: str, request: Request):
+    """
+    Return the statistics of the features of an analytics layer
+
+    For suitable_areas, the statistics of every suitable site (area,
+    elevation, slope, land cover fractions and distances to the power
+    network) with the land cover composition and slope distribution of all
+    the sites, as saved by the pipeline, ready for the charts.
+
+    Parameters
+    ----------
+    file : str
+        Name of analytics file
+    request : Request
+        Incoming request, for the If-None-Match header
+
+    Returns
+    -------
+    stats : Response
+        JSON with the sites and their summary
+
+    Raises
+    ------
+    HTTPException
+        If the layer has no statistics
+    """
+    return await _json_sidecar(f"{file}_stats.json", request)
+
+
+@app.get("/analytics/{file}/sweep")
+async def analytics_sweep(file: str, request: Request):
+    """
+    Return the results of an analytics layer over a range of parameters
+
+    For suitable_areas, the suitable area and number of sites for every
+    infrastructure distance in SWEEP_DISTANCES, by increasing distance, with
+    the name of the analytics layer of the suitable areas at that distance.
+
+    Parameters
+    ----------
+    file : str
+        Name of analytics file
+    request : Request
+        Incoming request, for the If-None-Match header
+
+    Returns
+    -------
+    sweep : Response
+        JSON list with distance_m, area_km2, sites and layer
+
+    Raises
+    ------
+    HTTPException
+        If the layer has no sweep
+    """
+    return await _json_sidecar(f"{file}_sweep.json", request)
+
+
+def _read_first(storage, name: str, n: int) -> gpd.GeoDataFrame:
+    """First features of a stored layer, reading only the batches holding them"""
+    frames, rows = [], 0
+    batches = layer_batches(storage, name, batch_size=min(n, BATCH_SIZE))
+    try:
+        for batch in batches:
+            frames.append(batch_frame(batch))
+            rows += len(frames[-1])
+            if rows >= n:
+                break
+    finally:
+        batches.close()
+    if not frames:
+        return gpd.GeoDataFrame(geometry=[], crs="EPSG:4326")
+    return pd.concat(frames).iloc[:n]
+
+
+@app.get("/analytics/ranked_sites/top")
+async def top_ranked_sites(request: Request, n: int = Query(10, ge=1, le=10000)):
+    """
+    Return the best suitable sites
+
+    Sites are saved sorted by rank, so only the first batches of the layer
+    are read.
+
+    Parameters
+    ----------
+    request : Request
+        Incoming request, for the If-None-Match and Accept headers
+    n : int, optional
+        Number of sites, by default 10
+
+    Returns
+    -------
+    sites : Response
+        GeoJSON or Arrow IPC with the n sites of highest score, with their
+        rank, score, area and distances
+
+    Raises
+    ------
+    HTTPException
+        If there are no ranked sites
+    """
+    name = await async_storage.call(find_layer, "ranked_sites")
+    version = (
+        await async_storage.call(object_version, name) if name is not None else None
+    )
+    if version is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="No ranked sites"
+        )
+    arrow = wants_arrow(request.headers.get("accept"))
+    key = f"{name}?top={n}" + ("#arrow" if arrow else "")
+    etag = make_etag(key, version)
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    try:
+        body = analytics_cache.get(key, version)
+        if body is None:
+            features = await async_storage.call(_read_first, name, n)
+            body = await async_storage.serialize(
+                to_arrow if arrow else _encode_geojson, features
+            )
+            analytics_cache.put(key, version, body)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    media_type = ARROW_MEDIA_TYPE if arrow else GEOJSON_MEDIA_TYPE
+    return Response(body, media_type=media_type, headers=headers)
+
+
+@app.get("/analytics/{file}/{z}/{x}/{y}.mvt")
+async def retrieve_analytics_tile(file: str, z: int, x: int, y: int, request: Request):
+    """
+    Return a Mapbox Vector Tile of an analytics layer
 
     Parameters
     ----------
     file : str
         Name of analytics file
+    z : int
+        Zoom level
+    x : int
+        Tile x coordinate
+    y : int
+        Tile y coordinate
+    request : Request
+        Incoming request, for the If-None-Match header
 
     Returns
     -------
-    analytics : dict
-        Dictionary with water quality analytics
+    tile : Response
+        Vector tile with a single layer named after the file
 
     Raises
     ------
     HTTPException
         If analytics file doesn't exist
     """
+    name = await async_storage.call(find_layer, file)
+    version = await async_storage.call(object_version, name) if name else None
+    if version is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail=f"{file} not found"
+        )
+    key = f"{name}/{z}/{x}/{y}"
+    etag = make_etag(key, version)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
     try:
-        if not storage.exists(f"{file}.geojson"):
-            return {}
-        analytics = storage.read(f"{file}.geojson")
-        analytics = analytics.to_json()
-        # convert to dict
-        analytics = json.loads(analytics)
-        return analytics
+        tile = vector_tile_cache.get(key, version)
+        if tile is None:
+            index = await async_storage.call(layer_indexes.get, name, version)
+            tile = await async_storage.serialize(encode_tile, index, file, z, x, y)
+            vector_tile_cache.put(key, version, tile)
+        return Response(tile, media_type=MVT_MEDIA_TYPE, headers=headers)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -125,6 +510,42 @@ def check_image_exists(image: str):
     return os.path.exists(path)
 
 
+@app.get("/images/{image}/stats")
+def retrieve_image_stats(image: str):
+    """
+    Return the band statistics of an image
+
+    Statistics come from the sidecar saved by the pipeline for the current
+    version of the image. Without one, they are computed block by block from
+    the image. Either way they are kept in memory until the image changes.
+
+    Parameters
+    ----------
+    image : str
+        Image name
+
+    Returns
+    -------
+    stats : list
+        Count of valid pixels, min, max, mean, std, percentiles and histogram
+        of every band
+
+    Raises
+    ------
+    HTTPException
+        If image is not found
+    """
+    version = object_version(storage, image)
+    if version is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail=f"{image} not found"
+        )
+    try:
+        return raster_stats.get(storage, image, version)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.get("/images/{image}/{z}/{x}/{y}.png")
 def retrieve_image_tile(
     image: str,
@@ -138,6 +559,9 @@ def retrieve_image_tile(
     """
     Return image tile
 
+    Rendered tiles are cached per image version, in memory and in TILE_CACHE_DIR
+    if it is set.
+
     Parameters
     ----------
     image : str
@@ -157,7 +581,7 @@ def retrieve_image_tile(
 
     Returns
     -------
-    tile : StreamingResponse
+    tile : Response
         Image tile
 
     Raises
@@ -165,6 +589,12 @@ def retrieve_image_tile(
     HTTPException
         If image is not found
     """
+    version = object_version(storage, image)
+    key = tile_key(image, z, x, y, bands, stretch, palette)
+    if version is not None:
+        cached = tile_cache.get(key, version)
+        if cached is not None:
+            return Response(cached, media_type="image/png")
     image_path = storage.get_path(f"{image}")
     tile_size = (256, 256)
     if len(bands) == 1:
@@ -175,8 +605,10 @@ def retrieve_image_tile(
     try:
         tile = get_tile_data(image_path, (x, y, z), bands, tile_size)
         tile = get_image_data(tile, stretch, palette)
-        image = ready_image(tile)
-        return StreamingResponse(image, media_type="image/png")
+        png = ready_image(tile).getvalue()
+        if version is not None:
+            tile_cache.put(key, version, png)
+        return Response(png, media_type="image/png")
     except ImageOutOfBounds as error:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=error.message)
 
@@ -191,38 +623,13 @@ def get_dem_min_max_values():
     min_max_values : dict
         Dictionary with min and max values
     """
-    ds, dem = read_raster("dem.tif", storage)
-    min_value = float(np.min(dem))
-    max_value = float(np.max(dem))
-    return {"min": min_value, "max": max_value}
+    stats = retrieve_image_stats("dem.tif")[0]
+    return {"min": stats["min"], "max": stats["max"]}
 
 
 def _read_pipeline_status() -> dict:
-    """Read pipeline_status.json from storage via pandas, return a plain dict."""
-    status_path = "pipeline_status.json"
-    idle = {
-        "status": "Idle",
-        "message": "No pipeline run yet",
-        "updated_at": None,
-    }
-    if not storage.exists(status_path):
-        return idle
-    try:
-        df = storage.read(status_path)
-        if df is None or df.empty:
-            return idle
-        row = df.iloc[0]
-        out = {}
-        for key, value in row.items():
-            if pd.isna(value):
-                out[key] = None
-            elif hasattr(value, "isoformat"):
-                out[key] = value.isoformat()
-            else:
-                out[key] = value
-        return out
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    """Pipeline status as last seen by the background watcher."""
+    return dict(status_watcher.status)
 
 
 @app.get("/pipeline/status")
@@ -231,6 +638,22 @@ def pipeline_status():
     return _read_pipeline_status()
 
 
+@app.get("/pipeline/stages")
+def pipeline_stage_records():
+    """Timing, memory, I/O and volume records of the stages of the last run."""
+    return pipeline_stages.records()
+
+
+@app.get("/pipeline/status/stream")
+async def pipeline_status_stream(request: Request):
+    """Server-Sent Events with the pipeline status, pushed when it changes."""
+    return StreamingResponse(
+        status_watcher.events(request),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.get("/data_available")
 def data_available():
     """Whether the pipeline has produced ready outputs."""
@@ -0,0 +1,137 @@
+"""
+Prometheus metrics of the pipeline stages, read from the records of the last run
+"""
+
+import json
+import logging
+import threading
+from typing import List
+
+from prometheus_client.core import GaugeMetricFamily
+
+from stats_sidecar import object_version
+
+logger = logging.getLogger(__name__)
+
+STAGES_PATH = "pipeline_stages.json"
+
+MB = 1024**2
+
+# Record field, metric name, help, unit scale and whether repeated stages add up
+_METRICS = [
+    ("wall_seconds", "wall_seconds", "Wall time of the stage", 1, True),
+    ("peak_rss_mb", "peak_rss_bytes", "Peak RSS at the end of the stage", MB, False),
+    ("rss_growth_mb", "rss_growth_bytes", "Peak RSS growth of the stage", MB, False),
+    (
+        "bytes_downloaded",
+        "downloaded_bytes",
+        "Bytes received by the downloads that report them",
+        1,
+        True,
+    ),
+    ("bytes_written", "written_bytes", "Bytes written to storage", 1, True),
+    ("features", "features", "Features produced", 1, True),
+    ("pixels", "pixels", "Raster pixels written", 1, True),
+    ("cache_hits", "cache_hits", "Downloads served from the cache", 1, True),
+]
+
+
+def read_stages(storage) -> List[dict]:
+    """Read pipeline_stages.json, a JSON list of stage records"""
+    data = storage.read_file(STAGES_PATH)
+    return json.loads(data if isinstance(data, str) else data.read())
+
+
+def aggregate_stages(records: List[dict]) -> dict:
+    """
+    Merge the records of repeated stages, like retried downloads
+
+    Parameters
+    ----------
+    records : list of dict
+        Stage records of a run
+
+    Returns
+    -------
+    stages : dict
+        Merged record and number of runs of every stage, keyed by (name, kind)
+    """
+    stages = {}
+    for record in records:
+        key = (record["name"], record.get("kind", "processing"))
+        merged = stages.get(key)
+        if merged is None:
+            merged = stages[key] = dict(record, runs=0, failed=0, skipped=0)
+        else:
+            for field, _, _, _, additive in _METRICS:
+                value = record.get(field) or 0
+                current = merged.get(field) or 0
+                merged[field] = current + value if additive else max(current, value)
+        # Stages skipped because their inputs didn't change didn't run
+        skipped = record.get("status") == "skipped"
+        merged["runs"] += int(not skipped)
+        merged["skipped"] += int(skipped)
+        merged["failed"] += int(record.get("status") == "error")
+    return stages
+
+
+class PipelineStagesCollector:
+    """
+    Prometheus collector of the stage records of the last pipeline run
+
+    The records are read again only when the file changed since the last scrape.
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object where the data is saved
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self._version = None
+        self._records: List[dict] = []
+        self._lock = threading.Lock()
+
+    def records(self) -> List[dict]:
+        """Stage records of the last run, empty if there is none"""
+        version = object_version(self.storage, STAGES_PATH)
+        with self._lock:
+            if version != self._version:
+                try:
+                    self._records = read_stages(self.storage) if version else []
+                    self._version = version
+                except Exception as e:
+                    logger.warning("Failed to read pipeline stages: %s", e)
+            return self._records
+
+    def collect(self):
+        stages = aggregate_stages(self.records())
+        labels = ["stage", "kind"]
+        families = {
+            field: GaugeMetricFamily(f"pipeline_stage_{name}", doc, labels=labels)
+            for field, name, doc, _, _ in _METRICS
+        }
+        runs = GaugeMetricFamily(
+            "pipeline_stage_runs", "Runs of the stage, retries included", labels=labels
+        )
+        failed = GaugeMetricFamily(
+            "pipeline_stage_failed", "Runs of the stage that failed", labels=labels
+        )
+        skipped = GaugeMetricFamily(
+            "pipeline_stage_skipped",
+            "Times the stage was skipped because its inputs didn't change",
+            labels=labels,
+        )
+        for (name, kind), record in stages.items():
+            for field, _, _, scale, _ in _METRICS:
+                families[field].add_metric(
+                    [name, kind], float(record.get(field) or 0) * scale
+                )
+            runs.add_metric([name, kind], record["runs"])
+            failed.add_metric([name, kind], record["failed"])
+            skipped.add_metric([name, kind], record["skipped"])
+        yield from families.values()
+        yield runs
+        yield failed
+        yield skipped
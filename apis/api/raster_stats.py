@@ -0,0 +1,55 @@
+"""
+Raster band statistics, from the pipeline sidecars or computed block by block
+"""
+
+import json
+import threading
+from typing import List
+
+from cachetools import LRUCache
+from stats_sidecar import raster_stats, sidecar_stats, stats_path
+
+MAX_CACHED_STATS = 64
+
+
+def _read_json(storage, name: str):
+    """Parse a JSON object without going through pandas, to keep float precision"""
+    data = storage.read_file(name)
+    return json.loads(data if isinstance(data, str) else data.read())
+
+
+class RasterStatsCache:
+    """
+    Band statistics of the rasters per version, read from the sidecar written
+    by the pipeline, or computed from the raster if there is no sidecar of
+    that version
+
+    Parameters
+    ----------
+    max_rasters : int, optional
+        Number of rasters kept in memory, by default 64
+    """
+
+    def __init__(self, max_rasters: int = MAX_CACHED_STATS):
+        self._stats = LRUCache(maxsize=max_rasters)
+        self._lock = threading.Lock()
+
+    def get(self, storage, name: str, version: str) -> List[dict]:
+        """Statistics of every band of a raster version"""
+        with self._lock:
+            cached = self._stats.get(name)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        stats = None
+        sidecar = stats_path(name)
+        if storage.exists(sidecar):
+            stats = sidecar_stats(_read_json(storage, sidecar), version)
+        if stats is None:
+            ds = storage.read(name)
+            try:
+                stats = raster_stats(ds)
+            finally:
+                ds.close()
+        with self._lock:
+            self._stats[name] = (version, stats)
+        return stats
@@ -0,0 +1,141 @@
+"""
+Pipeline status cached in memory and refreshed by a single background watcher
+"""
+
+import asyncio
+import json
+import logging
+from typing import Optional
+
+from stats_sidecar import object_version
+
+logger = logging.getLogger(__name__)
+
+STATUS_PATH = "pipeline_status.json"
+DEFAULT_INTERVAL = 2.0
+KEEPALIVE_SECONDS = 15.0
+
+IDLE_STATUS = {
+    "status": "Idle",
+    "message": "No pipeline run yet",
+    "updated_at": None,
+}
+
+
+def read_status(storage) -> dict:
+    """Read pipeline_status.json, the first record of a JSON list"""
+    data = storage.read_file(STATUS_PATH)
+    records = json.loads(data if isinstance(data, str) else data.read())
+    if not records:
+        return dict(IDLE_STATUS)
+    return records[0]
+
+
+class StatusWatcher:
+    """
+    Watch the pipeline status file and notify the waiting clients of changes
+
+    The watcher is the only reader of the storage. It checks the version of the
+    status file on every interval and only reads it when it changed, so the
+    number of storage calls does not depend on the number of clients.
+
+    Parameters
+    ----------
+    storage : AsyncStorage
+        Storage object where the data is saved, read on its I/O pool
+    interval : float, optional
+        Seconds between two checks, by default 2
+    """
+
+    def __init__(self, storage, interval: float = DEFAULT_INTERVAL):
+        self.storage = storage
+        self.interval = interval
+        self.status = dict(IDLE_STATUS)
+        # Incremented on every change, so clients can tell what they have seen
+        self.sequence = 0
+        self._version = None
+        self._changed = asyncio.Condition()
+        self._task: Optional[asyncio.Task] = None
+
+    async def refresh(self) -> None:
+        """Read the status if the file changed, and notify the clients"""
+        version = await self.storage.call(object_version, STATUS_PATH)
+        if version == self._version:
+            return
+        status = dict(IDLE_STATUS)
+        if version is not None:
+            status = await self.storage.call(read_status)
+        self._version = version
+        if status != self.status:
+            async with self._changed:
+                self.status = status
+                self.sequence += 1
+                self._changed.notify_all()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning("Failed to refresh pipeline status: %s", e)
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def wait(self, sequence: int, timeout: float) -> bool:
+        """
+        Wait until the status changes after a sequence number
+
+        Parameters
+        ----------
+        sequence : int
+            Last sequence number seen by the client
+        timeout : float
+            Maximum seconds to wait
+
+        Returns
+        -------
+        changed : bool
+            False if the timeout expired without changes
+        """
+        async with self._changed:
+            try:
+                await asyncio.wait_for(
+                    self._changed.wait_for(lambda: self.sequence != sequence), timeout
+                )
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    async def events(self, request):
+        """
+        Server-Sent Events with the current status and every change
+
+        Parameters
+        ----------
+        request : Request
+            Incoming request, to stop when the client disconnects
+
+        Yields
+        ------
+        event : str
+            A status event, or a comment keeping the connection alive
+        """
+        sequence = None
+        while not await request.is_disconnected():
+            if sequence != self.sequence:
+                sequence = self.sequence
+                yield f"id: {sequence}\ndata: {json.dumps(self.status)}\n\n"
+            elif not await self.wait(sequence, KEEPALIVE_SECONDS):
+                yield ": keep-alive\n\n"
@@ -0,0 +1,281 @@
+"""
+Analytics layers streamed in chunks, as GeoJSON or GeoArrow in Arrow IPC
+"""
+
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator, Optional
+
+import geopandas as gpd
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyogrio
+
+from vector_layers import _parse_crs
+
+GEOJSON_MEDIA_TYPE = "application/json"
+JSON_MEDIA_TYPE = "application/json"
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+# Layers larger than this are streamed instead of encoded and cached whole
+DEFAULT_STREAM_MB = 32
+BATCH_SIZE = 8192
+_JSON_TYPES = ("application/json", "application/geo+json", "application/*", "*/*")
+
+
+def wants_arrow(accept: Optional[str]) -> bool:
+    """
+    Whether an Accept header prefers Arrow IPC to GeoJSON
+
+    Parameters
+    ----------
+    accept : str or None
+        Value of the Accept request header
+
+    Returns
+    -------
+    arrow : bool
+        True if the Arrow stream media type has a higher quality than JSON
+    """
+    if not accept:
+        return False
+    arrow, geojson = 0.0, 0.0
+    for item in accept.split(","):
+        media_type, *params = item.strip().split(";")
+        quality = 1.0
+        for param in params:
+            match = re.fullmatch(r"\s*q\s*=\s*([0-9.]+)\s*", param)
+            if match:
+                quality = float(match.group(1))
+        media_type = media_type.strip().lower()
+        if media_type == ARROW_MEDIA_TYPE:
+            arrow = max(arrow, quality)
+        elif media_type in _JSON_TYPES:
+            geojson = max(geojson, quality)
+    return arrow > geojson
+
+
+def object_size(storage, path: str) -> int:
+    """Size in bytes of a stored file"""
+    local = storage.get_path(path)
+    if os.path.isfile(local):
+        return os.path.getsize(local)
+    return int(storage.object_info(path).get("size") or 0)
+
+
+@dataclass
+class LayerBatch:
+    """Features of a layer read from its file, with WKB geometries"""
+
+    batch: pa.RecordBatch
+    geometry: str
+    crs: Optional[object]
+    offset: int
+
+
+@contextmanager
+def local_file(storage, path: str) -> Iterator[str]:
+    """Local path of a stored file, copied to a temporary file from object storages"""
+    local = storage.get_path(path)
+    if os.path.isfile(local):
+        yield local
+        return
+    fd, tmp = tempfile.mkstemp(suffix=os.path.splitext(path)[1])
+    try:
+        with os.fdopen(fd, "wb") as f:
+            client = getattr(storage, "client", None)
+            if client is not None and not getattr(storage, "managed", False):
+                # Copy the object in chunks instead of reading it whole
+                response = client.get_object(storage.bucket, path)
+                try:
+                    shutil.copyfileobj(response, f)
+                finally:
+                    response.close()
+                    response.release_conn()
+            else:
+                f.write(storage.read_object(path).getvalue())
+        yield tmp
+    finally:
+        os.remove(tmp)
+
+
+def layer_batches(
+    storage, path: str, batch_size: int = BATCH_SIZE
+) -> Iterator[LayerBatch]:
+    """
+    Read a stored layer in batches of features, without decoding geometries
+
+    GeoParquet files are read by row groups with pyarrow, other formats
+    through the Arrow stream of GDAL.
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object where the data is saved
+    path : str
+        Storage name of the layer, as returned by find_layer
+    batch_size : int, optional
+        Maximum features per batch, by default 8192
+
+    Yields
+    ------
+    batch : LayerBatch
+        Next features of the layer
+    """
+    offset = 0
+    with local_file(storage, path) as source:
+        if path.endswith(".parquet"):
+            parquet = pq.ParquetFile(source)
+            geo = json.loads(parquet.schema_arrow.metadata[b"geo"])
+            geometry = geo["primary_column"]
+            meta = geo["columns"][geometry]
+            crs = _parse_crs(json.dumps(meta.get("crs", "OGC:CRS84"), sort_keys=True))
+            covering = meta.get("covering", {}).get("bbox", {}).get("xmin", [None])[0]
+            columns = [name for name in parquet.schema_arrow.names if name != covering]
+            for batch in parquet.iter_batches(batch_size=batch_size, columns=columns):
+                yield LayerBatch(batch, geometry, crs, offset)
+                offset += batch.num_rows
+        else:
+            with pyogrio.open_arrow(
+                source, batch_size=batch_size, use_pyarrow=True
+            ) as (meta, reader):
+                geometry = meta["geometry_name"] or "wkb_geometry"
+                crs = meta["crs"] or "EPSG:4326"
+                for batch in reader:
+                    yield LayerBatch(batch, geometry, crs, offset)
+                    offset += batch.num_rows
+
+
+def batch_frame(item: LayerBatch) -> gpd.GeoDataFrame:
+    """GeoDataFrame of a batch, indexed as the whole layer read at once"""
+    batch = item.batch
+    df = batch.drop_columns([item.geometry]).to_pandas()
+    if isinstance(df.index, pd.RangeIndex):
+        df.index = pd.RangeIndex(item.offset, item.offset + len(df))
+    geometry = gpd.GeoSeries.from_wkb(
+        batch.column(item.geometry).to_numpy(zero_copy_only=False),
+        index=df.index,
+        crs=item.crs,
+    )
+    return gpd.GeoDataFrame(df, geometry=geometry.rename("geometry"))
+
+
+class GeoJSONEncoder:
+    """
+    FeatureCollection written batch by batch, as GeoDataFrame.to_json writes it
+    """
+
+    def __init__(self):
+        self._crs = None
+        self._started = False
+
+    def encode(self, item: LayerBatch) -> bytes:
+        """Features of a batch, after the opening of the collection if first"""
+        features = batch_frame(item).to_geo_dict(na="null", drop_id=False)["features"]
+        chunk = json.dumps(features)[1:-1]
+        if not self._started:
+            self._started = True
+            self._crs = item.crs
+            return b'{"type": "FeatureCollection", "features": [' + chunk.encode()
+        return (", " + chunk).encode() if chunk else b""
+
+    def close(self) -> bytes:
+        """End of the collection, with the CRS member to_json adds"""
+        opening = b"" if self._started else b'{"type": "FeatureCollection", "features": ['
+        empty = json.loads(gpd.GeoDataFrame(geometry=[], crs=self._crs).to_json())
+        members = "".join(
+            f", {json.dumps(key)}: {json.dumps(value)}"
+            for key, value in empty.items()
+            if key not in ("type", "features")
+        )
+        return opening + ("]" + members + "}").encode()
+
+
+def _geoarrow_field(name: str, crs) -> pa.Field:
+    crs = gpd.GeoSeries([], crs=crs).crs
+    metadata = {"crs": crs.to_json_dict()} if crs is not None else {}
+    return pa.field(
+        name,
+        pa.binary(),
+        metadata={
+            "ARROW:extension:name": "geoarrow.wkb",
+            "ARROW:extension:metadata": json.dumps(metadata),
+        },
+    )
+
+
+class ArrowEncoder:
+    """
+    Arrow IPC stream of the batches, with a geoarrow.wkb "geometry" column
+    """
+
+    def __init__(self):
+        self._sink = io.BytesIO()
+        self._writer = None
+        self._schema = None
+
+    def _batch(self, item: LayerBatch) -> pa.RecordBatch:
+        batch = item.batch
+        index = batch.schema.get_field_index(item.geometry)
+        geometry = batch.column(index)
+        if pa.types.is_large_binary(geometry.type):
+            geometry = geometry.cast(pa.binary())
+        columns = batch.columns[:index] + batch.columns[index + 1 :] + [geometry]
+        if self._schema is None:
+            fields = [
+                field.remove_metadata()
+                for field in batch.schema
+                if field.name != item.geometry
+            ]
+            self._schema = pa.schema(fields + [_geoarrow_field("geometry", item.crs)])
+        return pa.RecordBatch.from_arrays(columns, schema=self._schema)
+
+    def _drain(self) -> bytes:
+        chunk = self._sink.getvalue()
+        self._sink.seek(0)
+        self._sink.truncate()
+        return chunk
+
+    def encode(self, item: LayerBatch) -> bytes:
+        """IPC messages of a batch, after the schema if first"""
+        batch = self._batch(item)
+        if self._writer is None:
+            self._writer = pa.ipc.new_stream(self._sink, self._schema)
+        self._writer.write_batch(batch)
+        return self._drain()
+
+    def close(self) -> bytes:
+        """End of the stream, an empty stream if there were no batches"""
+        if self._writer is None:
+            self._writer = pa.ipc.new_stream(
+                self._sink, pa.schema([_geoarrow_field("geometry", "EPSG:4326")])
+            )
+        self._writer.close()
+        return self._drain()
+
+
+def to_arrow(gdf: gpd.GeoDataFrame) -> bytes:
+    """
+    Arrow IPC stream of a GeoDataFrame, with a geoarrow.wkb "geometry" column
+
+    Parameters
+    ----------
+    gdf : GeoDataFrame
+        Features to encode
+
+    Returns
+    -------
+    body : bytes
+        The Arrow IPC stream
+    """
+    table = pa.table(gdf.to_arrow(index=False, geometry_encoding="WKB"))
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
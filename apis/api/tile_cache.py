@@ -0,0 +1,135 @@
+"""
+Rendered raster tile cache, in memory with an optional disk tier
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+from typing import Optional
+
+from analytics_cache import ResponseCache
+
+DEFAULT_TILE_CACHE_MB = 128
+DEFAULT_DISK_CACHE_MB = 1024
+# Writes between two size checks of the disk tier
+_EVICTION_INTERVAL = 256
+
+
+def tile_key(
+    image: str, z: int, x: int, y: int, bands: str, stretch: str, palette: str
+) -> str:
+    """Cache key of a rendered tile"""
+    return f"{image}/{z}/{x}/{y}?bands={bands}&stretch={stretch}&palette={palette}"
+
+
+class DiskTileCache:
+    """
+    Rendered tiles stored as files, evicting the least recently read ones
+
+    Parameters
+    ----------
+    path : str
+        Folder of the cached tiles
+    max_mb : float, optional
+        Maximum size of the folder in MB, by default 1024
+    """
+
+    def __init__(self, path: str, max_mb: float = DEFAULT_DISK_CACHE_MB):
+        self.path = path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._writes = 0
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key: str, version: str) -> str:
+        digest = hashlib.sha1(f"{key}:{version}".encode()).hexdigest()
+        return os.path.join(self.path, digest[:2], f"{digest}.png")
+
+    def get(self, key: str, version: str) -> Optional[bytes]:
+        path = self._file(key, version)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            # Evicted meanwhile, the tile read is still good
+            pass
+        return data
+
+    def put(self, key: str, version: str, data: bytes) -> None:
+        path = self._file(key, version)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self._lock:
+            self._writes += 1
+            evict = self._writes % _EVICTION_INTERVAL == 0
+        if evict:
+            self.evict()
+
+    def evict(self) -> None:
+        """Delete the least recently read tiles until the folder fits its size"""
+        files = []
+        for root, _, names in os.walk(self.path):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class TileCache:
+    """
+    Memory LRU of rendered tiles in front of an optional disk tier
+
+    Entries are keyed on the tile and the version of the image, so tiles of a
+    rewritten image are never served.
+
+    Parameters
+    ----------
+    max_mb : float, optional
+        Maximum size of the tiles in memory in MB, by default 128
+    disk_path : str, optional
+        Folder of the disk tier, by default no disk tier
+    disk_max_mb : float, optional
+        Maximum size of the disk tier in MB, by default 1024
+    """
+
+    def __init__(
+        self,
+        max_mb: float = DEFAULT_TILE_CACHE_MB,
+        disk_path: Optional[str] = None,
+        disk_max_mb: float = DEFAULT_DISK_CACHE_MB,
+    ):
+        self.memory = ResponseCache(max_mb)
+        self.disk = DiskTileCache(disk_path, disk_max_mb) if disk_path else None
+
+    def get(self, key: str, version: str) -> Optional[bytes]:
+        data = self.memory.get(key, version)
+        if data is None and self.disk is not None:
+            data = self.disk.get(key, version)
+            if data is not None:
+                self.memory.put(key, version, data)
+        return data
+
+    def put(self, key: str, version: str, data: bytes) -> None:
+        self.memory.put(key, version, data)
+        if self.disk is not None:
+            self.disk.put(key, version, data)
@@ -0,0 +1,99 @@
+"""
+Vector layers written by the pipeline, as GeoParquet, FlatGeobuf or GeoJSON
+"""
+
+import io
+import json
+import os
+from functools import lru_cache
+from typing import Optional
+
+import geopandas as gpd
+import pyarrow.parquet as pq
+import pyproj
+
+# Formats in the order layers are looked up, like the pipeline does
+VECTOR_FORMATS = ("parquet", "fgb", "geojson")
+
+
+def find_layer(storage, name: str) -> Optional[str]:
+    """
+    Storage name of a layer, in the first format it exists in
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object where the data is saved
+    name : str
+        Layer name, without extension
+
+    Returns
+    -------
+    str or None
+        Name of the stored layer, None if there is none
+    """
+    for vector_format in VECTOR_FORMATS:
+        path = f"{name}.{vector_format}"
+        if storage.exists(path):
+            return path
+    return None
+
+
+@lru_cache(maxsize=32)
+def _parse_crs(crs_json: str) -> Optional[pyproj.CRS]:
+    # GeoParquet PROJJSON without datum ensemble member ids is slow to resolve
+    crs = json.loads(crs_json)
+    return pyproj.CRS.from_user_input(crs) if crs is not None else None
+
+
+def _read_geoparquet(source) -> gpd.GeoDataFrame:
+    """Read a GeoParquet file with WKB geometries, parsing its CRS once"""
+    table = pq.read_table(source)
+    geo = json.loads(table.schema.metadata[b"geo"])
+    column = geo["primary_column"]
+    meta = geo["columns"][column]
+    if meta.get("encoding", "WKB").upper() != "WKB":
+        raise ValueError(f"Unsupported GeoParquet encoding {meta['encoding']}")
+    covering = meta.get("covering", {}).get("bbox")
+    if covering is not None:
+        table = table.drop_columns([covering["xmin"][0]])
+    df = table.drop_columns([column]).to_pandas()
+    geometry = gpd.GeoSeries.from_wkb(
+        table.column(column).to_numpy(zero_copy_only=False),
+        index=df.index,
+        crs=_parse_crs(json.dumps(meta.get("crs", "OGC:CRS84"), sort_keys=True)),
+    )
+    return gpd.GeoDataFrame(df, geometry=geometry.rename(column))
+
+
+def read_layer(storage, path: str) -> gpd.GeoDataFrame:
+    """
+    Read a stored layer, in EPSG:4326 when it has no CRS
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object where the data is saved
+    path : str
+        Storage name of the layer, as returned by find_layer
+
+    Returns
+    -------
+    GeoDataFrame
+        The layer
+    """
+    source = storage.get_path(path)
+    if not os.path.isfile(source):
+        source = io.BytesIO(storage.read_object(path).getvalue())
+    if path.endswith(".parquet"):
+        try:
+            gdf = _read_geoparquet(source)
+        except ValueError:
+            if isinstance(source, io.IOBase):
+                source.seek(0)
+            gdf = gpd.read_parquet(source)
+    else:
+        gdf = gpd.read_file(source, engine="pyogrio")
+    if gdf.crs is None:
+        gdf = gdf.set_crs("EPSG:4326")
+    return gdf
@@ -0,0 +1,163 @@
+"""
+Mapbox Vector Tiles for the analytics layers
+"""
+
+import threading
+from dataclasses import dataclass
+from typing import List
+
+import mapbox_vector_tile
+import mercantile
+import numpy as np
+import pandas as pd
+import shapely
+from cachetools import LRUCache
+
+from vector_layers import read_layer
+
+MVT_MEDIA_TYPE = "application/vnd.mapbox-vector-tile"
+EXTENT = 4096
+# Tile buffer in tile units, so lines and polygons are not cut at the tile edges
+BUFFER = 64
+MAX_INDEXED_LAYERS = 16
+
+
+@dataclass
+class LayerIndex:
+    """Layer geometries in EPSG:3857 with a spatial index built once"""
+
+    version: str
+    geometries: np.ndarray
+    properties: List[dict]
+    tree: shapely.STRtree
+
+
+def _properties(df: pd.DataFrame) -> List[dict]:
+    """Feature properties without nulls, as the types MVT can encode"""
+    records = []
+    for record in df.to_dict(orient="records"):
+        properties = {}
+        for key, value in record.items():
+            if value is None or (isinstance(value, float) and np.isnan(value)):
+                continue
+            if isinstance(value, np.generic):
+                value = value.item()
+            if not isinstance(value, (str, int, float, bool)):
+                value = str(value)
+            properties[key] = value
+        records.append(properties)
+    return records
+
+
+def build_index(gdf, version: str) -> LayerIndex:
+    """
+    Build the spatial index of a layer
+
+    Parameters
+    ----------
+    gdf : GeoDataFrame
+        Layer features
+    version : str
+        Version of the storage object the layer was read from
+
+    Returns
+    -------
+    index : LayerIndex
+        Projected geometries, properties and STRtree of the layer
+    """
+    if gdf.crs is None:
+        gdf = gdf.set_crs("EPSG:4326")
+    gdf = gdf[gdf.geometry.notna() & ~gdf.geometry.is_empty].to_crs("EPSG:3857")
+    geometries = gdf.geometry.to_numpy()
+    return LayerIndex(
+        version=version,
+        geometries=geometries,
+        properties=_properties(pd.DataFrame(gdf.drop(columns=gdf.geometry.name))),
+        tree=shapely.STRtree(geometries),
+    )
+
+
+class LayerIndexCache:
+    """
+    Spatial indexes of the most recently used layers, rebuilt when a layer changes
+
+    Parameters
+    ----------
+    max_layers : int, optional
+        Number of layer indexes kept in memory, by default 16
+    """
+
+    def __init__(self, max_layers: int = MAX_INDEXED_LAYERS):
+        self._indexes = LRUCache(maxsize=max_layers)
+        self._lock = threading.Lock()
+
+    def get(self, storage, name: str, version: str) -> LayerIndex:
+        """Index of a layer version, read from storage if missing"""
+        with self._lock:
+            index = self._indexes.get(name)
+        if index is None or index.version != version:
+            index = build_index(read_layer(storage, name), version)
+            with self._lock:
+                self._indexes[name] = index
+        return index
+
+
+def encode_tile(index: LayerIndex, layer: str, z: int, x: int, y: int) -> bytes:
+    """
+    Encode the features of a layer within a tile
+
+    Features are found with the spatial index, simplified to the tile
+    resolution and clipped to the tile plus a small buffer. Lines and polygons
+    smaller than a pixel are left out.
+
+    Parameters
+    ----------
+    index : LayerIndex
+        Spatial index of the layer
+    layer : str
+        Layer name inside the tile
+    z : int
+        Zoom level
+    x : int
+        Tile x coordinate
+    y : int
+        Tile y coordinate
+
+    Returns
+    -------
+    tile : bytes
+        Encoded vector tile
+    """
+    bounds = mercantile.xy_bounds(x, y, z)
+    resolution = (bounds.right - bounds.left) / EXTENT
+    margin = BUFFER * resolution
+    clip = (
+        bounds.left - margin,
+        bounds.bottom - margin,
+        bounds.right + margin,
+        bounds.top + margin,
+    )
+    candidates = index.tree.query(shapely.box(*clip), predicate="intersects")
+    # Lines and polygons smaller than a pixel would not be visible
+    extents = shapely.bounds(index.geometries[candidates])
+    visible = (shapely.get_dimensions(index.geometries[candidates]) == 0) | (
+        np.maximum(extents[:, 2] - extents[:, 0], extents[:, 3] - extents[:, 1])
+        >= resolution
+    )
+    candidates = candidates[visible]
+    geometries = shapely.simplify(
+        index.geometries[candidates], resolution, preserve_topology=True
+    )
+    geometries = shapely.clip_by_rect(geometries, *clip)
+    keep = ~shapely.is_empty(geometries)
+    features = [
+        {"geometry": geometry, "properties": index.properties[i]}
+        for geometry, i in zip(geometries[keep], candidates[keep])
+    ]
+    return mapbox_vector_tile.encode(
+        [{"name": layer, "features": features}],
+        default_options={
+            "quantize_bounds": (bounds.left, bounds.bottom, bounds.right, bounds.top),
+            "extents": EXTENT,
+        },
+    )
@@ -0,0 +1,466 @@
+"""
+Benchmarks of the pipeline stages and the API endpoints on synthetic data
+
+Every scale is generated in a temporary folder used as local storage, the same
+way the pipeline uses its data storage. OSM loaders return the synthetic layers
+instead of querying Overpass, so runs need no network. Results are saved as
+JSON, named after the time and the git commit, and can be compared with a
+previous run:
+
+    python benchmarks/run.py --scales small medium
+    python benchmarks/run.py --compare benchmarks/results/<previous>.json
+
+The comparison exits with status 1 when the median latency of a benchmark grew
+more than the threshold.
+"""
+
+import argparse
+import gc
+import importlib.util
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Callable, Iterator, List, Optional
+
+import mercantile
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT_DIR = os.path.join(ROOT, "scripts", "renewable-energy")
+API_DIR = os.path.join(ROOT, "apis", "api")
+SHARED_DIR = os.path.join(ROOT, "shared", "raster")
+sys.path[:0] = [SCRIPT_DIR, API_DIR, SHARED_DIR]
+
+from spai.storage.LocalStorage import LocalStorage  # noqa: E402
+
+from src import downloads  # noqa: E402
+from src.downloads import download_pipelines, download_power_networks  # noqa: E402
+from src.instrumentation import peak_rss_mb  # noqa: E402
+from src.raster_stats import write_raster_stats  # noqa: E402
+from src.suitable_areas import ENGINES, find_suitable_areas  # noqa: E402
+from src.terrain import TerrainCriteria  # noqa: E402
+from src.utilities import create_buffer  # noqa: E402
+from src.vector_io import (  # noqa: E402
+    DEFAULT_VECTOR_FORMAT,
+    VECTOR_FORMATS,
+    read_layer,
+    set_vector_format,
+)
+from synthetic import SCALES, generate  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REPEAT = 5
+DEFAULT_THRESHOLD = 0.25
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+TILE_ZOOM = 13
+
+
+def percentiles(samples: List[float]) -> dict:
+    """Latency summary of samples in seconds, in milliseconds"""
+    ms = np.asarray(samples) * 1000
+    return {
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(ms, 95)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+        "mean_ms": round(float(ms.mean()), 3),
+        "min_ms": round(float(ms.min()), 3),
+    }
+
+
+def measure(
+    func: Callable[[], object],
+    repeat: int,
+    items: int = 1,
+    unit: str = "calls",
+    setup: Optional[Callable[[], None]] = None,
+) -> dict:
+    """
+    Time a function and measure its memory
+
+    Timed runs go without tracemalloc, which slows allocations down. One more
+    run measures the peak of Python and numpy allocations.
+
+    Parameters
+    ----------
+    func : callable
+        Function to benchmark
+    repeat : int
+        Number of timed runs
+    items : int, optional
+        Items processed by a run, for the throughput, by default 1
+    unit : str, optional
+        Unit of the items, by default "calls"
+    setup : callable, optional
+        Called before every run, not timed
+
+    Returns
+    -------
+    dict
+        Samples, latency percentiles, throughput and memory
+    """
+    samples = []
+    rss = peak_rss_mb()
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    rss_growth = peak_rss_mb() - rss
+
+    if setup is not None:
+        setup()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "samples_ms": [round(s * 1000, 3) for s in samples],
+        **percentiles(samples),
+        "throughput": round(items * len(samples) / sum(samples), 3),
+        "throughput_unit": f"{unit}/s",
+        "tracemalloc_peak_mb": round(peak / 1024**2, 2),
+        "rss_growth_mb": round(rss_growth, 1),
+    }
+
+
+@contextmanager
+def offline_loaders(layers: dict) -> Iterator[None]:
+    """Serve the synthetic OSM frames instead of querying Overpass"""
+    loaders = {
+        "load_power_networks": layers["power_networks"],
+        "load_pipelines": layers["pipelines"],
+    }
+    previous = {name: getattr(downloads, name) for name in loaders}
+    try:
+        for name, gdf in loaders.items():
+            setattr(downloads, name, lambda *args, gdf=gdf, **kwargs: gdf)
+        yield
+    finally:
+        for name, loader in previous.items():
+            setattr(downloads, name, loader)
+
+
+def stage_benchmarks(storage, layers: dict) -> dict:
+    """Pipeline stages to benchmark, as (function, items, unit)"""
+    aoi = layers["aoi"]
+    roads = layers["roads"]
+    power = layers["power_networks"]
+    benchmarks = {
+        "create_buffer/roads": (
+            lambda: create_buffer(roads, 500),
+            len(roads),
+            "features",
+        ),
+        "download_power_networks": (
+            lambda: download_power_networks(storage, aoi),
+            len(power),
+            "features",
+        ),
+        "download_pipelines": (
+            lambda: download_pipelines(storage, aoi),
+            len(layers["pipelines"]),
+            "features",
+        ),
+        "write_raster_stats": (
+            lambda: write_raster_stats(storage, ["dem.tif", "land_cover.tif"]),
+            2,
+            "rasters",
+        ),
+    }
+    # Reads of the AOI corner, a quarter of the layer
+    minx, miny, maxx, maxy = aoi.total_bounds
+    corner = (minx, miny, (minx + maxx) / 2, (miny + maxy) / 2)
+    benchmarks["read_layer/roads"] = (
+        lambda: read_layer(storage, "roads"),
+        len(roads),
+        "features",
+    )
+    benchmarks["read_layer/roads+bbox"] = (
+        lambda: read_layer(storage, "roads", bbox=corner),
+        len(roads),
+        "features",
+    )
+    infrastructure = len(roads) + len(power) + len(layers["pipelines"])
+    for engine in ENGINES:
+        benchmarks[f"find_suitable_areas/{engine}"] = (
+            lambda engine=engine: find_suitable_areas(storage, aoi, engine=engine),
+            infrastructure,
+            "features",
+        )
+    benchmarks["find_suitable_areas/overlay+terrain"] = (
+        lambda: find_suitable_areas(
+            storage, aoi, engine="overlay", terrain=TerrainCriteria()
+        ),
+        infrastructure,
+        "features",
+    )
+    return benchmarks
+
+
+def load_api(storage):
+    """Import the API on the benchmark storage, without starting a server"""
+    os.environ.setdefault("SPAI_STORAGE_NAMES", "local_data")
+    os.environ.setdefault("SPAI_STORAGE_LOCAL_DATA_PATH", storage.path)
+    spec = importlib.util.spec_from_file_location(
+        "api_main", os.path.join(API_DIR, "main.py")
+    )
+    api = importlib.util.module_from_spec(spec)
+    cwd = os.getcwd()
+    # SPAIVars looks for spai.vars.json from the working directory
+    os.chdir(ROOT)
+    try:
+        spec.loader.exec_module(api)
+    finally:
+        os.chdir(cwd)
+    return api
+
+
+def reset_api(api, storage) -> None:
+    """Point the API to a storage, with empty in-memory caches"""
+    api.storage = storage
+    api.async_storage.storage = storage
+    api.analytics_cache = api.ResponseCache()
+    api.vector_tile_cache = api.ResponseCache()
+    api.layer_indexes = api.LayerIndexCache()
+    api.layer_levels = api.LayerLevelsCache()
+    api.raster_stats = api.RasterStatsCache()
+    api.tile_cache = api.TileCache()
+
+
+def endpoint_benchmarks(layers: dict) -> dict:
+    """API requests to benchmark, keyed by name"""
+    minx, miny, maxx, maxy = layers["aoi"].total_bounds
+    lon, lat = (minx + maxx) / 2, (miny + maxy) / 2
+    tile = mercantile.tile(lon, lat, TILE_ZOOM)
+    bbox = f"{minx},{miny},{lon},{lat}"
+    return {
+        "analytics": "/analytics/roads",
+        "analytics/bbox+zoom": f"/analytics/roads?bbox={bbox}&zoom=10",
+        "analytics/mvt": f"/analytics/roads/{tile.z}/{tile.x}/{tile.y}.mvt",
+        "images/png": f"/images/dem.tif/{tile.z}/{tile.x}/{tile.y}.png"
+        "?stretch=0,1000",
+        "images/stats": "/images/dem.tif/stats",
+        "dem": "/dem",
+        "pipeline/status": "/pipeline/status",
+    }
+
+
+def run_scale(scale_name: str, repeat: int, pattern: Optional[str], api) -> list:
+    """Generate a scale and benchmark every stage and endpoint on it"""
+    scale = SCALES[scale_name]
+    tmp = tempfile.mkdtemp(prefix=f"benchmark-{scale_name}-")
+    results = []
+    try:
+        storage = LocalStorage("data", path=os.path.join(tmp, "data"))
+        os.makedirs(storage.path, exist_ok=True)
+        started = time.perf_counter()
+        layers = generate(storage, scale)
+        logger.info(
+            "Generated %s dataset in %.1fs", scale_name, time.perf_counter() - started
+        )
+
+        with offline_loaders(layers):
+            for name, (func, items, unit) in stage_benchmarks(storage, layers).items():
+                if pattern and pattern not in name:
+                    continue
+                logger.info("Stage %s (%s)", name, scale_name)
+                result = measure(func, repeat, items, unit)
+                results.append(
+                    {"scale": scale_name, "kind": "stage", "name": name, **result}
+                )
+
+        if api is None:
+            return results
+        from fastapi.testclient import TestClient
+
+        client = TestClient(api.app)
+        for name, url in endpoint_benchmarks(layers).items():
+            if pattern and pattern not in name:
+                continue
+            logger.info("Endpoint %s (%s)", name, scale_name)
+
+            def request(url=url):
+                response = client.get(url)
+                if response.status_code >= 400:
+                    raise RuntimeError(f"{url}: {response.status_code} {response.text}")
+
+            for cached in (False, True):
+                reset_api(api, storage)
+                if cached:
+                    request()
+                result = measure(
+                    request,
+                    repeat,
+                    unit="requests",
+                    setup=None if cached else lambda: reset_api(api, storage),
+                )
+                results.append(
+                    {
+                        "scale": scale_name,
+                        "kind": "endpoint",
+                        "name": f"{name} ({'warm' if cached else 'cold'})",
+                        "url": url,
+                        **result,
+                    }
+                )
+        return results
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def compare(results: list, baseline: dict, threshold: float) -> List[str]:
+    """
+    Benchmarks whose median latency grew more than a threshold
+
+    Parameters
+    ----------
+    results : list of dict
+        Results of this run
+    baseline : dict
+        Saved results of a previous run
+    threshold : float
+        Allowed relative growth of the median latency, e.g. 0.25
+
+    Returns
+    -------
+    list of str
+        Description of every regression
+    """
+    previous = {
+        (r["scale"], r["kind"], r["name"]): r for r in baseline.get("results", [])
+    }
+    regressions = []
+    print(f"\n{'benchmark':58} {'before':>10} {'after':>10} {'change':>8}")
+    for result in results:
+        key = (result["scale"], result["kind"], result["name"])
+        if key not in previous:
+            continue
+        before, after = previous[key]["p50_ms"], result["p50_ms"]
+        change = (after - before) / before if before else 0.0
+        label = f"{result['scale']}/{result['name']}"
+        flag = " !" if change > threshold else ""
+        print(f"{label:58} {before:>10.2f} {after:>10.2f} {change:>+8.1%}{flag}")
+        if change > threshold:
+            regressions.append(f"{label}: p50 {before:.2f} ms -> {after:.2f} ms")
+    return regressions
+
+
+def print_results(results: list) -> None:
+    print(
+        f"\n{'benchmark':58} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} "
+        f"{'throughput':>18} {'peak MB':>8}"
+    )
+    for r in results:
+        label = f"{r['scale']}/{r['name']}"
+        throughput = f"{r['throughput']:.1f} {r['throughput_unit']}"
+        print(
+            f"{label:58} {r['p50_ms']:>10.2f} {r['p95_ms']:>10.2f} "
+            f"{r['p99_ms']:>10.2f} {throughput:>18} {r['tracemalloc_peak_mb']:>8.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--scales", nargs="+", choices=list(SCALES), default=["small", "medium"]
+    )
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("-k", dest="pattern", help="Only benchmarks matching")
+    parser.add_argument("--no-api", action="store_true", help="Skip the endpoints")
+    parser.add_argument(
+        "--vector-format",
+        choices=VECTOR_FORMATS,
+        help="Format of the vector layers, by default GeoParquet",
+    )
+    parser.add_argument("--output", default=RESULTS_DIR)
+    parser.add_argument("--compare", help="Results of a previous run")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="Allowed growth of the median latency, by default 0.25",
+    )
+    args = parser.parse_args()
+    set_vector_format(args.vector_format)
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s | %(levelname)-8s | %(message)s"
+    )
+    # Keep the pipeline logs out of the timings
+    logging.getLogger("src").setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    api = None
+    placeholder = tempfile.mkdtemp(prefix="benchmark-api-")
+    try:
+        if not args.no_api:
+            # Every scale points the API to its own storage
+            api = load_api(LocalStorage("data", path=placeholder))
+        results = []
+        for scale in args.scales:
+            results.extend(run_scale(scale, args.repeat, args.pattern, api))
+    finally:
+        shutil.rmtree(placeholder, ignore_errors=True)
+
+    now = datetime.now(timezone.utc)
+    commit = git_commit()
+    report = {
+        "meta": {
+            "created_at": now.isoformat(),
+            "commit": commit,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "scales": args.scales,
+            "repeat": args.repeat,
+            "vector_format": args.vector_format or DEFAULT_VECTOR_FORMAT,
+        },
+        "results": results,
+    }
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(
+        args.output, f"{now:%Y%m%dT%H%M%S}-{commit or 'unknown'}.json"
+    )
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    print_results(results)
+    print(f"\nResults saved to {path}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print("\nRegressions:\n" + "\n".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+"""
+Synthetic AOIs, OSM-like layers and terrain rasters for the benchmarks
+"""
+
+import os
+import tempfile
+from dataclasses import dataclass
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+import shapely
+from rasterio.transform import from_origin
+from src.downloads import PIPELINES_LAYER
+from src.vector_io import write_layer
+
+# Center of the synthetic AOIs, in the area of the template AOI
+CENTER = (11.7, 42.85)
+METERS_PER_DEGREE = 111320.0
+LAND_COVER_CLASSES = np.array([10, 20, 30, 40, 50, 60, 80], dtype="uint8")
+_BLOB_VERTICES = 24
+
+
+@dataclass(frozen=True)
+class Scale:
+    """Size of a synthetic dataset"""
+
+    name: str
+    aoi_km: float
+    roads: int
+    power: int
+    pipelines: int
+    protected: int
+    dem_pixels: int
+
+
+SCALES = {
+    scale.name: scale
+    for scale in (
+        Scale("small", 5, 200, 100, 20, 10, 512),
+        Scale("medium", 20, 2000, 1000, 200, 100, 2048),
+        Scale("large", 60, 20000, 8000, 2000, 600, 6144),
+    )
+}
+
+
+def aoi_bounds(scale: Scale) -> tuple:
+    """Bounds of the square AOI of a scale, in EPSG:4326"""
+    half_lat = scale.aoi_km * 500 / METERS_PER_DEGREE
+    half_lon = half_lat / np.cos(np.radians(CENTER[1]))
+    return (
+        CENTER[0] - half_lon,
+        CENTER[1] - half_lat,
+        CENTER[0] + half_lon,
+        CENTER[1] + half_lat,
+    )
+
+
+def make_aoi(scale: Scale) -> gpd.GeoDataFrame:
+    """Square AOI with a scenario, like the AOIs of spai.vars.json"""
+    return gpd.GeoDataFrame(
+        {"name": [f"synthetic-{scale.name}"], "scenario": ["synthetic"]},
+        geometry=[shapely.box(*aoi_bounds(scale))],
+        crs="EPSG:4326",
+    )
+
+
+def _random_walks(
+    rng: np.random.Generator, n: int, bounds: tuple, step: float
+) -> np.ndarray:
+    """Polylines of 2 to 12 vertices wandering from random points of the bounds"""
+    minx, miny, maxx, maxy = bounds
+    sizes = rng.integers(2, 13, n)
+    starts = np.column_stack([rng.uniform(minx, maxx, n), rng.uniform(miny, maxy, n)])
+    steps = rng.normal(0, step, (sizes.sum(), 2))
+    walked = np.cumsum(steps, axis=0)
+    # Restart the walk at the first vertex of every line
+    first = np.r_[0, np.cumsum(sizes)[:-1]]
+    walked -= np.repeat(walked[first] - steps[first], sizes, axis=0)
+    coords = np.repeat(starts, sizes, axis=0) + walked
+    return shapely.linestrings(coords, indices=np.repeat(np.arange(n), sizes))
+
+
+def _blobs(rng: np.random.Generator, n: int, bounds: tuple, size: float) -> np.ndarray:
+    """Irregular star-shaped polygons around random points of the bounds"""
+    minx, miny, maxx, maxy = bounds
+    centers = np.column_stack([rng.uniform(minx, maxx, n), rng.uniform(miny, maxy, n)])
+    angles = np.linspace(0, 2 * np.pi, _BLOB_VERTICES, endpoint=False)
+    radii = rng.uniform(0.3, 1.0, (n, 1)) * size
+    radii = radii * rng.uniform(0.6, 1.0, (n, _BLOB_VERTICES))
+    coords = np.stack(
+        [
+            centers[:, :1] + radii * np.cos(angles),
+            centers[:, 1:] + radii * np.sin(angles),
+        ],
+        axis=-1,
+    ).reshape(-1, 2)
+    rings = shapely.linearrings(
+        coords, indices=np.repeat(np.arange(n), _BLOB_VERTICES)
+    )
+    return shapely.polygons(rings)
+
+
+def _tag_lists(rng: np.random.Generator, n: int, values: list, share: float) -> list:
+    """Tag values, a share of them as lists like the ones returned by osmnx"""
+    tags = rng.choice(values, n).tolist()
+    for i in np.flatnonzero(rng.random(n) < share):
+        tags[i] = rng.choice(values, 2, replace=False).tolist()
+    return tags
+
+
+def make_roads(rng: np.random.Generator, scale: Scale) -> gpd.GeoDataFrame:
+    bounds = aoi_bounds(scale)
+    n = scale.roads
+    return gpd.GeoDataFrame(
+        {
+            "highway": rng.choice(
+                ["motorway", "trunk", "primary", "secondary", "tertiary"], n
+            ),
+            "name": [f"Road {i}" for i in range(n)],
+            "ref": rng.choice(["SP1", "SP2", "SR2", "E78"], n),
+            "maxspeed": rng.choice(["50", "70", "90", None], n),
+        },
+        geometry=_random_walks(rng, n, bounds, 0.002),
+        crs="EPSG:4326",
+    )
+
+
+def make_power_networks(rng: np.random.Generator, scale: Scale) -> gpd.GeoDataFrame:
+    """Power lines, substations and plants, with list tags and all-null tags"""
+    bounds = aoi_bounds(scale)
+    n_lines = int(scale.power * 0.7)
+    n_points = int(scale.power * 0.2)
+    n_polygons = scale.power - n_lines - n_points
+    minx, miny, maxx, maxy = bounds
+    geometries = np.concatenate(
+        [
+            _random_walks(rng, n_lines, bounds, 0.004),
+            shapely.points(
+                rng.uniform(minx, maxx, n_points), rng.uniform(miny, maxy, n_points)
+            ),
+            _blobs(rng, n_polygons, bounds, 0.002),
+        ]
+    )
+    n = len(geometries)
+    return gpd.GeoDataFrame(
+        {
+            "power": ["line"] * n_lines
+            + ["transformer"] * n_points
+            + ["substation"] * n_polygons,
+            "voltage": _tag_lists(
+                rng, n, ["15000", "132000", "220000", "380000"], 0.3
+            ),
+            "cables": _tag_lists(rng, n, ["3", "6", "9"], 0.2),
+            "operator": rng.choice(["Terna", "Enel", None], n),
+            "fixme": [None] * n,
+            "note": [None] * n,
+        },
+        geometry=geometries,
+        crs="EPSG:4326",
+    )
+
+
+def make_pipelines(rng: np.random.Generator, scale: Scale) -> gpd.GeoDataFrame:
+    bounds = aoi_bounds(scale)
+    n = scale.pipelines
+    return gpd.GeoDataFrame(
+        {
+            "man_made": ["pipeline"] * n,
+            "substance": _tag_lists(rng, n, ["gas", "water", "oil", "heat"], 0.15),
+            "operator": [None] * n,
+        },
+        geometry=_random_walks(rng, n, bounds, 0.003),
+        crs="EPSG:4326",
+    )
+
+
+def make_protected_areas(rng: np.random.Generator, scale: Scale) -> gpd.GeoDataFrame:
+    bounds = aoi_bounds(scale)
+    n = scale.protected
+    size = (bounds[2] - bounds[0]) / max(4.0, np.sqrt(n) * 2)
+    return gpd.GeoDataFrame(
+        {
+            "boundary": ["protected_area"] * n,
+            "name": [f"Reserve {i}" for i in range(n)],
+        },
+        geometry=_blobs(rng, n, bounds, size),
+        crs="EPSG:4326",
+    )
+
+
+def _write_raster(storage, name: str, data: np.ndarray, bounds: tuple, **profile):
+    height, width = data.shape
+    transform = from_origin(
+        bounds[0],
+        bounds[3],
+        (bounds[2] - bounds[0]) / width,
+        (bounds[3] - bounds[1]) / height,
+    )
+    fd, path = tempfile.mkstemp(suffix=".tif")
+    os.close(fd)
+    try:
+        with rasterio.open(
+            path,
+            "w",
+            driver="GTiff",
+            height=height,
+            width=width,
+            count=1,
+            dtype=data.dtype,
+            crs="EPSG:4326",
+            transform=transform,
+            tiled=True,
+            **profile,
+        ) as ds:
+            ds.write(data, 1)
+        storage.create(path, name)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def make_terrain(rng: np.random.Generator, scale: Scale, storage) -> None:
+    """Smooth DEM with noise, and patches of land cover classes"""
+    n = scale.dem_pixels
+    y, x = np.mgrid[0:n, 0:n] / n
+    dem = (
+        400
+        + 300 * np.sin(3 * np.pi * x) * np.cos(2 * np.pi * y)
+        + 150 * np.sin(7 * np.pi * (x + y))
+        + rng.normal(0, 5, (n, n))
+    ).astype("float32")
+    bounds = aoi_bounds(scale)
+    _write_raster(storage, "dem.tif", dem, bounds, nodata=-9999.0)
+    patches = rng.choice(LAND_COVER_CLASSES, (n // 64 + 1, n // 64 + 1))
+    land_cover = np.kron(patches, np.ones((64, 64), dtype="uint8"))[:n, :n]
+    _write_raster(storage, "land_cover.tif", land_cover, bounds, nodata=0)
+
+
+def generate(storage, scale: Scale, seed: int = 0) -> dict:
+    """
+    Write a synthetic dataset to storage, with the names used by the pipeline
+
+    Vector layers are written in the configured vector format.
+
+    Power networks and pipelines are returned as loaded from OSM, with list
+    tags, for the benchmarks of their download post-processing. Only their
+    lines are written, under the layer names the downloads save them to.
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object where the data is saved
+    scale : Scale
+        Size of the dataset
+    seed : int, optional
+        Seed of the random generator, by default 0
+
+    Returns
+    -------
+    dict
+        The AOI and every layer, keyed by name
+    """
+    rng = np.random.default_rng(seed)
+    layers = {
+        "aoi": make_aoi(scale),
+        "roads": make_roads(rng, scale),
+        "protected_areas": make_protected_areas(rng, scale),
+        "power_networks": make_power_networks(rng, scale),
+        "pipelines": make_pipelines(rng, scale),
+    }
+    write_layer(storage, layers["roads"], "roads")
+    write_layer(storage, layers["protected_areas"], "protected_areas")
+    power = layers["power_networks"]
+    write_layer(
+        storage,
+        power.loc[power.geometry.type == "LineString", ["power", "geometry"]],
+        "power_lines",
+    )
+    write_layer(
+        storage, layers["pipelines"][["man_made", "geometry"]], PIPELINES_LAYER
+    )
+    make_terrain(rng, scale, storage)
+    return layers
+
@@ -3,18 +3,51 @@ from spai.config import SPAIVars
 from spai.logging.log import log_inputs, log_results, Result
 
 from src.downloads import (
-    download_terrain_data,
-    download_geophysical_data,
-    download_infrastructure_data,
+    DEFAULT_MAX_WORKERS,
+    DEFAULT_RETRIES,
+    DOWNLOAD_GROUPS,
+    DOWNLOAD_OUTPUTS,
+    DOWNLOAD_QUERIES,
+    GEOPHYSICAL,
+    INFRASTRUCTURE,
+    TERRAIN,
+    check_downloads,
+    completed_groups,
+    download_all_data,
+)
+from src.cache import (
+    DEFAULT_CACHE_DIR,
+    DEFAULT_MAX_SIZE_MB,
+    DEFAULT_TTL,
+    DownloadCache,
+)
+from src.batch import run_batch
+from src.cog import DOWNLOADED_RASTERS, OUTPUT_RASTERS, optimize_rasters
+from src.incremental import StageGraph
+from src.instrumentation import DOWNLOAD, instrument_storage, recorder, stage
+from src.raster_stats import write_raster_stats
+from src.site_ranking import RANKED_LAYER, ScoreWeights, write_ranked_sites
+from src.site_stats import SITE_STATS, SITES_LAYER, write_site_stats
+from src.suitable_areas import INFRASTRUCTURE_BUFFER, find_suitable_areas
+from src.sweep import SWEEP_TABLE, sweep_layer, threshold_sweep
+from src.terrain import DEFAULT_BLOCK_SIZE, EXCLUSION_RASTER, TerrainCriteria
+from src.tiling import DEFAULT_TILE_SIZE
+from src.utilities import area_km2
+from src.vector_io import (
+    get_vector_format,
+    layer_exists,
+    read_layer,
+    set_vector_format,
 )
-from src.suitable_areas import find_suitable_areas
 from src.status_registry import (
     BUILDING,
     ERROR,
     READY,
     WARNING,
+    set_stages,
     set_status,
 )
+from dataclasses import asdict
 import geopandas as gpd
 import logging
 
@@ -29,13 +62,46 @@ vars = SPAIVars()
 
 def main():
     """Main function that executes the workflow"""
-    storage = Storage()["data"]
+    storage = instrument_storage(Storage()["data"])
+    recorder.reset()
     vars = SPAIVars()
     aoi = vars["AOI"]
     gdf = gpd.GeoDataFrame.from_features(aoi, crs="EPSG:4326")
 
     log_inputs(vars["AOI"])
 
+    cache = None
+    if vars["CACHE_ENABLED"] is not False:
+        cache = DownloadCache(
+            path=vars["CACHE_DIR"] or DEFAULT_CACHE_DIR,
+            ttl=vars["CACHE_TTL"] or DEFAULT_TTL,
+            max_size_mb=vars["CACHE_MAX_SIZE_MB"] or DEFAULT_MAX_SIZE_MB,
+            refresh=bool(vars["CACHE_REFRESH"]),
+        )
+
+    download_options = dict(
+        max_workers=vars["DOWNLOAD_WORKERS"] or DEFAULT_MAX_WORKERS,
+        timeouts=vars["DOWNLOAD_TIMEOUTS"],
+        retries=(
+            vars["DOWNLOAD_RETRIES"]
+            if vars["DOWNLOAD_RETRIES"] is not None
+            else DEFAULT_RETRIES
+        ),
+        cache=cache,
+        merge_osm=bool(vars["OSM_MERGED_QUERY"]),
+    )
+    engine = vars["SUITABILITY_ENGINE"] or "overlay"
+    terrain = (
+        TerrainCriteria.from_vars(vars) if vars["TERRAIN_CRITERIA"] is not False else None
+    )
+    cog = vars["COG_ENABLED"] is not False
+    tile_size = vars["TILE_SIZE"] if vars["TILE_SIZE"] is not None else DEFAULT_TILE_SIZE
+    vector_format = vars["VECTOR_FORMAT"]
+    set_vector_format(vector_format)
+    weights = ScoreWeights.from_vars(vars)
+    # Suitable area and sites for other infrastructure distances than 500 m
+    sweep_distances = sorted({float(d) for d in vars["SWEEP_DISTANCES"] or []})
+
     try:
         set_status(
             storage,
@@ -43,70 +109,217 @@ def main():
             "Data is being downloaded and processed...",
         )
 
-        set_status(storage, BUILDING, "Downloading terrain data...")
-        download_terrain_data(storage, gdf)
+        if vars["BATCH_MODE"]:
+            summaries = run_batch(
+                storage,
+                gdf,
+                by=vars["BATCH_BY"] or "scenario",
+                max_workers=vars["BATCH_WORKERS"],
+                download_options=download_options,
+                engine=engine,
+                terrain=terrain,
+                tile_size=tile_size,
+                cog=cog,
+                vector_format=vector_format,
+                weights=weights,
+            )
+            log_results(
+                [
+                    Result(
+                        label=f"Suitable area ({summary['job']})",
+                        value=summary["area_km2"],
+                        unit="km2",
+                    )
+                    for summary in summaries
+                ]
+            )
+            return
+
+        # Stages only rerun when the AOI, their parameters or their inputs changed
+        graph = StageGraph(storage, gdf, force=vars["INCREMENTAL"] is False)
+        for group in DOWNLOAD_GROUPS:
+            graph.add(
+                group,
+                DOWNLOAD_OUTPUTS[group],
+                params={
+                    "queries": DOWNLOAD_QUERIES[group],
+                    "merge_osm": download_options["merge_osm"],
+                    "vector_format": get_vector_format(),
+                    "cog": cog,
+                },
+                kind=DOWNLOAD,
+            )
+        graph.add(
+            "suitability",
+            ["suitable_areas", *OUTPUT_RASTERS],
+            params={
+                "engine": engine,
+                "terrain": asdict(terrain) if terrain is not None else None,
+                "tile_size": tile_size,
+                "buffer": INFRASTRUCTURE_BUFFER,
+                # Buffers were computed in EPSG:3857 by earlier versions
+                "buffer_crs": "local_metric",
+                "vector_format": get_vector_format(),
+                "cog": cog,
+            },
+            deps=list(DOWNLOAD_GROUPS),
+        )
+        # Sites are measured on the terrain rasters and power networks too
+        graph.add(
+            "site_stats",
+            [SITES_LAYER, SITE_STATS],
+            params={"vector_format": get_vector_format()},
+            deps=["suitability", TERRAIN, INFRASTRUCTURE],
+        )
+        graph.add(
+            "site_ranking",
+            [RANKED_LAYER],
+            params={
+                "weights": asdict(weights),
+                "vector_format": get_vector_format(),
+            },
+            deps=["site_stats", INFRASTRUCTURE],
+        )
+        if sweep_distances:
+            graph.add(
+                "threshold_sweep",
+                [SWEEP_TABLE, *map(sweep_layer, sweep_distances)],
+                params={
+                    "distances": sweep_distances,
+                    "terrain": asdict(terrain) if terrain is not None else None,
+                    "vector_format": get_vector_format(),
+                },
+                # The terrain exclusion mask is written by the suitability stage
+                deps=["suitability", TERRAIN, GEOPHYSICAL, INFRASTRUCTURE],
+            )
+
+        # Refreshing the cache needs the downloads to run
+        downloads = graph.plan(DOWNLOAD_GROUPS, force=bool(vars["CACHE_REFRESH"]))
+        if downloads:
+            with stage("download", DOWNLOAD):
+                outcomes = download_all_data(
+                    storage, gdf, groups=downloads, **download_options
+                )
+            completed = completed_groups(outcomes, downloads)
+            if TERRAIN in completed:
+                if cog:
+                    with stage("cog/downloads"):
+                        optimize_rasters(storage, DOWNLOADED_RASTERS)
+                with stage("raster_stats/downloads"):
+                    write_raster_stats(storage, DOWNLOADED_RASTERS)
+            # Failed groups are downloaded again by the next run, the stages
+            # after them do not run on the files left by an earlier one
+            for group in completed:
+                graph.complete(group)
+            check_downloads(outcomes)
         if not storage.exists("dem.tif") or not storage.exists("land_cover.tif"):
             set_status(
                 storage,
                 WARNING,
                 "Terrain data incomplete — DEM or land cover missing",
             )
-
-        set_status(storage, BUILDING, "Downloading geophysical data...")
-        download_geophysical_data(storage, gdf)
-        if not storage.exists("protected_areas.geojson"):
+        if not layer_exists(storage, "protected_areas"):
             set_status(
                 storage,
                 WARNING,
                 "No protected areas found",
             )
-
-        set_status(storage, BUILDING, "Downloading infrastructure data...")
-        download_infrastructure_data(storage, gdf)
-        if not storage.exists("roads.geojson"):
+        if not layer_exists(storage, "roads"):
             set_status(
                 storage,
                 WARNING,
                 "No roads found",
             )
 
-        set_status(storage, BUILDING, "Finding suitable areas...")
-        suitable_areas = find_suitable_areas(storage, gdf)
+        if graph.plan(["suitability"]):
+            set_status(storage, BUILDING, "Finding suitable areas...")
+            with stage("suitable_areas") as record:
+                suitable_areas = find_suitable_areas(
+                    storage,
+                    gdf,
+                    engine=engine,
+                    terrain=terrain,
+                    tile_size=tile_size,
+                    max_workers=vars["TILE_WORKERS"],
+                )
+                record.features = len(suitable_areas)
+            if cog:
+                with stage("cog/outputs"):
+                    optimize_rasters(storage, OUTPUT_RASTERS)
+            with stage("raster_stats/outputs"):
+                write_raster_stats(storage, OUTPUT_RASTERS)
+            graph.complete("suitability")
+        else:
+            # Empty results are not saved
+            suitable_areas = read_layer(storage, "suitable_areas")
+            if suitable_areas is None:
+                suitable_areas = gpd.GeoDataFrame(geometry=[], crs="EPSG:4326")
 
-        suitable_areas_utm = suitable_areas.to_crs(suitable_areas.estimate_utm_crs())
-        area_km2 = 0.0
-        if suitable_areas_utm is not None and not suitable_areas_utm.empty:
-            area_km2 = round(
-                suitable_areas_utm.to_crs(epsg=3857).geometry.area.sum() / 1e6, 2
-            )
+        if graph.plan(["site_stats"]):
+            with stage("site_stats") as record:
+                sites = write_site_stats(
+                    storage,
+                    suitable_areas,
+                    block_size=(
+                        terrain.block_size if terrain is not None else DEFAULT_BLOCK_SIZE
+                    ),
+                )
+                record.features = len(sites)
+            graph.complete("site_stats")
+        if graph.plan(["site_ranking"]):
+            with stage("site_ranking") as record:
+                ranked = write_ranked_sites(storage, weights)
+                record.features = len(ranked)
+            graph.complete("site_ranking")
+        if sweep_distances and graph.plan(["threshold_sweep"]):
+            set_status(storage, BUILDING, "Sweeping infrastructure distances...")
+            with stage("threshold_sweep"):
+                threshold_sweep(
+                    storage,
+                    gdf,
+                    sweep_distances,
+                    exclusion=EXCLUSION_RASTER if terrain is not None else None,
+                )
+            graph.complete("threshold_sweep")
+
+        suitable_area_km2 = area_km2(suitable_areas)
 
         log_results(
             [
-                Result(label="Suitable area", value=area_km2, unit="km2"),
+                Result(label="Suitable area", value=suitable_area_km2, unit="km2"),
                 Result(
                     label="Number of suitable locations",
-                    value=(
-                        len(suitable_areas_utm)
-                        if suitable_areas_utm is not None
-                        else 0
-                    ),
+                    value=len(suitable_areas),
                 ),
             ]
         )
 
+        skipped = (
+            f" (unchanged, skipped: {', '.join(graph.skipped)})"
+            if graph.skipped
+            else ""
+        )
         if suitable_areas is None or suitable_areas.empty:
             set_status(
                 storage,
                 READY,
-                "Pipeline completed — no suitable areas found",
+                f"Pipeline completed — no suitable areas found{skipped}",
+                skipped=graph.skipped,
             )
         else:
-            set_status(storage, READY, "Pipeline completed successfully")
+            set_status(
+                storage,
+                READY,
+                f"Pipeline completed successfully{skipped}",
+                skipped=graph.skipped,
+            )
 
     except Exception as e:
         logger.exception("Pipeline failed")
         set_status(storage, ERROR, str(e))
         raise
+    finally:
+        set_stages(storage, recorder.records())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# Modules shared with the API, in the raster shared group of the project.
+# Deployed images have them next to main.py, already importable.
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..")
+_SHARED_DIR = os.path.normpath(os.path.join(_ROOT, "shared", "raster"))
+if os.path.isdir(_SHARED_DIR) and _SHARED_DIR not in sys.path:
+    sys.path.append(_SHARED_DIR)
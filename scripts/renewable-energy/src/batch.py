@@ -0,0 +1,455 @@
+"""Batch processing of several AOIs or scenarios as independent jobs."""
+
+import json
+import logging
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional
+
+import geopandas as gpd
+import pandas as pd
+import shapely
+
+from .cog import DOWNLOADED_RASTERS, OUTPUT_RASTERS, optimize_rasters
+from .downloads import (
+    DOWNLOAD_BUFFER,
+    DownloadError,
+    check_downloads,
+    download_all_data,
+)
+from .instrumentation import DOWNLOAD, instrument_storage, recorder, stage
+from .raster_stats import write_raster_stats
+from .site_ranking import ScoreWeights, write_ranked_sites
+from .site_stats import write_site_stats
+from .status_registry import (
+    BUILDING,
+    ERROR,
+    READY,
+    WARNING,
+    set_stages,
+    set_status,
+)
+from .suitable_areas import find_suitable_areas
+from .terrain import DEFAULT_BLOCK_SIZE, TerrainCriteria
+from .vector_io import set_vector_format
+from .utilities import area_km2, create_buffer, default_storage
+
+logger = logging.getLogger(__name__)
+
+SHARED_PREFIX = "shared"
+SUMMARY_PATH = "batch_summary.json"
+
+
+class PrefixedStorage:
+    """
+    Storage view that namespaces object names under a prefix.
+
+    Objects are written under the prefix. Reads look under the prefix first
+    and then under the fallback prefixes, so jobs can read shared downloads
+    while keeping their outputs apart.
+
+    Parameters
+    ----------
+    storage : Storage
+        Underlying storage
+    prefix : str
+        Prefix of the objects written through this view
+    fallbacks : list of str, optional
+        Prefixes searched, in order, for objects missing under the prefix
+    """
+
+    def __init__(self, storage, prefix: str, fallbacks: Optional[List[str]] = None):
+        self.storage = storage
+        self.prefix = prefix.strip("/")
+        self.fallbacks = [fallback.strip("/") for fallback in fallbacks or []]
+
+    @property
+    def path(self) -> str:
+        """Folder of the prefix, only for storages with a local path"""
+        return os.path.join(self.storage.path, self.prefix)
+
+    def _name(self, name: str, prefix: Optional[str] = None) -> str:
+        prefix = self.prefix if prefix is None else prefix
+        return f"{prefix}/{name}" if prefix else name
+
+    def _resolve(self, name: str) -> str:
+        for prefix in [self.prefix] + self.fallbacks:
+            if self.storage.exists(self._name(name, prefix)):
+                return self._name(name, prefix)
+        return self._name(name)
+
+    def exists(self, name: str) -> bool:
+        return any(
+            self.storage.exists(self._name(name, prefix))
+            for prefix in [self.prefix] + self.fallbacks
+        )
+
+    def read(self, name: str):
+        return self.storage.read(self._resolve(name))
+
+    def read_object(self, name: str):
+        return self.storage.read_object(self._resolve(name))
+
+    def object_info(self, name: str):
+        return self.storage.object_info(self._resolve(name))
+
+    def get_path(self, name: str) -> str:
+        return self.storage.get_path(self._resolve(name))
+
+    def create(self, data, name: str, **kwargs):
+        return self.storage.create(data, self._name(name), **kwargs)
+
+    def delete(self, name: str):
+        # Objects under the fallback prefixes are shared, never delete them
+        if self.storage.exists(self._name(name)):
+            return self.storage.delete(self._name(name))
+
+    def list(self, pattern: str = "*", recursive: bool = True):
+        prefix = f"{self.prefix}/" if self.prefix else ""
+        return [
+            name[len(prefix) :]
+            for name in self.storage.list(prefix + pattern, recursive=recursive)
+        ]
+
+
+def job_storage(
+    storage_factory: Callable[[], Any], name: str, shared_prefix: str
+) -> PrefixedStorage:
+    """Storage of a job, reading the downloads shared with other jobs."""
+    return PrefixedStorage(storage_factory(), name, [shared_prefix])
+
+
+def job_id(value: Any) -> str:
+    """Storage-safe identifier of a job."""
+    return re.sub(r"[^a-z0-9_-]+", "-", str(value).lower()).strip("-") or "aoi"
+
+
+def split_jobs(
+    aoi_gdf: gpd.GeoDataFrame, by: Optional[str] = "scenario"
+) -> Dict[str, gpd.GeoDataFrame]:
+    """
+    Split an AOI FeatureCollection into independent jobs.
+
+    Parameters
+    ----------
+    aoi_gdf : GeoDataFrame
+        GeoDataFrame with the areas of interest
+    by : str, optional
+        Column grouping the features into a job, by default "scenario".
+        Features without a value form an "aoi" job, and values with the same
+        id get the index of their group appended. Every feature is its own
+        job if the column is missing, named after its "name" property when
+        present.
+
+    Returns
+    -------
+    dict
+        GeoDataFrame of every job, keyed by job id
+    """
+    jobs = {}
+    if by and by in aoi_gdf.columns:
+        groups = aoi_gdf.groupby(by, dropna=False, sort=False)
+        for i, (value, group) in enumerate(groups):
+            # Features without a value are a job of their own
+            key = job_id(value) if pd.notna(value) else "aoi"
+            if key in jobs:
+                key = f"{key}-{i}"
+            jobs[key] = group.reset_index(drop=True)
+        return jobs
+    names = aoi_gdf["name"] if "name" in aoi_gdf.columns else aoi_gdf.index
+    for i, name in enumerate(names):
+        key = job_id(name)
+        if key in jobs:
+            key = f"{key}-{i}"
+        jobs[key] = aoi_gdf.iloc[[i]].reset_index(drop=True)
+    return jobs
+
+
+def cluster_jobs(
+    jobs: Dict[str, gpd.GeoDataFrame], buffer_size: int = DOWNLOAD_BUFFER
+) -> List[List[str]]:
+    """
+    Group jobs whose buffered AOIs overlap, so they share one download.
+
+    Parameters
+    ----------
+    jobs : dict
+        GeoDataFrame of every job, keyed by job id
+    buffer_size : int, optional
+        Download buffer in meters, by default 5000
+
+    Returns
+    -------
+    list of list of str
+        Job ids of every cluster
+    """
+    names = list(jobs)
+    buffers = [
+        shapely.union_all(create_buffer(jobs[name], buffer_size).geometry.to_numpy())
+        for name in names
+    ]
+    parents = list(range(len(names)))
+
+    def root(i: int) -> int:
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    left, right = shapely.STRtree(buffers).query(buffers, predicate="intersects")
+    for i, j in zip(left, right):
+        parents[root(i)] = root(j)
+
+    clusters = {}
+    for i, name in enumerate(names):
+        clusters.setdefault(root(i), []).append(name)
+    return list(clusters.values())
+
+
+def run_suitability_job(
+    name: str,
+    aoi_gdf: gpd.GeoDataFrame,
+    shared_prefix: str,
+    engine: str = "overlay",
+    terrain: Optional[TerrainCriteria] = None,
+    tile_size: Optional[float] = None,
+    tile_workers: Optional[int] = 1,
+    cog: bool = True,
+    vector_format: Optional[str] = None,
+    weights: Optional[ScoreWeights] = None,
+    storage_factory: Callable[[], Any] = default_storage,
+) -> dict:
+    """
+    Find the suitable areas of a single job, in a worker process.
+
+    Parameters
+    ----------
+    name : str
+        Job id, used as storage prefix of its outputs and status
+    aoi_gdf : GeoDataFrame
+        GeoDataFrame with the area of interest of the job
+    shared_prefix : str
+        Storage prefix of the downloads shared with other jobs
+    engine : str, optional
+        Suitability engine, by default "overlay"
+    terrain : TerrainCriteria, optional
+        Terrain criteria, by default None
+    tile_size : float, optional
+        Side in meters of the tiles large AOIs are split into, by default None
+    tile_workers : int, optional
+        Number of processes of the tiles, by default 1: the job already runs
+        in a worker process
+    cog : bool, optional
+        Convert the output rasters to COG, by default True
+    vector_format : str, optional
+        Format of the vector outputs, by default GeoParquet
+    weights : ScoreWeights, optional
+        Weights of the site score, by default the default weights
+    storage_factory : callable, optional
+        Creates the storage in the worker, by default the project data storage
+
+    Returns
+    -------
+    dict
+        Job summary with status, suitable area and number of locations
+    """
+    storage = instrument_storage(job_storage(storage_factory, name, shared_prefix))
+    # Worker processes run several jobs, every job saves its own stages
+    recorder.reset()
+    set_vector_format(vector_format)
+    summary = {"job": name, "area_km2": 0.0, "locations": 0}
+    try:
+        set_status(storage, BUILDING, "Finding suitable areas...")
+        with stage("suitable_areas") as record:
+            suitable_areas = find_suitable_areas(
+                storage,
+                aoi_gdf,
+                engine=engine,
+                terrain=terrain,
+                tile_size=tile_size,
+                max_workers=tile_workers,
+                storage_factory=partial(
+                    job_storage, storage_factory, name, shared_prefix
+                ),
+            )
+            record.features = len(suitable_areas)
+        if cog:
+            with stage("cog/outputs"):
+                optimize_rasters(storage, OUTPUT_RASTERS)
+        with stage("raster_stats/outputs"):
+            write_raster_stats(storage, OUTPUT_RASTERS)
+        with stage("site_stats") as record:
+            sites = write_site_stats(
+                storage,
+                suitable_areas,
+                block_size=(
+                    terrain.block_size if terrain is not None else DEFAULT_BLOCK_SIZE
+                ),
+            )
+            record.features = len(sites)
+        with stage("site_ranking") as record:
+            ranked = write_ranked_sites(storage, weights or ScoreWeights())
+            record.features = len(ranked)
+        if suitable_areas is not None and not suitable_areas.empty:
+            summary["area_km2"] = area_km2(suitable_areas)
+            summary["locations"] = len(suitable_areas)
+            set_status(storage, READY, "Pipeline completed successfully")
+        else:
+            set_status(storage, READY, "Pipeline completed — no suitable areas found")
+        summary["status"] = READY
+    except Exception as e:
+        logger.exception("Job %s failed", name)
+        set_status(storage, ERROR, str(e))
+        summary["status"] = ERROR
+        summary["message"] = str(e)
+    set_stages(storage, recorder.records())
+    return summary
+
+
+def run_batch(
+    storage,
+    aoi_gdf: gpd.GeoDataFrame,
+    by: Optional[str] = "scenario",
+    max_workers: Optional[int] = None,
+    download_options: Optional[dict] = None,
+    engine: str = "overlay",
+    terrain: Optional[TerrainCriteria] = None,
+    tile_size: Optional[float] = None,
+    cog: bool = True,
+    vector_format: Optional[str] = None,
+    weights: Optional[ScoreWeights] = None,
+    storage_factory: Callable[[], Any] = default_storage,
+) -> List[dict]:
+    """
+    Process every AOI feature or scenario as an independent job.
+
+    Jobs whose buffered AOIs overlap share a single download of their union,
+    stored under shared/<cluster>/. The jobs of a cluster whose downloads
+    failed are marked as failed. Suitability then runs for the other jobs on a
+    process pool, writing its outputs and pipeline status under <job>/.
+    Workers left over when there are fewer jobs than workers process the
+    tiles of the jobs, so the two pools never run more processes than
+    max_workers.
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object where the data is saved
+    aoi_gdf : GeoDataFrame
+        GeoDataFrame with the areas of interest
+    by : str, optional
+        Column grouping features into jobs, by default "scenario"
+    max_workers : int, optional
+        Number of worker processes of the jobs and their tiles, by default the
+        number of CPUs
+    download_options : dict, optional
+        Keyword arguments of download_all_data
+    engine : str, optional
+        Suitability engine, by default "overlay"
+    terrain : TerrainCriteria, optional
+        Terrain criteria, by default None
+    tile_size : float, optional
+        Side in meters of the tiles large AOIs are split into, by default None
+    cog : bool, optional
+        Convert the downloaded and output rasters to COG, by default True
+    vector_format : str, optional
+        Format of the vector layers, by default GeoParquet
+    weights : ScoreWeights, optional
+        Weights of the site score, by default the default weights
+    storage_factory : callable, optional
+        Creates the storage in the worker processes, by default the project data storage
+
+    Returns
+    -------
+    list of dict
+        Summary of every job
+    """
+    jobs = split_jobs(aoi_gdf, by)
+    clusters = cluster_jobs(jobs)
+    logger.info("Batch of %d jobs in %d download clusters", len(jobs), len(clusters))
+
+    shared = {}
+    summaries = []
+    for i, names in enumerate(clusters):
+        prefix = f"{SHARED_PREFIX}/{i}"
+        set_status(
+            storage,
+            BUILDING,
+            f"Downloading data for {', '.join(names)} ({i + 1}/{len(clusters)})...",
+        )
+        union = gpd.GeoDataFrame(
+            geometry=[
+                shapely.union_all(
+                    pd.concat([jobs[name] for name in names]).geometry.to_numpy()
+                )
+            ],
+            crs=aoi_gdf.crs,
+        )
+        shared_storage = PrefixedStorage(storage, prefix)
+        with stage(f"download/{prefix}", DOWNLOAD):
+            outcomes = download_all_data(
+                shared_storage, union, **(download_options or {})
+            )
+        try:
+            check_downloads(outcomes)
+        except DownloadError as e:
+            # The jobs would run on whatever an earlier batch left under the prefix
+            for name in names:
+                set_status(PrefixedStorage(storage, name), ERROR, str(e))
+                summaries.append(
+                    {
+                        "job": name,
+                        "area_km2": 0.0,
+                        "locations": 0,
+                        "status": ERROR,
+                        "message": str(e),
+                    }
+                )
+            continue
+        if cog:
+            with stage(f"cog/{prefix}"):
+                optimize_rasters(shared_storage, DOWNLOADED_RASTERS)
+        with stage(f"raster_stats/{prefix}"):
+            write_raster_stats(shared_storage, DOWNLOADED_RASTERS)
+        shared.update({name: prefix for name in names})
+
+    set_status(storage, BUILDING, f"Finding suitable areas for {len(shared)} jobs...")
+    workers = max_workers or os.cpu_count() or 1
+    job_workers = max(min(workers, len(shared)), 1)
+    tile_workers = max(workers // job_workers, 1)
+    with ProcessPoolExecutor(max_workers=job_workers) as executor:
+        futures = [
+            executor.submit(
+                run_suitability_job,
+                name,
+                jobs[name],
+                shared[name],
+                engine,
+                terrain,
+                tile_size,
+                tile_workers,
+                cog,
+                vector_format,
+                weights,
+                storage_factory,
+            )
+            for name in shared
+        ]
+        for future in as_completed(futures):
+            summaries.append(future.result())
+            set_status(
+                storage,
+                BUILDING,
+                f"Finished {summaries[-1]['job']} ({len(summaries)}/{len(jobs)})",
+            )
+
+    summaries.sort(key=lambda summary: summary["job"])
+    storage.create(json.dumps(summaries, ensure_ascii=False), SUMMARY_PATH)
+    failed = [summary["job"] for summary in summaries if summary["status"] == ERROR]
+    if failed:
+        set_status(storage, WARNING, f"Batch completed — failed jobs: {', '.join(failed)}")
+    else:
+        set_status(storage, READY, f"Batch completed — {len(jobs)} jobs processed")
+    return summaries
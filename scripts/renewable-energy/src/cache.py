@@ -0,0 +1,448 @@
+"""Content-addressed local cache for downloaded layers, shared across pipeline runs."""
+
+from __future__ import annotations
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional
+
+import geopandas as gpd
+import shapely
+
+from .instrumentation import count
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "renewable-energy", "downloads"
+)
+DEFAULT_TTL = 7 * 24 * 3600
+DEFAULT_MAX_SIZE_MB = 2048
+
+INDEX_NAME = "index.json"
+LOCK_NAME = ".lock"
+FRAME_NAME = "data.parquet"
+EMPTY_MARKER = ".empty"
+
+
+def geometry_hash(gdf: gpd.GeoDataFrame) -> str:
+    """
+    Hash the union of a GeoDataFrame geometries, independent of vertex order.
+
+    Parameters
+    ----------
+    gdf : GeoDataFrame
+        GeoDataFrame with the area of interest
+
+    Returns
+    -------
+    str
+        Hex digest of the normalized geometry
+    """
+    if gdf.crs is None:
+        gdf = gdf.set_crs("EPSG:4326")
+    elif gdf.crs != "EPSG:4326":
+        gdf = gdf.to_crs("EPSG:4326")
+    geometry = shapely.union_all(gdf.geometry.values)
+    geometry = shapely.normalize(shapely.set_precision(geometry, 1e-7))
+    return hashlib.sha256(shapely.to_wkb(geometry)).hexdigest()
+
+
+def cache_key(
+    source: str, query: Any, aoi: gpd.GeoDataFrame, date: Optional[str] = None
+) -> str:
+    """
+    Build the cache key of a download.
+
+    Parameters
+    ----------
+    source : str
+        Data source and loader, e.g. "stac" or "osm/load_roads"
+    query : Any
+        JSON-serializable collection or tag query
+    aoi : GeoDataFrame
+        Area of interest the data is downloaded for (already buffered)
+    date : str, optional
+        Date of the data, by default None
+
+    Returns
+    -------
+    str
+        Hex digest identifying the download
+    """
+    payload = {
+        "source": source,
+        "query": query,
+        "aoi": geometry_hash(aoi),
+        "date": date,
+    }
+    body = json.dumps(payload, sort_keys=True, default=str)
+    return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+
+class DownloadCache:
+    """
+    Local directory of downloaded layers keyed by cache_key.
+
+    Every entry is a directory holding the cached files. An index with the
+    creation time, last access time and size of every entry is kept next to
+    them and used for TTL and least-recently-used size eviction.
+
+    Processes sharing the directory, like batch jobs, update the index and
+    the entries under an exclusive lock on a lock file in the directory.
+    Entries are staged aside and renamed into place, so they are never read
+    half written.
+
+    Parameters
+    ----------
+    path : str, optional
+        Cache directory, by default ~/.cache/renewable-energy/downloads
+    ttl : float, optional
+        Seconds an entry stays valid, by default 7 days
+    max_size_mb : float, optional
+        Maximum cache size in MB, by default 2048
+    refresh : bool, optional
+        Ignore cached entries and download again, by default False
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_CACHE_DIR,
+        ttl: float = DEFAULT_TTL,
+        max_size_mb: float = DEFAULT_MAX_SIZE_MB,
+        refresh: bool = False,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = int(max_size_mb * 1024 * 1024)
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+        with self._locked():
+            self._evict(self._read_index())
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        """Hold the lock of the directory, across threads and processes"""
+        with self._lock, open(os.path.join(self.path, LOCK_NAME), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _index_path(self) -> str:
+        return os.path.join(self.path, INDEX_NAME)
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.path, key)
+
+    def _read_index(self) -> dict:
+        try:
+            with open(self._index_path()) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _write_index(self, index: dict) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self._index_path())
+
+    def _discard(self, key: str) -> None:
+        """Delete an entry, renamed first so that it is never seen half deleted"""
+        path = self._entry_path(key)
+        if os.path.isdir(path):
+            trash = tempfile.mkdtemp(dir=self.path, prefix=".trash-")
+            os.replace(path, os.path.join(trash, key))
+            shutil.rmtree(trash, ignore_errors=True)
+
+    def _remove(self, index: dict, key: str) -> None:
+        index.pop(key, None)
+        self._discard(key)
+
+    def _evict(self, index: dict) -> None:
+        now = time.time()
+        for key, entry in list(index.items()):
+            if now - entry["created"] > self.ttl or not os.path.isdir(
+                self._entry_path(key)
+            ):
+                self._remove(index, key)
+        total = sum(entry["size"] for entry in index.values())
+        for key in sorted(index, key=lambda k: index[k]["accessed"]):
+            if total <= self.max_bytes:
+                break
+            total -= index[key]["size"]
+            logger.info("Evicting cached download %s", key)
+            self._remove(index, key)
+        self._write_index(index)
+
+    def lookup(self, key: str) -> Optional[str]:
+        """
+        Return the directory of a valid entry, or None on a miss.
+
+        Parameters
+        ----------
+        key : str
+            Cache key
+
+        Returns
+        -------
+        str or None
+            Entry directory
+        """
+        if self.refresh:
+            return None
+        with self._locked():
+            index = self._read_index()
+            entry = index.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry["created"] > self.ttl or not os.path.isdir(
+                self._entry_path(key)
+            ):
+                self._remove(index, key)
+                self._write_index(index)
+                return None
+            entry["accessed"] = time.time()
+            self._write_index(index)
+        return self._entry_path(key)
+
+    @contextmanager
+    def entry(self, key: str) -> Iterator[str]:
+        """
+        Yield a staging directory that replaces the entry once the block succeeds.
+
+        Parameters
+        ----------
+        key : str
+            Cache key
+
+        Yields
+        ------
+        str
+            Staging directory to write the entry files to
+        """
+        staging = tempfile.mkdtemp(dir=self.path, prefix=".staging-")
+        try:
+            yield staging
+            size = sum(
+                os.path.getsize(os.path.join(staging, name))
+                for name in os.listdir(staging)
+            )
+            with self._locked():
+                index = self._read_index()
+                self._discard(key)
+                os.replace(staging, self._entry_path(key))
+                now = time.time()
+                index[key] = {"created": now, "accessed": now, "size": size}
+                self._evict(index)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+
+def _read_frame(path: str) -> gpd.GeoDataFrame:
+    if os.path.exists(os.path.join(path, EMPTY_MARKER)):
+        return gpd.GeoDataFrame()
+    return gpd.read_parquet(os.path.join(path, FRAME_NAME))
+
+
+def _read_storage_bytes(storage, name: str) -> bytes:
+    path = storage.get_path(name)
+    if os.path.isfile(path):
+        with open(path, "rb") as f:
+            return f.read()
+    return storage.read_object(name).getvalue()
+
+
+def cached_frame(
+    cache: Optional[DownloadCache],
+    key: str,
+    loader: Callable[..., gpd.GeoDataFrame],
+    /,
+    *args,
+    **kwargs,
+) -> gpd.GeoDataFrame:
+    """
+    Load a GeoDataFrame through the cache.
+
+    Parameters
+    ----------
+    cache : DownloadCache or None
+        Cache to use. If None, the loader is always called.
+    key : str
+        Cache key of the download
+    loader : callable
+        Function returning the GeoDataFrame on a miss
+    *args, **kwargs
+        Arguments passed to the loader
+
+    Returns
+    -------
+    GeoDataFrame
+        The cached or freshly loaded data
+    """
+    if cache is None:
+        return loader(*args, **kwargs)
+    path = cache.lookup(key)
+    if path is not None:
+        try:
+            gdf = _read_frame(path)
+        except FileNotFoundError:
+            # Evicted by another process since the lookup
+            pass
+        else:
+            logger.info("Using cached %s", getattr(loader, "__name__", "download"))
+            count(cache_hits=1)
+            return gdf
+
+    gdf = loader(*args, **kwargs)
+    try:
+        with cache.entry(key) as staging:
+            if gdf.empty:
+                open(os.path.join(staging, EMPTY_MARKER), "w").close()
+            else:
+                gdf.to_parquet(os.path.join(staging, FRAME_NAME))
+    except Exception as exc:
+        logger.warning("Failed to cache %s: %s", key, exc)
+    return gdf
+
+
+def cached_storage_file(
+    cache: Optional[DownloadCache],
+    key: str,
+    storage,
+    name: str,
+    downloader: Callable[..., Any],
+    /,
+    *args,
+    **kwargs,
+) -> Any:
+    """
+    Run a downloader that writes a single storage object through the cache.
+
+    On a hit the cached file is copied into storage and the downloader is not called.
+
+    Parameters
+    ----------
+    cache : DownloadCache or None
+        Cache to use. If None, the downloader is always called.
+    key : str
+        Cache key of the download
+    storage : Storage
+        Storage object the downloader writes to
+    name : str
+        Name of the object written by the downloader
+    downloader : callable
+        Function downloading the object into storage on a miss
+    *args, **kwargs
+        Arguments passed to the downloader
+
+    Returns
+    -------
+    Any
+        The downloader result, or the storage path of the restored object.
+        None if there was no data to download.
+    """
+    if cache is None:
+        return downloader(*args, **kwargs)
+    path = cache.lookup(key)
+    if path is not None and os.path.exists(os.path.join(path, EMPTY_MARKER)):
+        logger.info("Using cached %s", name)
+        count(cache_hits=1)
+        return None
+    if path is not None:
+        suffix = os.path.splitext(name)[1]
+        fd, tmp_path = tempfile.mkstemp(suffix=suffix)
+        os.close(fd)
+        try:
+            shutil.copyfile(os.path.join(path, name), tmp_path)
+            logger.info("Using cached %s", name)
+            count(cache_hits=1)
+            return storage.create(tmp_path, name)
+        except FileNotFoundError:
+            # Evicted by another process since the lookup
+            if os.path.exists(os.path.join(path, name)):
+                raise
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    result = downloader(*args, **kwargs)
+    try:
+        with cache.entry(key) as staging:
+            if result is None or not storage.exists(name):
+                open(os.path.join(staging, EMPTY_MARKER), "w").close()
+            else:
+                with open(os.path.join(staging, name), "wb") as f:
+                    f.write(_read_storage_bytes(storage, name))
+    except Exception as exc:
+        logger.warning("Failed to cache %s: %s", name, exc)
+    return result
+
+
+def cached_frames(
+    cache: Optional[DownloadCache],
+    keys: Dict[str, str],
+    loader: Callable[..., Dict[str, gpd.GeoDataFrame]],
+    /,
+    *args,
+    **kwargs,
+) -> Dict[str, gpd.GeoDataFrame]:
+    """
+    Load several GeoDataFrames produced by a single call through the cache.
+
+    The loader is only called if any of the frames is missing from the cache.
+
+    Parameters
+    ----------
+    cache : DownloadCache or None
+        Cache to use. If None, the loader is always called.
+    keys : dict
+        Cache key of every frame, keyed by frame name
+    loader : callable
+        Function returning the GeoDataFrames, keyed by frame name, on a miss
+    *args, **kwargs
+        Arguments passed to the loader
+
+    Returns
+    -------
+    dict
+        The cached or freshly loaded data, keyed by frame name
+    """
+    if cache is not None:
+        paths = {name: cache.lookup(key) for name, key in keys.items()}
+        if all(path is not None for path in paths.values()):
+            try:
+                frames = {name: _read_frame(path) for name, path in paths.items()}
+            except FileNotFoundError:
+                # Evicted by another process since the lookup
+                pass
+            else:
+                logger.info("Using cached %s", ", ".join(keys))
+                count(cache_hits=1)
+                return frames
+
+    frames = loader(*args, **kwargs)
+    if cache is None:
+        return frames
+    for name, key in keys.items():
+        gdf = frames.get(name, gpd.GeoDataFrame())
+        try:
+            with cache.entry(key) as staging:
+                if gdf.empty:
+                    open(os.path.join(staging, EMPTY_MARKER), "w").close()
+                else:
+                    gdf.to_parquet(os.path.join(staging, FRAME_NAME))
+        except Exception as exc:
+            logger.warning("Failed to cache %s: %s", name, exc)
+    return frames
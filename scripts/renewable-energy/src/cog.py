@@ -0,0 +1,105 @@
+"""Conversion of the rasters to Cloud-Optimized GeoTIFFs with internal overviews."""
+
+import logging
+import os
+import tempfile
+from typing import Dict, List
+
+import rasterio.shutil
+
+logger = logging.getLogger(__name__)
+
+# Overview resampling of every raster, continuous values are averaged and
+# classes keep the most frequent one
+DOWNLOADED_RASTERS = {"dem.tif": "average", "land_cover.tif": "mode"}
+OUTPUT_RASTERS = {
+    "slope.tif": "average",
+    "aspect.tif": "nearest",
+    "terrain_exclusion.tif": "nearest",
+    "suitable_areas.tif": "nearest",
+}
+COG_BLOCK_SIZE = 512
+
+
+def is_cog(ds) -> bool:
+    """Whether a dataset already has the COG layout"""
+    return ds.tags(ns="IMAGE_STRUCTURE").get("LAYOUT") == "COG"
+
+
+def convert_to_cog(
+    storage, name: str, resampling: str = "nearest", block_size: int = COG_BLOCK_SIZE
+) -> bool:
+    """
+    Rewrite a raster as a tiled Cloud-Optimized GeoTIFF with internal overviews.
+
+    GDAL copies the raster block by block, so it is never loaded in memory.
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object where the data is saved
+    name : str
+        Name of the raster
+    resampling : str, optional
+        Overview resampling method, by default "nearest"
+    block_size : int, optional
+        Tile size in pixels, by default 512
+
+    Returns
+    -------
+    bool
+        True if the raster was converted, False if it already was a COG
+    """
+    ds = storage.read(name)
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, os.path.basename(name))
+    try:
+        if is_cog(ds):
+            return False
+        rasterio.shutil.copy(
+            ds,
+            path,
+            driver="COG",
+            compress="deflate",
+            blocksize=block_size,
+            overview_resampling=resampling,
+            bigtiff="IF_SAFER",
+        )
+        ds.close()
+        storage.create(path, name)
+        return True
+    finally:
+        ds.close()
+        if os.path.exists(path):
+            os.remove(path)
+        os.rmdir(tmp_dir)
+
+
+def optimize_rasters(storage, rasters: Dict[str, str]) -> List[str]:
+    """
+    Convert the existing rasters of a set to Cloud-Optimized GeoTIFFs.
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object where the data is saved
+    rasters : dict
+        Overview resampling method of every raster, keyed by name
+
+    Returns
+    -------
+    list of str
+        Names of the converted rasters
+    """
+    converted = []
+    for name, resampling in rasters.items():
+        if not storage.exists(name):
+            continue
+        try:
+            if convert_to_cog(storage, name, resampling):
+                converted.append(name)
+        except Exception:
+            logger.exception("Could not convert %s to COG", name)
+    if converted:
+        logger.info("Converted to COG: %s", ", ".join(converted))
+    return converted
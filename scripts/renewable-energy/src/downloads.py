@@ -1,21 +1,409 @@
 import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
 import geopandas as gpd
 from spai.data.satellite import download_satellite_imagery
-from spai.data.hidrology import download_waterways
+from spai.data.hidrology import load_waterways
 from spai.data.utilities import (
-    download_roads,
-    download_buildings,
+    load_roads,
+    load_buildings,
     load_power_networks,
     load_pipelines,
 )
-from spai.data.ecosystems import download_protected_areas
+from spai.data.ecosystems import load_protected_areas
+from .cache import (
+    DownloadCache,
+    cache_key,
+    cached_frame,
+    cached_frames,
+    cached_storage_file,
+)
+from .instrumentation import DOWNLOAD, recorder, stage
+from .osm import LINES, POINTS, POLYGONS, OsmLayer, load_osm_layers
 from .utilities import create_buffer
-from typing import Any, Optional
+from .vector_io import sanitize_tags, write_layer
+from .status_registry import BUILDING, set_status
+from typing import Any, Callable, Collection, Dict, List, Optional
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_RETRIES = 2
+DEFAULT_RETRY_BACKOFF = 5.0
+# Per-attempt timeouts in seconds, keyed by task source (or task name)
+DEFAULT_TIMEOUTS = {"stac": 900.0, "osm": 600.0}
+
+_POLL_INTERVAL = 1.0
+# Distance in meters around the AOI the vector layers are downloaded in
+DOWNLOAD_BUFFER = 5000
+# Layer the pipeline lines are saved to, read by the suitability engines
+PIPELINES_LAYER = "pipelines_lines"
+
+ROADS_QUERY = {"highway": ["motorway", "trunk", "primary", "secondary", "tertiary"]}
+BUILDINGS_QUERY = {"building": True}
+WATERWAYS_QUERY = {"waterway": ["river", "canal", "stream", "brook", "ditch", "drain"]}
+PROTECTED_AREAS_QUERY = {"boundary": "protected_area", "leisure": "nature_reserve"}
+POWER_NETWORKS_QUERY = {"power": ["line", "cable", "substation", "plant", "transformer"]}
+PIPELINES_QUERY = {
+    "man_made": ["pipeline"],
+    "pipeline": ["oil", "gas", "water", "sewage", "heat"],
+}
+
+# Layers fetched by the merged OSM query, named after their output files
+OSM_LAYERS = [
+    OsmLayer("waterways", WATERWAYS_QUERY, LINES),
+    OsmLayer("protected_areas", PROTECTED_AREAS_QUERY, POLYGONS),
+    OsmLayer("roads", ROADS_QUERY, LINES),
+    OsmLayer("buildings", BUILDINGS_QUERY, POLYGONS),
+    OsmLayer("power_lines", POWER_NETWORKS_QUERY, LINES),
+    OsmLayer("power_points", POWER_NETWORKS_QUERY, POINTS),
+    OsmLayer("power_polygons", POWER_NETWORKS_QUERY, POLYGONS),
+    OsmLayer(PIPELINES_LAYER, PIPELINES_QUERY, LINES),
+]
+
+DEM_COLLECTION = "cop-dem-glo-30"
+LAND_COVER_COLLECTION = "esa-worldcover"
+LAND_COVER_DATE = "2021"
+
+TERRAIN = "terrain"
+GEOPHYSICAL = "geophysical"
+INFRASTRUCTURE = "infrastructure"
+# Groups of downloads that can be refreshed on their own, with the names of
+# their tasks (the merged OSM task belongs to both OSM groups), the files and
+# layers they write and the queries they send
+DOWNLOAD_GROUPS = {
+    TERRAIN: ("dem", "land_cover"),
+    GEOPHYSICAL: ("waterways", "protected_areas", "osm"),
+    INFRASTRUCTURE: ("roads", "buildings", "power_networks", "pipelines", "osm"),
+}
+DOWNLOAD_OUTPUTS = {
+    TERRAIN: ["dem.tif", "land_cover.tif"],
+    GEOPHYSICAL: ["waterways", "protected_areas"],
+    INFRASTRUCTURE: [
+        "roads",
+        "buildings",
+        "power_lines",
+        "power_points",
+        "power_polygons",
+        PIPELINES_LAYER,
+    ],
+}
+DOWNLOAD_QUERIES = {
+    TERRAIN: {
+        "dem": DEM_COLLECTION,
+        "land_cover": [LAND_COVER_COLLECTION, LAND_COVER_DATE],
+    },
+    GEOPHYSICAL: {
+        "waterways": WATERWAYS_QUERY,
+        "protected_areas": PROTECTED_AREAS_QUERY,
+    },
+    INFRASTRUCTURE: {
+        "roads": ROADS_QUERY,
+        "buildings": BUILDINGS_QUERY,
+        "power_networks": POWER_NETWORKS_QUERY,
+        "pipelines": PIPELINES_QUERY,
+    },
+}
+
+
+class NoDataError(ValueError):
+    """A required layer has no data in the area of interest, retrying does not help"""
+
+
+class DownloadError(RuntimeError):
+    """Download tasks failed after all their attempts"""
+
+
+@dataclass
+class DownloadTask:
+    """An independent fetch executed by the download scheduler."""
+
+    name: str
+    source: str
+    func: Callable[..., Any]
+    args: tuple = ()
+    kwargs: dict = field(default_factory=dict)
+    timeout: Optional[float] = None
+    retries: int = DEFAULT_RETRIES
+
+
+@dataclass
+class DownloadOutcome:
+    """Final result of a scheduled download task."""
+
+    name: str
+    result: Any = None
+    error: Optional[BaseException] = None
+    attempts: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+@dataclass
+class _Attempt:
+    task: DownloadTask
+    number: int
+    started_at: Optional[float] = None
+
+    def expired(self, now: float) -> bool:
+        if self.task.timeout is None or self.started_at is None:
+            return False
+        return now - self.started_at > self.task.timeout
+
+    def remaining(self, now: float) -> Optional[float]:
+        if self.task.timeout is None or self.started_at is None:
+            return None
+        return max(0.0, self.task.timeout - (now - self.started_at))
+
+
+def _run_attempt(attempt: _Attempt, stages: list) -> Any:
+    attempt.started_at = time.monotonic()
+    task = attempt.task
+    with recorder.within(stages), stage(f"download/{task.name}", DOWNLOAD):
+        return task.func(*task.args, **task.kwargs)
+
+
+def run_downloads(
+    storage,
+    tasks: List[DownloadTask],
+    max_workers: int = DEFAULT_MAX_WORKERS,
+    retry_backoff: float = DEFAULT_RETRY_BACKOFF,
+) -> Dict[str, DownloadOutcome]:
+    """
+    Run independent download tasks concurrently on a bounded thread pool.
+
+    Each attempt of a task has its own timeout, counted from the moment a
+    worker picks it up. Failed or timed out attempts are retried with a linear
+    backoff until the task runs out of retries, unless they found no data
+    (NoDataError). Backoffs are waited by the scheduler, not by the workers.
+    Python threads cannot be interrupted, so a timed out attempt is abandoned
+    rather than killed, and its task is only retried once the abandoned call
+    returns: two attempts of a task never write its outputs at the same time. An abandoned attempt that succeeds
+    while waiting for its retry completes the task. The last attempt of a
+    task is not waited for: the task fails at its timeout.
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object used to report progress in the status registry
+    tasks : list of DownloadTask
+        Tasks to run. Names must be unique.
+    max_workers : int, optional
+        Size of the thread pool, by default 4
+    retry_backoff : float, optional
+        Seconds to wait before the n-th retry, multiplied by n, by default 5
+
+    Returns
+    -------
+    dict
+        DownloadOutcome of every task, keyed by task name
+    """
+    outcomes = {task.name: DownloadOutcome(task.name) for task in tasks}
+    if not tasks:
+        return outcomes
+
+    total = len(tasks)
+    submitted_at = {}
+    # Running attempts, attempts abandoned at their timeout that still run,
+    # and retries waiting for their backoff, as (ready at, task, number)
+    pending = {}
+    abandoned = {}
+    scheduled = []
+    done_tasks = set()
+    executor = ThreadPoolExecutor(
+        max_workers=max(1, int(max_workers)), thread_name_prefix="download"
+    )
+    # The workers record their downloads inside the stages open here
+    stages = recorder.current()
+
+    def submit(task: DownloadTask, number: int) -> None:
+        attempt = _Attempt(task, number)
+        pending[executor.submit(_run_attempt, attempt, stages)] = attempt
+        outcomes[task.name].attempts = number
+
+    def finish(task: DownloadTask, result: Any = None, error=None) -> None:
+        done_tasks.add(task.name)
+        outcome = outcomes[task.name]
+        outcome.result = result
+        outcome.error = error
+        outcome.elapsed = time.monotonic() - submitted_at[task.name]
+        if error is None:
+            logger.info("Downloaded %s in %.1fs", task.name, outcome.elapsed)
+            message = f"Downloaded {task.name} ({len(done_tasks)}/{total})"
+        else:
+            logger.warning("Download of %s failed: %s", task.name, error)
+            message = f"Download of {task.name} failed ({len(done_tasks)}/{total})"
+        set_status(storage, BUILDING, message)
+
+    def can_retry(attempt: _Attempt, error: BaseException) -> bool:
+        task = attempt.task
+        # Missing data is not transient, another attempt would find none either
+        if attempt.number > task.retries or isinstance(error, NoDataError):
+            finish(task, error=error)
+            return False
+        logger.warning(
+            "Download of %s failed (attempt %d/%d): %s",
+            task.name,
+            attempt.number,
+            task.retries + 1,
+            error,
+        )
+        return True
+
+    def retry(attempt: _Attempt) -> None:
+        ready_at = time.monotonic() + retry_backoff * attempt.number
+        scheduled.append((ready_at, attempt.task, attempt.number + 1))
+
+    set_status(storage, BUILDING, f"Downloading {total} layers...")
+    try:
+        for task in tasks:
+            submitted_at[task.name] = time.monotonic()
+            submit(task, 1)
+
+        while pending or scheduled or any(
+            attempt.task.name not in done_tasks for attempt in abandoned.values()
+        ):
+            now = time.monotonic()
+            wait_for = _POLL_INTERVAL
+            for item in sorted(scheduled, key=lambda item: item[0]):
+                ready_at, task, number = item
+                if ready_at <= now:
+                    scheduled.remove(item)
+                    submit(task, number)
+                else:
+                    wait_for = min(wait_for, ready_at - now)
+            for future, attempt in list(pending.items()):
+                if attempt.expired(now):
+                    del pending[future]
+                    error = TimeoutError(
+                        f"{attempt.task.name} timed out after {attempt.task.timeout:g}s"
+                    )
+                    if can_retry(attempt, error):
+                        # Retried when the abandoned call returns
+                        abandoned[future] = attempt
+                    continue
+                remaining = attempt.remaining(now)
+                if remaining is not None:
+                    wait_for = min(wait_for, remaining)
+
+            running = list(pending) + list(abandoned)
+            if not running:
+                time.sleep(wait_for)
+                continue
+            done, _ = wait(running, timeout=wait_for, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in abandoned:
+                    attempt = abandoned.pop(future)
+                    if attempt.task.name in done_tasks:
+                        continue
+                    if future.exception() is None:
+                        logger.info(
+                            "Abandoned download of %s completed", attempt.task.name
+                        )
+                        finish(attempt.task, result=future.result())
+                    else:
+                        retry(attempt)
+                    continue
+                attempt = pending.pop(future)
+                error = future.exception()
+                if error is None:
+                    finish(attempt.task, result=future.result())
+                elif can_retry(attempt, error):
+                    retry(attempt)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return outcomes
 
-def download_terrain_data(storage, gdf: gpd.GeoDataFrame) -> tuple:
+
+def download_raster(
+    storage,
+    aoi: gpd.GeoDataFrame,
+    name: str,
+    collection: str,
+    date: Optional[str] = None,
+    cache: Optional[DownloadCache] = None,
+) -> Any:
+    """
+    Download a STAC collection for the given area of interest, through the download cache.
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object to save the downloaded data
+    aoi : GeoDataFrame
+        GeoDataFrame with the area of interest
+    name : str
+        The name of the file to store the raster
+    collection : str
+        The STAC collection to download
+    date : str, optional
+        The date of the data, by default the latest available
+    cache : DownloadCache, optional
+        Cache of previous downloads, by default None
+
+    Returns
+    -------
+    Any
+        The downloaded file, or None if there was no data
+    """
+    kwargs = {"collection": collection, "name": name}
+    if date is not None:
+        kwargs["date"] = date
+    key = cache_key("stac", {"collection": collection}, aoi, date)
+    return cached_storage_file(
+        cache, key, storage, name, download_satellite_imagery, storage, aoi, **kwargs
+    )
+
+
+def download_osm_layer(
+    storage,
+    aoi: gpd.GeoDataFrame,
+    loader: Callable[..., gpd.GeoDataFrame],
+    name: str,
+    query: dict,
+    crs: Optional[str] = "EPSG:4326",
+    cache: Optional[DownloadCache] = None,
+    required: Optional[bool] = False,
+) -> None:
+    """
+    Download an OpenStreetMap layer for the given area of interest, through the download cache.
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object to save the downloaded data
+    aoi : GeoDataFrame
+        GeoDataFrame with the area of interest
+    loader : callable
+        spai loader of the layer, e.g. load_roads
+    name : str
+        The name of the layer, stored in the configured vector format
+    query : dict
+        The OSM tags to query
+    crs : str, optional
+        The coordinate reference system to use, by default WGS84 (EPSG:4326)
+    cache : DownloadCache, optional
+        Cache of previous downloads, by default None
+    required : bool, optional
+        Raise a NoDataError if the layer is empty, by default False
+    """
+    key = cache_key(f"osm/{loader.__name__}", query, aoi)
+    gdf = cached_frame(cache, key, loader, aoi, query=query, crs=crs)
+    if gdf.empty:
+        if required:
+            raise NoDataError(f"No data found for {name}")
+        return
+    write_layer(storage, sanitize_tags(gdf), name)
+
+
+def download_terrain_data(
+    storage, gdf: gpd.GeoDataFrame, cache: Optional[DownloadCache] = None
+) -> tuple:
     """
     Downloads terrain data (DEM and land cover)
 
@@ -25,6 +413,8 @@ def download_terrain_data(storage, gdf: gpd.GeoDataFrame) -> tuple:
         Storage object to save the downloaded data
     gdf : GeoDataFrame
         GeoDataFrame with the area of interest
+    cache : DownloadCache, optional
+        Cache of previous downloads, by default None
 
     Returns
     -------
@@ -32,17 +422,22 @@ def download_terrain_data(storage, gdf: gpd.GeoDataFrame) -> tuple:
         (dem, land_cover) downloaded files
     """
     logger.info("Downloading terrain data...")
-    dem = download_satellite_imagery(
-        storage, gdf, collection="cop-dem-glo-30", name="dem.tif"
-    )
-    lc = download_satellite_imagery(
-        storage, gdf, date="2021", collection="esa-worldcover", name="land_cover.tif"
+    dem = download_raster(storage, gdf, "dem.tif", DEM_COLLECTION, cache=cache)
+    lc = download_raster(
+        storage,
+        gdf,
+        "land_cover.tif",
+        LAND_COVER_COLLECTION,
+        date=LAND_COVER_DATE,
+        cache=cache,
     )
     logger.info("Terrain data downloaded successfully")
     return dem, lc
 
 
-def download_geophysical_data(storage, gdf: gpd.GeoDataFrame) -> None:
+def download_geophysical_data(
+    storage, gdf: gpd.GeoDataFrame, cache: Optional[DownloadCache] = None
+) -> None:
     """
     Downloads geophysical data (waterways and protected areas)
 
@@ -52,25 +447,40 @@ def download_geophysical_data(storage, gdf: gpd.GeoDataFrame) -> None:
         Storage object to save the downloaded data
     gdf : GeoDataFrame
         GeoDataFrame with the area of interest
+    cache : DownloadCache, optional
+        Cache of previous downloads, by default None
     """
     logger.info("Downloading geophysical data...")
-    gdf_buffer = create_buffer(gdf, 5000)
-    download_waterways(storage, gdf_buffer)
-    download_protected_areas(storage, gdf_buffer)
+    gdf_buffer = create_buffer(gdf, DOWNLOAD_BUFFER)
+    download_osm_layer(
+        storage,
+        gdf_buffer,
+        load_waterways,
+        "waterways",
+        WATERWAYS_QUERY,
+        cache=cache,
+    )
+    download_osm_layer(
+        storage,
+        gdf_buffer,
+        load_protected_areas,
+        "protected_areas",
+        PROTECTED_AREAS_QUERY,
+        cache=cache,
+    )
     logger.info("Geophysical data downloaded successfully")
 
 
 def download_power_networks(
     storage,
     aoi: Any,
-    line_name: Optional[str] = "power_lines.geojson",
-    point_name: Optional[str] = "power_points.geojson",
-    polygon_name: Optional[str] = "power_polygons.geojson",
+    line_name: Optional[str] = "power_lines",
+    point_name: Optional[str] = "power_points",
+    polygon_name: Optional[str] = "power_polygons",
     source: Optional[str] = "osm",
-    query: Optional[dict] = {
-        "power": ["line", "cable", "substation", "plant", "transformer"]
-    },
+    query: Optional[dict] = POWER_NETWORKS_QUERY,
     crs: Optional[str] = "EPSG:4326",
+    cache: Optional[DownloadCache] = None,
 ) -> None:
     """
     Download power network elements from OpenStreetMap for the given area of interest and separate them by geometry type.
@@ -82,19 +492,29 @@ def download_power_networks(
     storage : BaseStorage
         The storage object
     line_name : str, optional
-        The name of the file to store line geometries, by default "power_lines.geojson"
+        The name of the layer of line geometries, by default "power_lines"
     point_name : str, optional
-        The name of the file to store point geometries, by default "power_points.geojson"
+        The name of the layer of point geometries, by default "power_points"
     polygon_name : str, optional
-        The name of the file to store polygon geometries, by default "power_polygons.geojson"
+        The name of the layer of polygon geometries, by default "power_polygons"
     source : str, optional
         The data source, by default "osm"
     query : dict, optional
         The query to use, by default includes power lines, cables, substations, plants, and transformers.
     crs : str, optional
         The coordinate reference system to use, by default WGS84 (EPSG:4326)
+    cache : DownloadCache, optional
+        Cache of previous downloads, by default None
     """
-    final_power_networks_gdf = load_power_networks(aoi, source, query, crs)
+    final_power_networks_gdf = cached_frame(
+        cache,
+        cache_key(f"{source}/load_power_networks", query, aoi),
+        load_power_networks,
+        aoi,
+        source,
+        query,
+        crs,
+    )
 
     logger.info("Downloading power networks data...")
     lines_gdf = final_power_networks_gdf[
@@ -107,31 +527,23 @@ def download_power_networks(
         final_power_networks_gdf.geometry.type.isin(("Polygon", "MultiPolygon"))
     ]
 
-    lines_gdf = lines_gdf.map(lambda x: x if not isinstance(x, list) else str(x))
-    points_gdf = points_gdf.map(lambda x: x if not isinstance(x, list) else str(x))
-    polygons_gdf = polygons_gdf.map(
-        lambda x: x if not isinstance(x, list) else str(x)
-    )
-
     if not lines_gdf.empty:
-        storage.create(lines_gdf, name=line_name)
+        write_layer(storage, sanitize_tags(lines_gdf), line_name)
     if not points_gdf.empty:
-        storage.create(points_gdf, name=point_name)
+        write_layer(storage, sanitize_tags(points_gdf), point_name)
     if not polygons_gdf.empty:
-        storage.create(polygons_gdf, name=polygon_name)
+        write_layer(storage, sanitize_tags(polygons_gdf), polygon_name)
     logger.info("Power networks data downloaded successfully")
 
 
 def download_pipelines(
     storage,
     aoi: Any,
-    name: Optional[str] = "pipelines_lines.geojson",
+    name: Optional[str] = PIPELINES_LAYER,
     source: Optional[str] = "osm",
-    query: Optional[dict] = {
-        "man_made": ["pipeline"],
-        "pipeline": ["oil", "gas", "water", "sewage", "heat"],
-    },
+    query: Optional[dict] = PIPELINES_QUERY,
     crs: Optional[str] = "EPSG:4326",
+    cache: Optional[DownloadCache] = None,
 ) -> None:
     """
     Download pipeline elements from OpenStreetMap for the given area of interest.
@@ -143,23 +555,76 @@ def download_pipelines(
     storage : BaseStorage
         The storage object
     name : str, optional
-        The name of the file to store line geometries, by default "pipelines_lines.geojson"
+        The name of the layer of line geometries, by default "pipelines_lines"
     source : str, optional
         The data source, by default "osm"
     query : dict, optional
         The query to use, by default includes pipelines for oil, gas, water, sewage, and heat.
     crs : str, optional
         The coordinate reference system to use, by default WGS84 (EPSG:4326)
+    cache : DownloadCache, optional
+        Cache of previous downloads, by default None
     """
     logger.info("Downloading pipelines data...")
-    lines_gdf = load_pipelines(aoi, source, query, crs)
-    lines_gdf = lines_gdf.map(lambda x: x if not isinstance(x, list) else str(x))
+    lines_gdf = cached_frame(
+        cache,
+        cache_key(f"{source}/load_pipelines", query, aoi),
+        load_pipelines,
+        aoi,
+        source,
+        query,
+        crs,
+    )
     if not lines_gdf.empty:
-        storage.create(lines_gdf, name=name)
+        write_layer(storage, sanitize_tags(lines_gdf), name)
     logger.info("Pipelines data downloaded successfully")
 
 
-def download_infrastructure_data(storage, gdf: gpd.GeoDataFrame) -> None:
+def download_osm_layers(
+    storage,
+    aoi: gpd.GeoDataFrame,
+    layers: Optional[List[OsmLayer]] = None,
+    crs: Optional[str] = "EPSG:4326",
+    cache: Optional[DownloadCache] = None,
+) -> None:
+    """
+    Download several OpenStreetMap layers with a single merged query and store every non-empty layer.
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object to save the downloaded data
+    aoi : GeoDataFrame
+        GeoDataFrame with the area of interest
+    layers : list of OsmLayer, optional
+        Layers to download, by default OSM_LAYERS
+    crs : str, optional
+        The coordinate reference system to use, by default WGS84 (EPSG:4326)
+    cache : DownloadCache, optional
+        Cache of previous downloads, by default None
+    """
+    logger.info("Downloading OSM layers...")
+    layers = layers or OSM_LAYERS
+    keys = {
+        layer.name: cache_key(
+            f"osm/merged/{layer.name}",
+            {"tags": layer.query, "geometry_types": layer.geometry_types},
+            aoi,
+        )
+        for layer in layers
+    }
+    frames = cached_frames(cache, keys, load_osm_layers, aoi, layers, crs)
+    for name, gdf in frames.items():
+        if gdf.empty:
+            logger.warning("No OSM features found for %s", name)
+            continue
+        write_layer(storage, sanitize_tags(gdf), name)
+    logger.info("OSM layers downloaded successfully")
+
+
+def download_infrastructure_data(
+    storage, gdf: gpd.GeoDataFrame, cache: Optional[DownloadCache] = None
+) -> None:
     """
     Downloads infrastructure data (roads, buildings, power networks, pipelines)
 
@@ -169,9 +634,301 @@ def download_infrastructure_data(storage, gdf: gpd.GeoDataFrame) -> None:
         Storage object to save the downloaded data
     gdf : GeoDataFrame
         GeoDataFrame with the area of interest
+    cache : DownloadCache, optional
+        Cache of previous downloads, by default None
+    """
+    gdf_buffer = create_buffer(gdf, DOWNLOAD_BUFFER)
+    download_osm_layer(
+        storage,
+        gdf_buffer,
+        load_roads,
+        "roads",
+        ROADS_QUERY,
+        cache=cache,
+        required=True,
+    )
+    download_osm_layer(
+        storage,
+        gdf_buffer,
+        load_buildings,
+        "buildings",
+        BUILDINGS_QUERY,
+        cache=cache,
+    )
+    download_power_networks(storage, gdf_buffer, cache=cache)
+    download_pipelines(storage, gdf_buffer, cache=cache)
+
+
+def terrain_download_tasks(
+    storage, gdf: gpd.GeoDataFrame, cache: Optional[DownloadCache] = None
+) -> List[DownloadTask]:
+    """
+    Builds the download tasks for terrain data (DEM and land cover)
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object to save the downloaded data
+    gdf : GeoDataFrame
+        GeoDataFrame with the area of interest
+    cache : DownloadCache, optional
+        Cache of previous downloads, by default None
+
+    Returns
+    -------
+    list of DownloadTask
+        Tasks to run with the download scheduler
+    """
+    return [
+        DownloadTask(
+            "dem",
+            "stac",
+            download_raster,
+            (storage, gdf, "dem.tif", DEM_COLLECTION),
+            {"cache": cache},
+        ),
+        DownloadTask(
+            "land_cover",
+            "stac",
+            download_raster,
+            (storage, gdf, "land_cover.tif", LAND_COVER_COLLECTION),
+            {"date": LAND_COVER_DATE, "cache": cache},
+        ),
+    ]
+
+
+def geophysical_download_tasks(
+    storage, gdf_buffer: gpd.GeoDataFrame, cache: Optional[DownloadCache] = None
+) -> List[DownloadTask]:
+    """
+    Builds the download tasks for geophysical data (waterways and protected areas)
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object to save the downloaded data
+    gdf_buffer : GeoDataFrame
+        GeoDataFrame with the buffered area of interest
+    cache : DownloadCache, optional
+        Cache of previous downloads, by default None
+
+    Returns
+    -------
+    list of DownloadTask
+        Tasks to run with the download scheduler
+    """
+    return [
+        DownloadTask(
+            "waterways",
+            "osm",
+            download_osm_layer,
+            (storage, gdf_buffer, load_waterways, "waterways", WATERWAYS_QUERY),
+            {"cache": cache},
+        ),
+        DownloadTask(
+            "protected_areas",
+            "osm",
+            download_osm_layer,
+            (
+                storage,
+                gdf_buffer,
+                load_protected_areas,
+                "protected_areas",
+                PROTECTED_AREAS_QUERY,
+            ),
+            {"cache": cache},
+        ),
+    ]
+
+
+def infrastructure_download_tasks(
+    storage, gdf_buffer: gpd.GeoDataFrame, cache: Optional[DownloadCache] = None
+) -> List[DownloadTask]:
+    """
+    Builds the download tasks for infrastructure data (roads, buildings, power networks, pipelines)
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object to save the downloaded data
+    gdf_buffer : GeoDataFrame
+        GeoDataFrame with the buffered area of interest
+    cache : DownloadCache, optional
+        Cache of previous downloads, by default None
+
+    Returns
+    -------
+    list of DownloadTask
+        Tasks to run with the download scheduler
+    """
+    return [
+        DownloadTask(
+            "roads",
+            "osm",
+            download_osm_layer,
+            (storage, gdf_buffer, load_roads, "roads", ROADS_QUERY),
+            {"cache": cache, "required": True},
+        ),
+        DownloadTask(
+            "buildings",
+            "osm",
+            download_osm_layer,
+            (storage, gdf_buffer, load_buildings, "buildings", BUILDINGS_QUERY),
+            {"cache": cache},
+        ),
+        DownloadTask(
+            "power_networks",
+            "osm",
+            download_power_networks,
+            (storage, gdf_buffer),
+            {"cache": cache},
+        ),
+        DownloadTask(
+            "pipelines",
+            "osm",
+            download_pipelines,
+            (storage, gdf_buffer),
+            {"cache": cache},
+        ),
+    ]
+
+
+def osm_download_tasks(
+    storage, gdf_buffer: gpd.GeoDataFrame, cache: Optional[DownloadCache] = None
+) -> List[DownloadTask]:
+    """
+    Builds the download task of all OSM layers with a single merged query
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object to save the downloaded data
+    gdf_buffer : GeoDataFrame
+        GeoDataFrame with the buffered area of interest
+    cache : DownloadCache, optional
+        Cache of previous downloads, by default None
+
+    Returns
+    -------
+    list of DownloadTask
+        Tasks to run with the download scheduler
+    """
+    return [
+        DownloadTask(
+            "osm", "osm", download_osm_layers, (storage, gdf_buffer), {"cache": cache}
+        )
+    ]
+
+
+def download_all_data(
+    storage,
+    gdf: gpd.GeoDataFrame,
+    max_workers: int = DEFAULT_MAX_WORKERS,
+    timeouts: Optional[Dict[str, float]] = None,
+    retries: int = DEFAULT_RETRIES,
+    cache: Optional[DownloadCache] = None,
+    merge_osm: bool = False,
+    groups: Optional[Collection[str]] = None,
+) -> Dict[str, DownloadOutcome]:
+    """
+    Downloads terrain, geophysical and infrastructure data concurrently
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object to save the downloaded data
+    gdf : GeoDataFrame
+        GeoDataFrame with the area of interest
+    max_workers : int, optional
+        Number of concurrent downloads, by default 4
+    timeouts : dict, optional
+        Per-attempt timeouts in seconds keyed by task name or source ("stac", "osm").
+        Overrides DEFAULT_TIMEOUTS.
+    retries : int, optional
+        Number of retries per task, by default 2
+    cache : DownloadCache, optional
+        Cache of previous downloads, by default None
+    merge_osm : bool, optional
+        Fetch all OSM layers with a single merged query instead of one query per layer, by default False
+    groups : collection of str, optional
+        Only download these groups of DOWNLOAD_GROUPS, by default all of them.
+        The merged OSM query downloads both OSM groups.
+
+    Returns
+    -------
+    dict
+        DownloadOutcome of every task, keyed by task name
+    """
+    logger.info("Downloading all data...")
+    groups = set(DOWNLOAD_GROUPS if groups is None else groups)
+    gdf_buffer = create_buffer(gdf, DOWNLOAD_BUFFER)
+    tasks = []
+    if TERRAIN in groups:
+        tasks += terrain_download_tasks(storage, gdf, cache)
+    if merge_osm:
+        if groups & {GEOPHYSICAL, INFRASTRUCTURE}:
+            tasks += osm_download_tasks(storage, gdf_buffer, cache)
+    else:
+        if GEOPHYSICAL in groups:
+            tasks += geophysical_download_tasks(storage, gdf_buffer, cache)
+        if INFRASTRUCTURE in groups:
+            tasks += infrastructure_download_tasks(storage, gdf_buffer, cache)
+    timeouts = {**DEFAULT_TIMEOUTS, **(timeouts or {})}
+    for task in tasks:
+        task.timeout = timeouts.get(task.name, timeouts.get(task.source))
+        task.retries = retries
+    outcomes = run_downloads(storage, tasks, max_workers=max_workers)
+    failed = [name for name, outcome in outcomes.items() if not outcome.ok]
+    if failed:
+        logger.warning("Failed downloads: %s", ", ".join(failed))
+    else:
+        logger.info("All data downloaded successfully")
+    return outcomes
+
+
+def completed_groups(
+    outcomes: Dict[str, DownloadOutcome], groups: Optional[Collection[str]] = None
+) -> List[str]:
+    """
+    Download groups whose tasks all succeeded
+
+    Parameters
+    ----------
+    outcomes : dict
+        DownloadOutcome of every task, as returned by download_all_data
+    groups : collection of str, optional
+        Groups that were downloaded, by default all of them
+
+    Returns
+    -------
+    list of str
+        Names of the groups with at least one task run and no failed task
+    """
+    completed = []
+    for group in DOWNLOAD_GROUPS if groups is None else groups:
+        names = [name for name in DOWNLOAD_GROUPS[group] if name in outcomes]
+        if names and all(outcomes[name].ok for name in names):
+            completed.append(group)
+    return completed
+
+
+def check_downloads(outcomes: Dict[str, DownloadOutcome]) -> None:
+    """
+    Raise if any download task failed
+
+    Parameters
+    ----------
+    outcomes : dict
+        DownloadOutcome of every task, as returned by download_all_data
+
+    Raises
+    ------
+    DownloadError
+        Naming the failed tasks and their errors
     """
-    gdf_buffer = create_buffer(gdf, 5000)
-    download_roads(storage, gdf_buffer)
-    download_buildings(storage, gdf_buffer)
-    download_power_networks(storage, gdf_buffer)
-    download_pipelines(storage, gdf_buffer)
\ No newline at end of file
+    failed = [outcome for outcome in outcomes.values() if not outcome.ok]
+    if failed:
+        raise DownloadError(
+            "Downloads failed: "
+            + ", ".join(f"{outcome.name} ({outcome.error})" for outcome in failed)
+        )
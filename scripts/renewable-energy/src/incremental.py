@@ -0,0 +1,193 @@
+"""Incremental pipeline runs: stages only rerun when their inputs changed."""
+
+import hashlib
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional
+
+import geopandas as gpd
+
+from .cache import geometry_hash
+from .instrumentation import PROCESSING, recorder
+from .status_registry import get_manifest, set_manifest
+from .vector_io import find_layer
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+
+
+def _digest(payload: Any) -> str:
+    body = json.dumps(payload, sort_keys=True, default=str)
+    return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+
+def artifact_version(storage, name: str) -> Optional[str]:
+    """
+    Version of a stored file or vector layer, changing whenever it is rewritten.
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object where the data is saved
+    name : str
+        File name, or layer name without extension for vector layers
+
+    Returns
+    -------
+    str or None
+        Stored name with its modification time and size for local storage, or
+        its object info otherwise. None if it doesn't exist.
+    """
+    path = name if os.path.splitext(name)[1] else find_layer(storage, name)
+    if path is None or not storage.exists(path):
+        return None
+    local = storage.get_path(path)
+    if os.path.isfile(local):
+        stat = os.stat(local)
+        return f"{path}:{stat.st_mtime_ns}-{stat.st_size}"
+    return f"{path}:{_digest(storage.object_info(path))}"
+
+
+@dataclass
+class StageSpec:
+    """A stage of the pipeline DAG and the inputs it is fingerprinted on."""
+
+    name: str
+    outputs: List[str]
+    params: dict = field(default_factory=dict)
+    deps: List[str] = field(default_factory=list)
+    kind: str = PROCESSING
+
+
+class StageGraph:
+    """
+    Stages of the pipeline and the fingerprints of their last completed run.
+
+    The fingerprint of a stage hashes the AOI, its parameters and the versions
+    of the outputs of its upstream stages. A stage is current, and skipped,
+    when its fingerprint is the one of its last completed run and its outputs
+    weren't rewritten since. Fingerprints are kept in pipeline_manifest.json.
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object where the data is saved
+    aoi_gdf : GeoDataFrame
+        GeoDataFrame with the area of interest
+    force : bool, optional
+        Run every stage, by default False
+    """
+
+    def __init__(self, storage, aoi_gdf: gpd.GeoDataFrame, force: bool = False):
+        self.storage = storage
+        self.aoi_hash = geometry_hash(aoi_gdf)
+        self.force = force
+        self.stages: Dict[str, StageSpec] = {}
+        self.skipped: List[str] = []
+        self.completed: List[str] = []
+        manifest = get_manifest(storage)
+        if manifest.get("version") != MANIFEST_VERSION:
+            manifest = {"version": MANIFEST_VERSION, "stages": {}}
+        self.manifest = manifest
+
+    def add(
+        self,
+        name: str,
+        outputs: Iterable[str],
+        params: Optional[dict] = None,
+        deps: Iterable[str] = (),
+        kind: str = PROCESSING,
+    ) -> StageSpec:
+        """
+        Add a stage, after the stages it depends on.
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage
+        outputs : iterable of str
+            Files and vector layers written by the stage
+        params : dict, optional
+            JSON-serializable parameters of the stage
+        deps : iterable of str, optional
+            Upstream stages whose outputs the stage reads
+        kind : str, optional
+            Kind of the stage records, by default "processing"
+
+        Returns
+        -------
+        StageSpec
+            The added stage
+        """
+        missing = [dep for dep in deps if dep not in self.stages]
+        if missing:
+            raise ValueError(f"Unknown upstream stages of {name}: {missing}")
+        spec = StageSpec(name, list(outputs), dict(params or {}), list(deps), kind)
+        self.stages[name] = spec
+        return spec
+
+    def fingerprint(self, name: str) -> str:
+        """Hash of the AOI, parameters and upstream output versions of a stage"""
+        spec = self.stages[name]
+        # Versions of the stored outputs, also rewritten by failed or external runs
+        upstream = {dep: self._outputs(dep) for dep in spec.deps}
+        return _digest(
+            {"aoi": self.aoi_hash, "params": spec.params, "upstream": upstream}
+        )
+
+    def _outputs(self, name: str) -> Dict[str, Optional[str]]:
+        return {
+            output: artifact_version(self.storage, output)
+            for output in self.stages[name].outputs
+        }
+
+    def is_current(self, name: str) -> bool:
+        """Whether a stage last completed with the same inputs and outputs"""
+        entry = self.manifest["stages"].get(name)
+        if self.force or entry is None:
+            return False
+        return (
+            entry["fingerprint"] == self.fingerprint(name)
+            and entry["outputs"] == self._outputs(name)
+        )
+
+    def plan(self, names: Iterable[str], force: bool = False) -> List[str]:
+        """
+        Stages that have to run, recording the current ones as skipped.
+
+        Parameters
+        ----------
+        names : iterable of str
+            Stages to check, whose upstream stages already ran or were skipped
+        force : bool, optional
+            Run these stages even if they are current, by default False
+
+        Returns
+        -------
+        list of str
+            Names of the stages to run
+        """
+        stale = []
+        for name in names:
+            if not force and self.is_current(name):
+                logger.info("Skipping %s, its inputs didn't change", name)
+                self.skipped.append(name)
+                recorder.skip(name, self.stages[name].kind)
+            else:
+                stale.append(name)
+        return stale
+
+    def complete(self, name: str) -> None:
+        """Save the fingerprint and output versions of a stage that just ran"""
+        outputs = self._outputs(name)
+        self.manifest["stages"][name] = {
+            "fingerprint": self.fingerprint(name),
+            "outputs": outputs,
+            "completed_at": datetime.now(timezone.utc).isoformat(),
+        }
+        self.completed.append(name)
+        set_manifest(self.storage, self.manifest)
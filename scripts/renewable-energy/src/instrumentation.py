@@ -0,0 +1,311 @@
+"""Per-stage timing, memory, I/O and volume records of a pipeline run."""
+
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Iterator, List, Optional
+
+import pyarrow.parquet as pq
+import pyogrio
+import rasterio
+
+from .status_registry import MANIFEST_PATH, STAGES_PATH, STATUS_PATH
+
+logger = logging.getLogger(__name__)
+
+DOWNLOAD = "download"
+PROCESSING = "processing"
+STORAGE = "storage"
+
+RASTER_EXTENSIONS = (".tif", ".tiff")
+VECTOR_FILE_EXTENSIONS = (".parquet", ".fgb")
+# Bookkeeping files of the run, not recorded as writes
+_UNRECORDED = (STATUS_PATH, STAGES_PATH, MANIFEST_PATH)
+# ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+_RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+
+def peak_rss_mb() -> float:
+    """Peak resident memory of the process and its finished children, in MB"""
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return peak * _RSS_UNIT / 1024**2
+
+
+@dataclass
+class StageRecord:
+    """
+    Measures of a pipeline stage.
+
+    The operating system only keeps the peak memory of the whole process, so
+    peak_rss_mb is the peak reached by the end of the stage, and rss_growth_mb
+    how much the stage raised it.
+
+    bytes_downloaded is only counted by downloads that know how much they
+    received. The spai loaders and the STAC reads don't report it, so it stays
+    0 for them: their stages record what they saved as bytes_written.
+    """
+
+    name: str
+    kind: str = PROCESSING
+    parent: Optional[str] = None
+    started_at: Optional[str] = None
+    wall_seconds: float = 0.0
+    peak_rss_mb: float = 0.0
+    rss_growth_mb: float = 0.0
+    bytes_downloaded: int = 0
+    bytes_written: int = 0
+    features: int = 0
+    pixels: int = 0
+    cache_hits: int = 0
+    status: str = "ok"
+    error: Optional[str] = None
+    _start: float = field(default=0.0, repr=False)
+    _start_rss: float = field(default=0.0, repr=False)
+
+    def to_dict(self) -> dict:
+        return {k: v for k, v in asdict(self).items() if not k.startswith("_")}
+
+
+class StageRecorder:
+    """
+    Collects the records of the stages run by every thread of the process.
+
+    Stages nest per thread: counts added inside a stage are also added to the
+    stages enclosing it in the same thread, or in the thread that handed its
+    stages over with within().
+    """
+
+    def __init__(self):
+        self._records: List[StageRecord] = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self) -> List[StageRecord]:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def stage(self, name: str, kind: str = PROCESSING) -> Iterator[StageRecord]:
+        stack = self._stack()
+        record = StageRecord(
+            name,
+            kind,
+            parent=stack[-1].name if stack else None,
+            started_at=datetime.now(timezone.utc).isoformat(),
+            _start=time.perf_counter(),
+            _start_rss=peak_rss_mb(),
+        )
+        stack.append(record)
+        try:
+            yield record
+        except BaseException as e:
+            record.status = "error"
+            record.error = str(e)
+            raise
+        finally:
+            stack.pop()
+            record.wall_seconds = round(time.perf_counter() - record._start, 3)
+            peak = peak_rss_mb()
+            record.peak_rss_mb = round(peak, 1)
+            record.rss_growth_mb = round(peak - record._start_rss, 1)
+            with self._lock:
+                self._records.append(record)
+            logger.debug(
+                "Stage %s: %.2fs, %d bytes written, %d features, %d pixels",
+                name,
+                record.wall_seconds,
+                record.bytes_written,
+                record.features,
+                record.pixels,
+            )
+
+    def skip(self, name: str, kind: str = PROCESSING) -> None:
+        """Record a stage that didn't run because its inputs didn't change"""
+        stack = self._stack()
+        record = StageRecord(
+            name,
+            kind,
+            parent=stack[-1].name if stack else None,
+            started_at=datetime.now(timezone.utc).isoformat(),
+            peak_rss_mb=round(peak_rss_mb(), 1),
+            status="skipped",
+        )
+        with self._lock:
+            self._records.append(record)
+
+    def current(self) -> List[StageRecord]:
+        """Stages currently open in this thread, outermost first"""
+        return list(self._stack())
+
+    @contextmanager
+    def within(self, stages: List[StageRecord]) -> Iterator[None]:
+        """Nest the stages of this thread in the stages of another thread"""
+        previous = self._stack()
+        self._local.stack = list(stages)
+        try:
+            yield
+        finally:
+            self._local.stack = previous
+
+    @contextmanager
+    def collect(self) -> Iterator[List[StageRecord]]:
+        """
+        Keep the stages recorded in the block apart, in the list yielded.
+
+        Stages recorded by other threads meanwhile are collected too.
+        """
+        collected = []
+        with self._lock:
+            previous, self._records = self._records, collected
+        try:
+            yield collected
+        finally:
+            with self._lock:
+                self._records = previous
+
+    def merge(self, records: List[dict], prefix: str) -> None:
+        """
+        Add the records of stages run elsewhere, e.g. in a worker process.
+
+        Names are prefixed with prefix and "/", and the stages without a
+        parent are nested in the stage open in this thread.
+        """
+        stack = self._stack()
+        parent = stack[-1].name if stack else None
+        merged = []
+        for record in records:
+            record = dict(record)
+            record["name"] = f"{prefix}/{record['name']}"
+            record["parent"] = (
+                f"{prefix}/{record['parent']}" if record["parent"] else parent
+            )
+            merged.append(StageRecord(**record))
+        with self._lock:
+            self._records.extend(merged)
+
+    def add(self, **counts: int) -> None:
+        """Add counts to the stages currently open in this thread"""
+        # Stages handed over with within() are shared with other threads
+        with self._lock:
+            for record in self._stack():
+                for key, value in counts.items():
+                    setattr(record, key, getattr(record, key) + int(value))
+
+    def records(self) -> List[dict]:
+        with self._lock:
+            return [record.to_dict() for record in self._records]
+
+    def reset(self) -> None:
+        with self._lock:
+            self._records = []
+
+
+recorder = StageRecorder()
+
+
+def stage(name: str, kind: str = PROCESSING):
+    """
+    Record a stage of the pipeline.
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage
+    kind : str, optional
+        "download", "processing" or "storage", by default "processing"
+
+    Returns
+    -------
+    context manager
+        Yields the StageRecord, filled when the block exits
+    """
+    return recorder.stage(name, kind)
+
+
+def count(**counts: int) -> None:
+    """Add feature, pixel or cache hit counts to the current stages"""
+    recorder.add(**counts)
+
+
+def _object_size(storage, name: str) -> int:
+    try:
+        return int(storage.object_info(name)["size"])
+    except Exception:
+        return 0
+
+
+def _raster_pixels(path: str) -> int:
+    try:
+        with rasterio.open(path) as ds:
+            return ds.width * ds.height * ds.count
+    except Exception:
+        return 0
+
+
+def _file_features(path: str) -> int:
+    try:
+        if path.lower().endswith(".parquet"):
+            return pq.read_metadata(path).num_rows
+        return int(pyogrio.read_info(path)["features"])
+    except Exception:
+        return 0
+
+
+class InstrumentedStorage:
+    """
+    Storage recording the bytes, features and pixels of every write.
+
+    Every other attribute is the one of the wrapped storage.
+
+    Parameters
+    ----------
+    storage : Storage
+        Wrapped storage
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self.storage, attr)
+
+    def create(self, data, name: str, **kwargs):
+        if name in _UNRECORDED:
+            return self.storage.create(data, name, **kwargs)
+        with stage(f"write/{name}", STORAGE):
+            pixels = 0
+            features = len(data) if hasattr(data, "geometry") else 0
+            if isinstance(data, str) and os.path.isfile(data):
+                # Local files are moved by the storage, read them first
+                if name.lower().endswith(RASTER_EXTENSIONS):
+                    pixels = _raster_pixels(data)
+                elif name.lower().endswith(VECTOR_FILE_EXTENSIONS):
+                    features = _file_features(data)
+            result = self.storage.create(data, name, **kwargs)
+            if name.lower().endswith(RASTER_EXTENSIONS) and not pixels:
+                path = self.storage.get_path(name)
+                if os.path.isfile(path):
+                    pixels = _raster_pixels(path)
+            count(
+                bytes_written=_object_size(self.storage, name),
+                features=features,
+                pixels=pixels,
+            )
+            return result
+
+
+def instrument_storage(storage) -> InstrumentedStorage:
+    """Wrap a storage to record its writes, once"""
+    if isinstance(storage, InstrumentedStorage):
+        return storage
+    return InstrumentedStorage(storage)
@@ -0,0 +1,160 @@
+"""Single merged Overpass query for several OpenStreetMap layers."""
+
+import logging
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import geopandas as gpd
+import osmnx as ox
+import pandas as pd
+from shapely.validation import make_valid
+from spai.data.satellite.utils import create_aoi_geodataframe
+from spai.data.sources.osm import curate_osm_gdf
+
+logger = logging.getLogger(__name__)
+
+LINES = ("LineString", "MultiLineString")
+POINTS = ("Point", "MultiPoint")
+POLYGONS = ("Polygon", "MultiPolygon")
+
+
+@dataclass(frozen=True)
+class OsmLayer:
+    """An OSM layer extracted from the merged query."""
+
+    name: str
+    query: dict
+    geometry_types: Optional[Tuple[str, ...]] = None
+
+
+def merge_tags(layers: List[OsmLayer]) -> Dict[str, object]:
+    """
+    Merge the tag queries of several layers into a single osmnx tags dict.
+
+    Parameters
+    ----------
+    layers : list of OsmLayer
+        Layers to query
+
+    Returns
+    -------
+    dict
+        Tags matching any feature of any layer
+    """
+    tags = {}
+    for layer in layers:
+        for key, values in layer.query.items():
+            if values is True or tags.get(key) is True:
+                tags[key] = True
+                continue
+            values = values if isinstance(values, list) else [values]
+            merged = tags.setdefault(key, [])
+            merged.extend(value for value in values if value not in merged)
+    return tags
+
+
+def match_tags(gdf: gpd.GeoDataFrame, query: dict) -> pd.Series:
+    """
+    Boolean mask of the features matching a tag query.
+
+    Parameters
+    ----------
+    gdf : GeoDataFrame
+        Features returned by osmnx, with one column per tag
+    query : dict
+        The tag query of a layer
+
+    Returns
+    -------
+    Series
+        True for every feature with any of the queried tags
+    """
+    mask = pd.Series(False, index=gdf.index)
+    for key, values in query.items():
+        if key not in gdf.columns:
+            continue
+        if values is True:
+            mask |= gdf[key].notna()
+        else:
+            values = values if isinstance(values, list) else [values]
+            mask |= gdf[key].isin(values)
+    return mask
+
+
+def split_layers(
+    gdf: gpd.GeoDataFrame, layers: List[OsmLayer], crs: str = "EPSG:4326"
+) -> Dict[str, gpd.GeoDataFrame]:
+    """
+    Split the merged query result into one curated GeoDataFrame per layer.
+
+    Tag columns that are empty for a layer are dropped, so every layer has the
+    same columns it would have had with its own query.
+
+    Parameters
+    ----------
+    gdf : GeoDataFrame
+        Features returned by the merged query
+    layers : list of OsmLayer
+        Layers to extract
+    crs : str, optional
+        The coordinate reference system to use, by default WGS84 (EPSG:4326)
+
+    Returns
+    -------
+    dict
+        GeoDataFrame of every layer, keyed by layer name
+    """
+    out = {}
+    for layer in layers:
+        if gdf.empty:
+            out[layer.name] = gpd.GeoDataFrame()
+            continue
+        subset = gdf[match_tags(gdf, layer.query)]
+        if layer.geometry_types:
+            subset = subset[subset.geometry.type.isin(layer.geometry_types)]
+        if subset.empty:
+            out[layer.name] = gpd.GeoDataFrame()
+            continue
+        subset = subset.dropna(axis=1, how="all")
+        out[layer.name] = curate_osm_gdf(
+            gpd.GeoDataFrame(subset, geometry="geometry", crs=gdf.crs), crs
+        )
+    return out
+
+
+def load_osm_layers(
+    aoi, layers: List[OsmLayer], crs: str = "EPSG:4326"
+) -> Dict[str, gpd.GeoDataFrame]:
+    """
+    Load several OSM layers with a single Overpass query per AOI polygon.
+
+    Parameters
+    ----------
+    aoi : Any
+        The area of interest
+    layers : list of OsmLayer
+        Layers to load
+    crs : str, optional
+        The coordinate reference system to use, by default WGS84 (EPSG:4326)
+
+    Returns
+    -------
+    dict
+        GeoDataFrame of every layer, keyed by layer name
+    """
+    aoi_gdf = create_aoi_geodataframe(aoi, crs)
+    tags = merge_tags(layers)
+    logger.info("Querying OSM once for %d layers...", len(layers))
+    elements = []
+    for polygon in aoi_gdf.geometry:
+        if not polygon.is_valid:
+            polygon = make_valid(polygon)
+        try:
+            elements.append(ox.features_from_polygon(polygon, tags=tags))
+        except ox._errors.InsufficientResponseError:
+            continue
+    if not elements:
+        return split_layers(gpd.GeoDataFrame(), layers, crs)
+    gdf = pd.concat(elements)
+    gdf = gdf[~gdf.index.duplicated()]
+    return split_layers(gdf, layers, crs)
@@ -0,0 +1,44 @@
+"""Band statistics of the rasters, saved as sidecars for the API."""
+
+import logging
+from typing import Iterable, List
+
+from stats_sidecar import object_version, raster_stats, sidecar, stats_path
+
+logger = logging.getLogger(__name__)
+
+
+def write_raster_stats(storage, names: Iterable[str]) -> List[str]:
+    """
+    Save the band statistics of the existing rasters next to them.
+
+    Every sidecar records the version of the raster it was computed on, so
+    the API can tell when the raster has been rewritten since.
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object where the data is saved
+    names : iterable of str
+        Names of the rasters
+
+    Returns
+    -------
+    list of str
+        Names of the saved sidecars
+    """
+    written = []
+    for name in names:
+        if not storage.exists(name):
+            continue
+        version = object_version(storage, name)
+        ds = storage.read(name)
+        try:
+            stats = raster_stats(ds)
+        finally:
+            ds.close()
+        storage.create(sidecar(stats, version), stats_path(name))
+        written.append(stats_path(name))
+    if written:
+        logger.info("Raster statistics saved: %s", ", ".join(written))
+    return written
@@ -0,0 +1,245 @@
+"""Raster suitability engine based on distance transforms on the DEM grid."""
+
+import logging
+import math
+from typing import List, Optional, Tuple
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from affine import Affine
+from rasterio import features
+from scipy import ndimage
+
+from .utilities import write_raster
+
+logger = logging.getLogger(__name__)
+
+SUITABILITY_RASTER = "suitable_areas.tif"
+METERS_PER_DEGREE = 111320.0
+
+
+def pixel_size_m(transform: Affine, crs, height: int) -> Tuple[float, float]:
+    """
+    Size in meters of the pixels of a grid, as (row, column) spacing.
+
+    For geographic grids the spacing is taken at the latitude of the grid center.
+
+    Parameters
+    ----------
+    transform : Affine
+        Geotransform of the grid
+    crs : CRS
+        Coordinate reference system of the grid
+    height : int
+        Number of rows of the grid
+
+    Returns
+    -------
+    tuple
+        (dy, dx) pixel spacing in meters
+    """
+    dx, dy = abs(transform.a), abs(transform.e)
+    if crs is not None and crs.is_geographic:
+        latitude = transform.f + transform.e * height / 2
+        return (
+            dy * METERS_PER_DEGREE,
+            dx * METERS_PER_DEGREE * math.cos(math.radians(latitude)),
+        )
+    return dy, dx
+
+
+def padded_grid(
+    transform: Affine, shape: Tuple[int, int], pad: int
+) -> Tuple[Affine, Tuple[int, int]]:
+    """
+    Grow a grid by pad pixels on every side.
+
+    Parameters
+    ----------
+    transform : Affine
+        Geotransform of the grid
+    shape : tuple
+        (height, width) of the grid
+    pad : int
+        Pixels to add on every side
+
+    Returns
+    -------
+    tuple
+        (transform, shape) of the padded grid
+    """
+    return (
+        transform * Affine.translation(-pad, -pad),
+        (shape[0] + 2 * pad, shape[1] + 2 * pad),
+    )
+
+
+def rasterize_layers(
+    layers: List[Optional[gpd.GeoDataFrame]],
+    transform: Affine,
+    shape: Tuple[int, int],
+    crs,
+    all_touched: bool = True,
+) -> np.ndarray:
+    """
+    Burn the geometries of several layers into a boolean mask.
+
+    Parameters
+    ----------
+    layers : list of GeoDataFrame or None
+        Layers to rasterize
+    transform : Affine
+        Geotransform of the grid
+    shape : tuple
+        (height, width) of the grid
+    crs : CRS
+        Coordinate reference system of the grid
+    all_touched : bool, optional
+        Burn every pixel touched by a geometry, by default True so thin lines are never missed
+
+    Returns
+    -------
+    ndarray
+        True where any geometry is present
+    """
+    geometries = []
+    for layer in layers:
+        if layer is None or layer.empty:
+            continue
+        if layer.crs is None:
+            layer = layer.set_crs("EPSG:4326")
+        geometries.extend(layer.to_crs(crs).geometry.dropna().to_numpy())
+    if not geometries:
+        return np.zeros(shape, dtype=bool)
+    mask = features.rasterize(
+        ((geometry, 1) for geometry in geometries),
+        out_shape=shape,
+        transform=transform,
+        fill=0,
+        dtype="uint8",
+        all_touched=all_touched,
+    )
+    return mask.astype(bool)
+
+
+def distance_to(mask: np.ndarray, sampling: Tuple[float, float]) -> np.ndarray:
+    """
+    Euclidean distance in meters from every pixel to the nearest True pixel.
+
+    Parameters
+    ----------
+    mask : ndarray
+        Boolean mask of the features
+    sampling : tuple
+        (dy, dx) pixel spacing in meters
+
+    Returns
+    -------
+    ndarray
+        float32 distances, infinite everywhere if the mask is empty
+    """
+    if not mask.any():
+        return np.full(mask.shape, np.inf, dtype=np.float32)
+    return ndimage.distance_transform_edt(~mask, sampling=sampling).astype(np.float32)
+
+
+def vectorize_mask(mask: np.ndarray, transform: Affine, crs) -> gpd.GeoDataFrame:
+    """
+    Polygonize the True pixels of a mask.
+
+    Parameters
+    ----------
+    mask : ndarray
+        Boolean mask
+    transform : Affine
+        Geotransform of the mask
+    crs : CRS
+        Coordinate reference system of the mask
+
+    Returns
+    -------
+    GeoDataFrame
+        One polygon per connected region
+    """
+    shapes = features.shapes(
+        mask.astype(np.uint8), mask=mask, transform=transform, connectivity=8
+    )
+    geometries = [shapely.geometry.shape(geometry) for geometry, _ in shapes]
+    return gpd.GeoDataFrame(geometry=geometries, crs=crs)
+
+
+def raster_suitable_areas(
+    storage,
+    aoi_gdf: gpd.GeoDataFrame,
+    protected_areas: Optional[gpd.GeoDataFrame],
+    infrastructure_layers: List[Optional[gpd.GeoDataFrame]],
+    buffer_size: int = 500,
+    reference: str = "dem.tif",
+    exclusion: Optional[str] = None,
+) -> gpd.GeoDataFrame:
+    """
+    Suitable areas computed on the grid of a reference raster.
+
+    Infrastructure, protected areas and the AOI are rasterized on the grid,
+    padded by the buffer distance so infrastructure just outside the raster
+    still counts. A Euclidean distance transform gives the distance to the
+    nearest infrastructure pixel. The suitability mask is saved as a GeoTIFF
+    and returned as polygons. Runtime depends on the pixel count, not on the
+    number of vertices.
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object where the data is saved
+    aoi_gdf : GeoDataFrame
+        GeoDataFrame with the area of interest
+    protected_areas : GeoDataFrame or None
+        Areas to exclude
+    infrastructure_layers : list of GeoDataFrame or None
+        Layers the suitable areas must be close to
+    buffer_size : int, optional
+        Maximum distance to infrastructure in meters, by default 500
+    reference : str, optional
+        Raster whose grid is used, by default "dem.tif"
+    exclusion : str, optional
+        Mask raster on the reference grid with extra areas to exclude, by default None
+
+    Returns
+    -------
+    GeoDataFrame
+        Suitable polygons, in the AOI CRS
+    """
+    if not storage.exists(reference):
+        raise FileNotFoundError(f"{reference} is required by the raster engine")
+    ds = storage.read(reference)
+    transform, crs, shape = ds.transform, ds.crs, (ds.height, ds.width)
+    ds.close()
+
+    sampling = pixel_size_m(transform, crs, shape[0])
+    pad = math.ceil(buffer_size / min(sampling)) + 1
+    transform, shape = padded_grid(transform, shape, pad)
+    logger.info("Rasterizing layers on a %dx%d grid...", shape[1], shape[0])
+
+    infrastructure = rasterize_layers(infrastructure_layers, transform, shape, crs)
+    near = distance_to(infrastructure, sampling) <= buffer_size
+    protected = rasterize_layers([protected_areas], transform, shape, crs)
+    aoi = rasterize_layers([aoi_gdf], transform, shape, crs, all_touched=False)
+    suitable = aoi & near & ~protected
+    if exclusion is not None:
+        excluded = storage.read(exclusion)
+        suitable[pad:-pad, pad:-pad] &= ~excluded.read(1).astype(bool)
+        excluded.close()
+
+    window = (slice(pad, shape[0] - pad), slice(pad, shape[1] - pad))
+    write_raster(
+        storage,
+        suitable[window],
+        SUITABILITY_RASTER,
+        transform * Affine.translation(pad, pad),
+        crs,
+    )
+
+    if not suitable.any():
+        return gpd.GeoDataFrame(geometry=[], crs=aoi_gdf.crs)
+    return vectorize_mask(suitable, transform, crs).to_crs(aoi_gdf.crs)
@@ -0,0 +1,160 @@
+"""Suitable sites scored on their size and distance to the grid and roads."""
+
+import logging
+from dataclasses import dataclass
+
+import geopandas as gpd
+import numpy as np
+
+from .site_stats import SITES_LAYER, nearest_distances, power_features
+from .utilities import local_metric_crs
+from .vector_io import delete_layer, read_layer, write_layer
+
+logger = logging.getLogger(__name__)
+
+RANKED_LAYER = "ranked_sites"
+# Power network features a site can be connected to, besides the lines
+CONNECTION_TAGS = ("substation", "transformer")
+# Infrastructure is downloaded this far around the AOI, sites farther away
+# than this from it score 0 on that criterion
+DEFAULT_REFERENCE_DISTANCE = 5000.0
+
+
+@dataclass
+class ScoreWeights:
+    """Weights of the criteria of the site score."""
+
+    area: float = 0.4
+    grid: float = 0.4
+    road: float = 0.2
+    reference_distance: float = DEFAULT_REFERENCE_DISTANCE
+
+    @classmethod
+    def from_vars(cls, vars) -> "ScoreWeights":
+        """
+        Read the weights from SPAIVars, falling back to the defaults.
+
+        Parameters
+        ----------
+        vars : SPAIVars
+            Project variables. Uses SCORE_WEIGHTS, a dict with area, grid and
+            road weights, and SCORE_REFERENCE_DISTANCE in meters.
+
+        Returns
+        -------
+        ScoreWeights
+            The weights
+        """
+        weights = cls()
+        for name, value in (vars["SCORE_WEIGHTS"] or {}).items():
+            if name not in ("area", "grid", "road"):
+                raise ValueError(
+                    f"Unknown score weight '{name}', use area, grid or road"
+                )
+            setattr(weights, name, float(value))
+        if vars["SCORE_REFERENCE_DISTANCE"]:
+            weights.reference_distance = float(vars["SCORE_REFERENCE_DISTANCE"])
+        return weights
+
+
+def _distance_score(distances: np.ndarray, reference: float) -> np.ndarray:
+    """1 next to the infrastructure down to 0 at the reference distance, or without it"""
+    score = np.clip(1 - distances / reference, 0, 1)
+    return np.where(np.isnan(score), 0.0, score)
+
+
+def score_sites(
+    storage, sites: gpd.GeoDataFrame, weights: ScoreWeights
+) -> gpd.GeoDataFrame:
+    """
+    Score and rank sites on their area and their distances to the grid and roads.
+
+    Distances of all the sites are found with bulk nearest queries on spatial
+    indexes of the power lines, the substations and transformers, and the
+    roads. The connection distance is the distance to the nearest of them
+    that belongs to the grid. Every criterion is scaled to [0, 1]: areas by
+    the largest site, distances linearly down to 0 at the reference
+    distance. The score is their weighted mean.
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object where the data is saved
+    sites : GeoDataFrame
+        Sites, as saved by write_site_stats
+    weights : ScoreWeights
+        Weights of the criteria
+
+    Returns
+    -------
+    GeoDataFrame
+        The sites with connection_distance_m, road_distance_m, score and rank
+        columns, sorted by rank from 1
+    """
+    sites = sites.copy()
+    if sites.empty:
+        for column in ("connection_distance_m", "road_distance_m", "score"):
+            sites[column] = np.array([], dtype="float64")
+        sites["rank"] = np.array([], dtype="int64")
+        return sites
+    crs = local_metric_crs(sites)
+    connection = np.fmin(
+        nearest_distances(sites, read_layer(storage, "power_lines"), crs),
+        nearest_distances(sites, power_features(storage, CONNECTION_TAGS), crs),
+    )
+    road = nearest_distances(sites, read_layer(storage, "roads"), crs)
+    area = sites["area_km2"].to_numpy()
+
+    total = weights.area + weights.grid + weights.road
+    if total <= 0:
+        raise ValueError("Score weights must add up to more than 0")
+    score = (
+        weights.area * area / area.max()
+        + weights.grid * _distance_score(connection, weights.reference_distance)
+        + weights.road * _distance_score(road, weights.reference_distance)
+    ) / total
+
+    sites["connection_distance_m"] = connection
+    sites["road_distance_m"] = road
+    sites["score"] = score
+    # Ties go to the larger site
+    order = np.lexsort((-area, -score))
+    sites = sites.iloc[order].reset_index(drop=True)
+    sites["rank"] = np.arange(1, len(sites) + 1)
+    return sites
+
+
+def write_ranked_sites(storage, weights: ScoreWeights) -> gpd.GeoDataFrame:
+    """
+    Rank the saved suitable sites and save them, best first.
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object where the data is saved
+    weights : ScoreWeights
+        Weights of the criteria
+
+    Returns
+    -------
+    GeoDataFrame
+        The ranked sites
+    """
+    logger.info("Ranking suitable sites...")
+    sites = read_layer(storage, SITES_LAYER)
+    if sites is None:
+        sites = gpd.GeoDataFrame(
+            {"site_id": [], "area_km2": []}, geometry=[], crs="EPSG:4326"
+        )
+    ranked = score_sites(storage, sites, weights)
+    if ranked.empty:
+        delete_layer(storage, RANKED_LAYER)
+    else:
+        write_layer(storage, ranked, RANKED_LAYER)
+        logger.info(
+            "%d sites ranked, best site %d scored %.3f",
+            len(ranked),
+            ranked["site_id"].iloc[0],
+            ranked["score"].iloc[0],
+        )
+    return ranked
@@ -0,0 +1,427 @@
+"""Zonal statistics of the suitable sites, saved for the API charts."""
+
+import json
+import logging
+import math
+from typing import Dict, Optional, Sequence
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from rasterio import features
+from rasterio.errors import WindowError
+from rasterio.windows import Window, from_bounds
+
+from .raster_suitability import METERS_PER_DEGREE
+from .terrain import (
+    DEFAULT_BLOCK_SIZE,
+    _land_cover_block,
+    _read_with_halo,
+    block_windows,
+    slope_aspect,
+)
+from .utilities import local_metric_crs, project_geometries
+from .vector_io import delete_layer, read_layer, write_layer
+
+logger = logging.getLogger(__name__)
+
+SITES_LAYER = "suitable_sites"
+SITE_STATS = "suitable_areas_stats.json"
+
+# ESA WorldCover classes, 0 is no data
+LAND_COVER_CLASSES = {
+    10: "Tree cover",
+    20: "Shrubland",
+    30: "Grassland",
+    40: "Cropland",
+    50: "Built-up",
+    60: "Bare / sparse vegetation",
+    70: "Snow and ice",
+    80: "Permanent water bodies",
+    90: "Herbaceous wetland",
+    95: "Mangroves",
+    100: "Moss and lichen",
+}
+LAND_COVER_BINS = 256
+# Slope histogram of the sites, in one degree bins, the last one open
+SLOPE_HISTOGRAM_MAX = 45
+SUBSTATION_TAGS = ("substation",)
+
+
+def suitable_sites(suitable_areas: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """
+    Single polygons of the suitable areas, numbered as sites.
+
+    Parameters
+    ----------
+    suitable_areas : GeoDataFrame
+        Suitable areas, in EPSG:4326 if they have no CRS
+
+    Returns
+    -------
+    GeoDataFrame
+        site_id, from 0 in the order of the areas and their parts, area_km2
+        and geometry, in EPSG:4326
+    """
+    if suitable_areas.crs is None:
+        suitable_areas = suitable_areas.set_crs("EPSG:4326")
+    geometries = suitable_areas.geometry.to_crs("EPSG:4326").explode(
+        index_parts=False
+    )
+    geometries = geometries[
+        ~geometries.is_empty & (geometries.geom_type == "Polygon")
+    ].reset_index(drop=True)
+    sites = gpd.GeoDataFrame(
+        {"site_id": np.arange(len(geometries))}, geometry=geometries, crs="EPSG:4326"
+    )
+    if len(sites):
+        area = shapely.area(project_geometries(sites.geometry, local_metric_crs(sites)))
+        sites["area_km2"] = area / 1e6
+    else:
+        sites["area_km2"] = pd.Series(dtype="float64")
+    return sites
+
+
+class _Accumulator:
+    """Count, sum, sum of squares, min and max of values per site label."""
+
+    def __init__(self, n: int):
+        self.count = np.zeros(n, dtype="int64")
+        self.sum = np.zeros(n)
+        self.sum_sq = np.zeros(n)
+        self.min = np.full(n, np.inf)
+        self.max = np.full(n, -np.inf)
+
+    def add(self, labels: np.ndarray, values: np.ndarray) -> None:
+        n = len(self.count)
+        self.count += np.bincount(labels, minlength=n)
+        self.sum += np.bincount(labels, weights=values, minlength=n)
+        self.sum_sq += np.bincount(labels, weights=values * values, minlength=n)
+        np.minimum.at(self.min, labels, values)
+        np.maximum.at(self.max, labels, values)
+
+    def stats(self, prefix: str, names=("min", "max", "mean", "std")) -> dict:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = self.sum / self.count
+            std = np.sqrt(np.maximum(self.sum_sq / self.count - mean * mean, 0))
+        empty = self.count == 0
+        values = {"min": self.min, "max": self.max, "mean": mean, "std": std}
+        return {
+            f"{prefix}_{name}": np.where(empty, np.nan, values[name]) for name in names
+        }
+
+
+def zonal_terrain_stats(
+    storage,
+    sites: gpd.GeoDataFrame,
+    dem: str = "dem.tif",
+    land_cover: str = "land_cover.tif",
+    block_size: int = DEFAULT_BLOCK_SIZE,
+) -> Dict[str, np.ndarray]:
+    """
+    Elevation, slope and land cover statistics of every site, block by block.
+
+    All the sites are rasterized at once on the DEM grid as a label raster,
+    and every block is reduced with bincounts over the labels. Land cover is
+    resampled (mode) onto the DEM grid, like the terrain screening does.
+    Sites smaller than a DEM pixel get no statistics.
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object where the data is saved
+    sites : GeoDataFrame
+        Sites, as returned by suitable_sites
+    dem : str, optional
+        DEM raster, by default "dem.tif"
+    land_cover : str, optional
+        Land cover raster, skipped if missing, by default "land_cover.tif"
+    block_size : int, optional
+        Block side in pixels, by default 512
+
+    Returns
+    -------
+    dict
+        Arrays over the sites: pixels, elevation_min/max/mean/std and
+        slope_mean/max/std, land_cover with the pixels of every site (rows) by
+        class code (columns), and slope_histogram with the pixels of all the
+        sites by slope degree
+    """
+    n = len(sites)
+    elevation = _Accumulator(n + 1)
+    slope_acc = _Accumulator(n + 1)
+    land_cover_pixels = np.zeros((n + 1) * LAND_COVER_BINS, dtype="int64")
+    histogram = np.zeros(SLOPE_HISTOGRAM_MAX + 1, dtype="int64")
+
+    ds = storage.read(dem)
+    lc = storage.read(land_cover) if storage.exists(land_cover) else None
+    if lc is None:
+        logger.warning("%s not found, land cover statistics skipped", land_cover)
+    try:
+        geometries = sites.geometry.to_crs(ds.crs) if ds.crs is not None else sites.geometry
+        bounds = from_bounds(*geometries.total_bounds, transform=ds.transform)
+        col0, row0 = math.floor(bounds.col_off), math.floor(bounds.row_off)
+        window = Window(
+            col0,
+            row0,
+            math.ceil(bounds.col_off + bounds.width) - col0,
+            math.ceil(bounds.row_off + bounds.height) - row0,
+        )
+        try:
+            window = window.intersection(Window(0, 0, ds.width, ds.height))
+            # Labels are the site ids plus one, 0 is outside the sites
+            labels = features.rasterize(
+                zip(geometries, sites["site_id"].to_numpy() + 1),
+                out_shape=(int(window.height), int(window.width)),
+                transform=ds.window_transform(window),
+                fill=0,
+                dtype="int32",
+            )
+        except WindowError:
+            logger.warning("The sites are out of %s, terrain statistics skipped", dem)
+            window, labels = Window(0, 0, 0, 0), np.zeros((0, 0), dtype="int32")
+        row_off, col_off = int(window.row_off), int(window.col_off)
+        dy = abs(ds.transform.e)
+        geographic = ds.crs is not None and ds.crs.is_geographic
+        if geographic:
+            dy *= METERS_PER_DEGREE
+        for block in block_windows(labels.shape[0], labels.shape[1], block_size):
+            rows = slice(int(block.row_off), int(block.row_off + block.height))
+            cols = slice(int(block.col_off), int(block.col_off + block.width))
+            block_labels = labels[rows, cols]
+            inside = block_labels > 0
+            if not inside.any():
+                continue
+            dem_window = Window(
+                col_off + block.col_off, row_off + block.row_off, block.width, block.height
+            )
+            raster_rows = np.arange(dem_window.row_off, dem_window.row_off + block.height)
+            dx = np.full(len(raster_rows), abs(ds.transform.a))
+            if geographic:
+                latitudes = ds.transform.f + ds.transform.e * (raster_rows + 0.5)
+                dx = dx * METERS_PER_DEGREE * np.cos(np.radians(latitudes))
+
+            heights = _read_with_halo(ds, dem_window)
+            slope, _ = slope_aspect(heights, dy, dx)
+            heights = heights[1:-1, 1:-1]
+
+            valid = inside & np.isfinite(heights)
+            elevation.add(block_labels[valid], heights[valid])
+            valid = inside & np.isfinite(slope)
+            slope_acc.add(block_labels[valid], slope[valid])
+            histogram += np.bincount(
+                np.minimum(slope[valid], SLOPE_HISTOGRAM_MAX).astype("int64"),
+                minlength=SLOPE_HISTOGRAM_MAX + 1,
+            )
+            if lc is not None:
+                classes = _land_cover_block(lc, ds, dem_window).astype("int64")
+                valid = inside & (classes > 0) & (classes < LAND_COVER_BINS)
+                land_cover_pixels += np.bincount(
+                    block_labels[valid] * LAND_COVER_BINS + classes[valid],
+                    minlength=len(land_cover_pixels),
+                )
+    finally:
+        ds.close()
+        if lc is not None:
+            lc.close()
+
+    # Label 0 is outside the sites
+    return {
+        "pixels": elevation.count[1:],
+        **{k: v[1:] for k, v in elevation.stats("elevation").items()},
+        **{
+            k: v[1:]
+            for k, v in slope_acc.stats("slope", ("mean", "max", "std")).items()
+        },
+        "land_cover": land_cover_pixels.reshape(n + 1, LAND_COVER_BINS)[1:],
+        "slope_histogram": histogram,
+    }
+
+
+def power_features(
+    storage, tags: Sequence[str] = SUBSTATION_TAGS
+) -> Optional[gpd.GeoDataFrame]:
+    """
+    Points and polygons of the power networks with some power tags.
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object where the data is saved
+    tags : sequence of str, optional
+        Values of the power tag to keep, by default substations
+
+    Returns
+    -------
+    GeoDataFrame or None
+        The features, in EPSG:4326, None if there are none
+    """
+    layers = []
+    for name in ("power_points", "power_polygons"):
+        layer = read_layer(storage, name)
+        if layer is not None and "power" in layer.columns:
+            layers.append(layer[layer["power"].isin(tags)])
+    layers = [layer for layer in layers if not layer.empty]
+    if not layers:
+        return None
+    return pd.concat([layer.to_crs("EPSG:4326") for layer in layers], ignore_index=True)
+
+
+def nearest_distances(
+    sites: gpd.GeoDataFrame, layer: Optional[gpd.GeoDataFrame], crs
+) -> np.ndarray:
+    """
+    Distance in meters from every site to the nearest feature of a layer.
+
+    Parameters
+    ----------
+    sites : GeoDataFrame
+        Sites, as returned by suitable_sites
+    layer : GeoDataFrame or None
+        Features to measure the distance to
+    crs : CRS
+        Metric CRS distances are measured in
+
+    Returns
+    -------
+    ndarray
+        Distances, 0 for sites touching a feature, NaN without features
+    """
+    distances = np.full(len(sites), np.nan)
+    if layer is None or layer.empty or sites.empty:
+        return distances
+    if layer.crs is None:
+        layer = layer.set_crs("EPSG:4326")
+    tree = shapely.STRtree(project_geometries(layer.geometry, crs))
+    (site_index, _), distance = tree.query_nearest(
+        project_geometries(sites.geometry, crs),
+        return_distance=True,
+        all_matches=False,
+    )
+    distances[site_index] = distance
+    return distances
+
+
+def _json_value(value):
+    value = float(value)
+    return None if math.isnan(value) else round(value, 3)
+
+
+def write_site_stats(
+    storage,
+    suitable_areas: Optional[gpd.GeoDataFrame],
+    block_size: int = DEFAULT_BLOCK_SIZE,
+) -> gpd.GeoDataFrame:
+    """
+    Compute the statistics of every suitable site and save them.
+
+    Sites are saved as the suitable_sites layer with their statistics as
+    columns, and suitable_areas_stats.json has them with the land cover
+    composition and slope distribution of all the sites, ready for charts.
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object where the data is saved
+    suitable_areas : GeoDataFrame or None
+        Suitable areas found by the pipeline
+    block_size : int, optional
+        Block side in pixels of the raster reads, by default 512
+
+    Returns
+    -------
+    GeoDataFrame
+        The sites with their statistics
+    """
+    logger.info("Computing site statistics...")
+    if suitable_areas is None:
+        suitable_areas = gpd.GeoDataFrame(geometry=[], crs="EPSG:4326")
+    sites = suitable_sites(suitable_areas)
+
+    terrain = None
+    if not sites.empty and storage.exists("dem.tif"):
+        terrain = zonal_terrain_stats(storage, sites, block_size=block_size)
+    elif not sites.empty:
+        logger.warning("dem.tif not found, terrain statistics skipped")
+
+    land_cover = {}
+    slope_histogram = []
+    if terrain is not None:
+        for column in (
+            "pixels",
+            "elevation_min",
+            "elevation_max",
+            "elevation_mean",
+            "elevation_std",
+            "slope_mean",
+            "slope_max",
+            "slope_std",
+        ):
+            sites[column] = terrain[column]
+        pixels = terrain["land_cover"]
+        totals = pixels.sum(axis=0)
+        classes = np.flatnonzero(totals)
+        shares = pixels[:, classes] / np.maximum(pixels.sum(axis=1), 1)[:, np.newaxis]
+        land_cover = {
+            "classes": classes,
+            "shares": shares,
+            "total": totals[classes] / max(totals.sum(), 1),
+        }
+        histogram = terrain["slope_histogram"]
+        slope_histogram = [
+            {"slope": int(degree), "fraction": float(count) / max(histogram.sum(), 1)}
+            for degree, count in enumerate(histogram)
+        ]
+
+    if not sites.empty:
+        metric_crs = local_metric_crs(sites)
+        sites["power_line_distance_m"] = nearest_distances(
+            sites, read_layer(storage, "power_lines"), metric_crs
+        )
+        sites["substation_distance_m"] = nearest_distances(
+            sites, power_features(storage), metric_crs
+        )
+
+    records = []
+    for i, site in enumerate(sites.drop(columns="geometry").to_dict("records")):
+        record = {
+            key: int(value) if key in ("site_id", "pixels") else _json_value(value)
+            for key, value in site.items()
+        }
+        if land_cover:
+            record["land_cover"] = {
+                str(code): round(float(share), 4)
+                for code, share in zip(land_cover["classes"], land_cover["shares"][i])
+                if share > 0
+            }
+        records.append(record)
+    total_area = float(sites["area_km2"].sum()) if len(sites) else 0.0
+    stats = {
+        "sites": records,
+        "summary": {
+            "sites": len(sites),
+            "area_km2": round(total_area, 2),
+            "land_cover": [
+                {
+                    "class": int(code),
+                    "name": LAND_COVER_CLASSES.get(int(code), str(code)),
+                    "fraction": round(float(fraction), 4),
+                    "area_km2": round(float(fraction) * total_area, 3),
+                }
+                for code, fraction in zip(
+                    land_cover.get("classes", []), land_cover.get("total", [])
+                )
+            ],
+            "slope_histogram": slope_histogram,
+        },
+    }
+
+    if not sites.empty:
+        write_layer(storage, sites, SITES_LAYER)
+    else:
+        # Sites of an earlier run would be ranked and served again
+        delete_layer(storage, SITES_LAYER)
+    storage.create(json.dumps(stats), SITE_STATS)
+    logger.info("Statistics of %d sites saved", len(sites))
+    return sites
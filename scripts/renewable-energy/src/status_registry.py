@@ -4,14 +4,18 @@ from __future__ import annotations
 
 import json
 import logging
+import os
+import tempfile
 from datetime import datetime, timezone
-from typing import Any
+from typing import Any, List, Optional
 
 import pandas as pd
 
 logger = logging.getLogger(__name__)
 
 STATUS_PATH = "pipeline_status.json"
+STAGES_PATH = "pipeline_stages.json"
+MANIFEST_PATH = "pipeline_manifest.json"
 
 IDLE = "Idle"
 BUILDING = "Building"
@@ -40,23 +44,77 @@ def _row_to_status(df: pd.DataFrame) -> dict:
     return out
 
 
-def set_status(storage: Any, status: str, message: str) -> None:
-    """Overwrite pipeline status as a records JSON list (readable by storage.read)."""
+def _write_status(storage: Any, body: str, name: str = STATUS_PATH) -> None:
+    """Replace a status file with a single write, atomically on local storage."""
+    path = getattr(storage, "path", None)
+    if path is None or not os.path.isdir(path):
+        # A PUT replaces the whole object on S3, readers never see it missing
+        storage.create(body, name)
+        return
+    dst = os.path.join(path, name)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dst), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(body)
+        os.replace(tmp, dst)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def set_status(
+    storage: Any, status: str, message: str, skipped: Optional[List[str]] = None
+) -> None:
+    """Overwrite pipeline status as a records JSON list (readable by storage.read).
+
+    The stages skipped because their inputs didn't change are listed when given.
+    """
     payload = {
         "status": status,
         "message": message,
         "updated_at": datetime.now(timezone.utc).isoformat(),
     }
+    if skipped is not None:
+        payload["skipped"] = list(skipped)
     body = json.dumps([payload], ensure_ascii=False)
     try:
-        if storage.exists(STATUS_PATH):
-            storage.delete(STATUS_PATH)
-        storage.create(body, STATUS_PATH)
+        _write_status(storage, body)
         logger.info("Pipeline status: %s — %s", status, message)
     except Exception as exc:
         logger.warning("Failed to write pipeline status: %s", exc)
 
 
+def set_stages(storage: Any, records: list) -> None:
+    """Overwrite the stage records of the run, next to the pipeline status."""
+    body = json.dumps(records, ensure_ascii=False)
+    try:
+        _write_status(storage, body, STAGES_PATH)
+    except Exception as exc:
+        logger.warning("Failed to write pipeline stages: %s", exc)
+
+
+def set_manifest(storage: Any, manifest: dict) -> None:
+    """Overwrite the input fingerprints of the last completed run of every stage."""
+    body = json.dumps(manifest, ensure_ascii=False)
+    try:
+        _write_status(storage, body, MANIFEST_PATH)
+    except Exception as exc:
+        logger.warning("Failed to write pipeline manifest: %s", exc)
+
+
+def get_manifest(storage: Any) -> dict:
+    """Read the stage fingerprints, empty if there are none or they're unreadable."""
+    if not storage.exists(MANIFEST_PATH):
+        return {}
+    try:
+        data = storage.read_file(MANIFEST_PATH)
+        return json.loads(data if isinstance(data, str) else data.read())
+    except Exception as exc:
+        logger.warning("Failed to read pipeline manifest: %s", exc)
+        return {}
+
+
 def get_status(storage: Any) -> dict:
     """Read the current pipeline status from storage (pandas → dict)."""
     if not storage.exists(STATUS_PATH):
@@ -1,15 +1,124 @@
 import logging
 import geopandas as gpd
+import numpy as np
 import pandas as pd
-from .utilities import create_buffer
+import shapely
+from pyproj import CRS
+from shapely import STRtree
+from typing import Any, Callable, List, Optional
+from .downloads import PIPELINES_LAYER
+from .instrumentation import stage
+from .raster_suitability import raster_suitable_areas
+from .terrain import (
+    DEFAULT_BLOCK_SIZE,
+    TerrainCriteria,
+    exclusion_polygons,
+    screen_terrain,
+)
+from .tiling import needs_tiling, tiled_suitable_areas
+from .utilities import (
+    BUFFER_QUAD_SEGS,
+    buffer_layers,
+    default_storage,
+    local_metric_crs,
+    project_geometries,
+    unproject_geometries,
+)
+from .vector_io import read_layer, write_layer
 
 logger = logging.getLogger(__name__)
 
-def find_suitable_areas(storage, aoi_gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+ENGINES = ("overlay", "strtree", "raster")
+INFRASTRUCTURE_BUFFER = 500
+UNION_CHUNK_SIZE = 1024
+# Relative margin on the candidate search distance, so that features right
+# at the buffer distance are never missed because of reprojection round-offs
+_CANDIDATE_MARGIN = 0.01
+
+# Margin of the layer reads around the AOI, relative to the buffer distance
+_BBOX_MARGIN = 2.0
+METERS_PER_DEGREE = 111319.49
+# Latitude the longitude margin of the reads is computed at, at most
+_MAX_BBOX_LATITUDE = 89.0
+
+_POLYGON_TYPES = (shapely.GeometryType.POLYGON, shapely.GeometryType.MULTIPOLYGON)
+
+
+def load_layers(storage, bbox: Optional[tuple] = None) -> tuple:
+    """
+    Load the layers used to find suitable areas, in EPSG:4326
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object where the data is saved
+    bbox : tuple, optional
+        Only load the features intersecting minx, miny, maxx, maxy, in
+        EPSG:4326. By default the whole layers.
+
+    Returns
+    -------
+    tuple
+        (protected_areas, roads, power_networks, pipelines), None for missing layers
+    """
+    layers = []
+    for name in ("protected_areas", "roads", "power_lines", PIPELINES_LAYER):
+        layer = read_layer(storage, name, bbox=bbox)
+        if layer is not None:
+            if layer.crs is None:
+                layer = layer.set_crs("EPSG:4326")
+            elif layer.crs != "EPSG:4326":
+                layer = layer.to_crs("EPSG:4326")
+        layers.append(layer)
+    return tuple(layers)
+
+
+def search_bbox(
+    aoi_gdf: gpd.GeoDataFrame, buffer_size: int = INFRASTRUCTURE_BUFFER
+) -> tuple:
+    """
+    Bounds of the features that can change the suitable areas of an AOI
+
+    Parameters
+    ----------
+    aoi_gdf : GeoDataFrame
+        GeoDataFrame with the area of interest
+    buffer_size : int, optional
+        Maximum distance to infrastructure in meters, by default 500
+
+    Returns
+    -------
+    tuple
+        minx, miny, maxx, maxy in EPSG:4326, grown by the buffer distance
+    """
+    aoi = aoi_gdf if aoi_gdf.crs is not None else aoi_gdf.set_crs("EPSG:4326")
+    minx, miny, maxx, maxy = aoi.to_crs("EPSG:4326").total_bounds
+    # Buffers are true distances: a degree of longitude shrinks with latitude
+    margin = buffer_size * _BBOX_MARGIN / METERS_PER_DEGREE
+    max_lat = min(max(abs(miny), abs(maxy)) + margin, _MAX_BBOX_LATITUDE)
+    margin_x = margin / np.cos(np.radians(max_lat))
+    return (
+        max(minx - margin_x, -180.0),
+        max(miny - margin, -90.0),
+        min(maxx + margin_x, 180.0),
+        min(maxy + margin, 90.0),
+    )
+
+
+def find_suitable_areas(
+    storage,
+    aoi_gdf: gpd.GeoDataFrame,
+    engine: Optional[str] = "overlay",
+    terrain: Optional[TerrainCriteria] = None,
+    tile_size: Optional[float] = None,
+    max_workers: Optional[int] = None,
+    storage_factory: Callable[[], Any] = default_storage,
+) -> gpd.GeoDataFrame:
     """
     Finds suitable areas within AOI that are:
     - NOT within protected areas
     - Within 500m of relevant infrastructure (roads, power networks)
+    - NOT too steep or on excluded land cover, if terrain criteria are given
 
     Parameters
     ----------
@@ -17,62 +126,438 @@ def find_suitable_areas(storage, aoi_gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
         Storage object where the data is saved
     aoi_gdf : GeoDataFrame
         GeoDataFrame with the area of interest
+    engine : str, optional
+        "overlay" buffers, dissolves and overlays whole layers. "strtree" only
+        processes the features near the AOI, found with a spatial index, and
+        produces the same output. "raster" uses distance transforms on the DEM
+        grid and also saves a suitable_areas.tif mask. By default "overlay".
+    terrain : TerrainCriteria, optional
+        Slope and land cover thresholds, computed from dem.tif and
+        land_cover.tif. By default None, no terrain criteria.
+    tile_size : float, optional
+        Side in meters of the tiles AOIs larger than a tile are split into, for
+        the vector engines. Tiles run in parallel and are stitched at the
+        seams. By default None, no tiling.
+    max_workers : int, optional
+        Number of processes used for the tiles, by default the number of CPUs
+    storage_factory : callable, optional
+        Creates the storage the tiles read their layers from in the worker
+        processes, by default the project data storage
 
     Returns
     -------
     GeoDataFrame
         Areas that meet the criteria
     """
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown suitability engine '{engine}', use one of {ENGINES}")
     logger.info("Finding suitable areas...")
-    # Load all required layers
-    protected_areas, roads, power_networks, pipelines = None, None, None, None
-    if storage.exists("protected_areas.geojson"):
-        protected_areas = storage.read("protected_areas.geojson")
-    if storage.exists("roads.geojson"):
-        roads = storage.read("roads.geojson")
-    if storage.exists("power_lines.geojson"):
-        power_networks = storage.read("power_lines.geojson")
-    if storage.exists("pipelines.geojson"):
-        pipelines = storage.read("pipelines.geojson")
-
-    # Ensure all layers are in the same CRS
-    layers = [protected_areas, roads, power_networks, pipelines]
-    for layer in layers:
-        if layer is not None:
-            if layer.crs is None:
-                layer = layer.set_crs("EPSG:4326")
-            elif layer.crs != "EPSG:4326":
-                layer = layer.to_crs("EPSG:4326")
+    # Every tile buffers in the CRS of the whole AOI, so they match at the seams
+    metric_crs = local_metric_crs(aoi_gdf)
+    # Tiles read the features around them, the whole layers are never loaded
+    tiled = engine != "raster" and needs_tiling(aoi_gdf, tile_size, metric_crs)
+    if not tiled:
+        with stage("load_layers") as record:
+            # Features far from the AOI can't change the result, skip them
+            protected_areas, roads, power_networks, pipelines = load_layers(
+                storage, bbox=search_bbox(aoi_gdf)
+            )
+            infrastructure_layers = [roads, power_networks, pipelines]
+            record.features = sum(
+                len(layer)
+                for layer in (protected_areas, *infrastructure_layers)
+                if layer is not None
+            )
+
+    exclusion = None
+    if terrain is not None:
+        if storage.exists("dem.tif"):
+            with stage("terrain_screening"):
+                exclusion = screen_terrain(storage, terrain)
+        else:
+            logger.warning("dem.tif not found, terrain criteria skipped")
+
+    vector_engine = (
+        strtree_suitable_areas if engine == "strtree" else overlay_suitable_areas
+    )
+    if engine == "raster":
+        with stage("raster") as record:
+            suitable_areas = raster_suitable_areas(
+                storage,
+                aoi_gdf,
+                protected_areas,
+                infrastructure_layers,
+                exclusion=exclusion,
+            )
+            record.features = len(suitable_areas)
+    elif tiled:
+        with stage("tiled") as record:
+            suitable_areas = tiled_suitable_areas(
+                vector_engine,
+                load_layers,
+                storage,
+                aoi_gdf,
+                INFRASTRUCTURE_BUFFER,
+                tile_size=tile_size,
+                max_workers=max_workers,
+                metric_crs=metric_crs,
+                storage_factory=storage_factory,
+            )
+            record.features = len(suitable_areas)
+    else:
+        suitable_areas = vector_engine(
+            aoi_gdf,
+            protected_areas,
+            infrastructure_layers,
+            metric_crs=metric_crs,
+        )
+
+    if exclusion is not None and engine != "raster" and not suitable_areas.empty:
+        with stage("terrain_exclusion") as record:
+            suitable_areas = subtract_exclusion(
+                storage, suitable_areas, exclusion, terrain.block_size
+            )
+            record.features = len(suitable_areas)
+
+    if not suitable_areas.empty:
+        write_layer(storage, suitable_areas, "suitable_areas")
+
+    logger.info("Suitable areas found successfully")
+    return suitable_areas
+
+
+def subtract_exclusion(
+    storage,
+    suitable_areas: gpd.GeoDataFrame,
+    exclusion: str,
+    block_size: int = DEFAULT_BLOCK_SIZE,
+) -> gpd.GeoDataFrame:
+    """
+    Remove the excluded terrain from suitable areas
+
+    Only the excluded pixels the suitable areas touch are polygonized, so the
+    cost follows the size of the result, not of the exclusion raster. The
+    polygons are subtracted as two multipolygons, one per block parity,
+    without unioning them.
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object where the data is saved
+    suitable_areas : GeoDataFrame
+        Suitable areas of a vector engine
+    exclusion : str
+        Exclusion mask raster
+    block_size : int, optional
+        Block side in pixels the mask is polygonized in, by default 512
+
+    Returns
+    -------
+    GeoDataFrame
+        The suitable areas outside the excluded terrain
+    """
+    excluded = exclusion_polygons(storage, exclusion, block_size, within=suitable_areas)
+    if excluded.empty:
+        return suitable_areas
+    excluded = excluded.to_crs(suitable_areas.crs)
+    geometries = suitable_areas.geometry.to_numpy()
+    for _, parity in excluded.groupby("parity"):
+        geometries = shapely.difference(
+            geometries, shapely.multipolygons(parity.geometry.to_numpy())
+        )
+    geometries = _polygonal(geometries)
+    keep = ~(shapely.is_missing(geometries) | shapely.is_empty(geometries))
+    suitable_areas = suitable_areas[keep].copy()
+    suitable_areas[suitable_areas.geometry.name] = geometries[keep]
+    return suitable_areas.reset_index(drop=True)
+
+
+def overlay_suitable_areas(
+    aoi_gdf: gpd.GeoDataFrame,
+    protected_areas: Optional[gpd.GeoDataFrame],
+    infrastructure_layers: List[Optional[gpd.GeoDataFrame]],
+    buffer_size: int = INFRASTRUCTURE_BUFFER,
+    metric_crs: Optional[CRS] = None,
+) -> gpd.GeoDataFrame:
+    """
+    Suitable areas computed with whole-layer buffers, dissolve and overlays
 
+    Parameters
+    ----------
+    aoi_gdf : GeoDataFrame
+        GeoDataFrame with the area of interest
+    protected_areas : GeoDataFrame or None
+        Areas to exclude
+    infrastructure_layers : list of GeoDataFrame or None
+        Layers the suitable areas must be close to
+    buffer_size : int, optional
+        Maximum distance to infrastructure in meters, by default 500
+    metric_crs : CRS, optional
+        CRS the buffers are computed in, by default the local_metric_crs of
+        the AOI
+
+    Returns
+    -------
+    GeoDataFrame
+        Areas that meet the criteria
+    """
+    if metric_crs is None:
+        metric_crs = local_metric_crs(aoi_gdf)
     # Create infrastructure buffer (500m)
-    infrastructure_layers = [roads, power_networks, pipelines]
     infrastructure_buffer = gpd.GeoDataFrame(geometry=[], crs=aoi_gdf.crs)
 
-    for layer in infrastructure_layers:
-        if layer is not None and not layer.empty:
-            buffer = create_buffer(layer, 500)
-            infrastructure_buffer = pd.concat([infrastructure_buffer, buffer])
+    with stage("overlay/buffer") as record:
+        layers = [
+            layer
+            for layer in infrastructure_layers
+            if layer is not None and not layer.empty
+        ]
+        if layers:
+            infrastructure_buffer = pd.concat(
+                [
+                    infrastructure_buffer,
+                    *buffer_layers(layers, buffer_size, crs=metric_crs),
+                ]
+            )
+        record.features = len(infrastructure_buffer)
 
     # Dissolve all infrastructure buffers into a single polygon
     if not infrastructure_buffer.empty:
-        infrastructure_buffer = infrastructure_buffer.dissolve()
+        with stage("overlay/dissolve"):
+            infrastructure_buffer = infrastructure_buffer.dissolve()
 
     # Find areas that are NOT protected
-    if not protected_areas.empty:
-        non_protected = aoi_gdf.overlay(protected_areas, how="difference")
+    if protected_areas is not None and not protected_areas.empty:
+        with stage("overlay/difference") as record:
+            non_protected = aoi_gdf.overlay(protected_areas, how="difference")
+            record.features = len(non_protected)
     else:
         non_protected = aoi_gdf
 
     # Find intersection with infrastructure buffer
     if not infrastructure_buffer.empty:
-        suitable_areas = non_protected.overlay(
-            infrastructure_buffer, how="intersection"
-        )
+        with stage("overlay/intersection") as record:
+            suitable_areas = non_protected.overlay(
+                infrastructure_buffer, how="intersection"
+            )
+            record.features = len(suitable_areas)
     else:
         suitable_areas = gpd.GeoDataFrame(geometry=[], crs=aoi_gdf.crs)
+    return suitable_areas
 
-    if not suitable_areas.empty:
-        storage.create(suitable_areas, "suitable_areas.geojson")
 
-    logger.info("Suitable areas found successfully")
-    return suitable_areas
\ No newline at end of file
+def _polygonal(geometries: np.ndarray) -> np.ndarray:
+    """Repair polygonal results and drop non-polygonal parts, like overlay does."""
+    geometries = geometries.copy()
+    types = shapely.get_type_id(geometries)
+    polygons = np.isin(types, _POLYGON_TYPES)
+    geometries[polygons] = shapely.make_valid(geometries[polygons])
+    for i in np.flatnonzero(types == shapely.GeometryType.GEOMETRYCOLLECTION):
+        parts = shapely.get_parts(geometries[i])
+        parts = parts[np.isin(shapely.get_type_id(parts), _POLYGON_TYPES)]
+        geometries[i] = shapely.union_all(parts) if len(parts) else None
+    keep = np.isin(shapely.get_type_id(geometries), _POLYGON_TYPES)
+    geometries[~keep] = None
+    return geometries
+
+
+def _valid_polygons(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """Repair invalid input polygons, like overlay does before computing."""
+    invalid = ~gdf.geometry.is_valid
+    if not invalid.any():
+        return gdf
+    gdf = gdf.copy()
+    gdf.loc[invalid, gdf.geometry.name] = _polygonal(
+        gdf.geometry[invalid].to_numpy()
+    )
+    return gdf[gdf.geometry.notna()]
+
+
+def union_chunks(
+    geometries: np.ndarray, chunk_size: int = UNION_CHUNK_SIZE
+) -> shapely.Geometry:
+    """
+    Union geometries in chunks, to bound the size of every GEOS union.
+
+    Parameters
+    ----------
+    geometries : ndarray
+        Geometries to union
+    chunk_size : int, optional
+        Geometries per union, by default 1024
+
+    Returns
+    -------
+    Geometry
+        The union of all geometries
+    """
+    if len(geometries) == 0:
+        return shapely.Polygon()
+    while len(geometries) > 1:
+        geometries = np.array(
+            [
+                shapely.union_all(geometries[i : i + chunk_size])
+                for i in range(0, len(geometries), chunk_size)
+            ],
+            dtype=object,
+        )
+    return geometries[0]
+
+
+def dissolved_attributes(
+    infrastructure_layers: List[Optional[gpd.GeoDataFrame]],
+) -> pd.DataFrame:
+    """
+    Attributes of the dissolved infrastructure buffer, aggregated like dissolve() does.
+
+    Parameters
+    ----------
+    infrastructure_layers : list of GeoDataFrame or None
+        Layers the suitable areas must be close to
+
+    Returns
+    -------
+    DataFrame
+        Single row with the first non-null value of every attribute
+    """
+    attributes = pd.concat(
+        [
+            pd.DataFrame(layer.drop(columns=layer.geometry.name))
+            for layer in infrastructure_layers
+            if layer is not None and not layer.empty
+        ]
+    )
+    return attributes.groupby(np.zeros(len(attributes), dtype="int64")).first()
+
+
+def _buffer_candidates(
+    layer: gpd.GeoDataFrame,
+    targets: np.ndarray,
+    buffer_size: int,
+    metric_crs: CRS,
+) -> np.ndarray:
+    """Buffer, like buffer_layers does, only the features near the targets."""
+    geometries = project_geometries(layer.geometry, metric_crs)
+    tree = STRtree(geometries)
+    _, candidates = tree.query(
+        targets,
+        predicate="dwithin",
+        distance=buffer_size * (1 + _CANDIDATE_MARGIN),
+    )
+    candidates = np.unique(candidates)
+    buffers = shapely.buffer(
+        geometries[candidates], buffer_size, quad_segs=BUFFER_QUAD_SEGS
+    )
+    return unproject_geometries(buffers, metric_crs)
+
+
+def strtree_suitable_areas(
+    aoi_gdf: gpd.GeoDataFrame,
+    protected_areas: Optional[gpd.GeoDataFrame],
+    infrastructure_layers: List[Optional[gpd.GeoDataFrame]],
+    buffer_size: int = INFRASTRUCTURE_BUFFER,
+    chunk_size: int = UNION_CHUNK_SIZE,
+    metric_crs: Optional[CRS] = None,
+) -> gpd.GeoDataFrame:
+    """
+    Suitable areas computed on the features near the AOI only.
+
+    Protected areas and infrastructure are filtered with STRtree queries against
+    the AOI, candidate buffers are computed and unioned in vectorized chunks, and
+    the set algebra runs on those candidates. The output matches overlay_suitable_areas.
+
+    Parameters
+    ----------
+    aoi_gdf : GeoDataFrame
+        GeoDataFrame with the area of interest
+    protected_areas : GeoDataFrame or None
+        Areas to exclude
+    infrastructure_layers : list of GeoDataFrame or None
+        Layers the suitable areas must be close to
+    buffer_size : int, optional
+        Maximum distance to infrastructure in meters, by default 500
+    chunk_size : int, optional
+        Buffers per union, by default 1024
+    metric_crs : CRS, optional
+        CRS the buffers are computed in, by default the local_metric_crs of
+        the AOI
+
+    Returns
+    -------
+    GeoDataFrame
+        Areas that meet the criteria
+    """
+    infrastructure_layers = [
+        layer for layer in infrastructure_layers if layer is not None and not layer.empty
+    ]
+    if not infrastructure_layers:
+        return gpd.GeoDataFrame(geometry=[], crs=aoi_gdf.crs)
+    if metric_crs is None:
+        metric_crs = local_metric_crs(aoi_gdf)
+
+    # Find areas that are NOT protected
+    non_protected = aoi_gdf
+    if protected_areas is not None and not protected_areas.empty:
+        with stage("strtree/difference") as record:
+            non_protected = _strtree_difference(aoi_gdf, protected_areas)
+            record.features = len(non_protected)
+
+    # Union the buffers of the infrastructure near the non protected areas
+    with stage("strtree/buffer") as record:
+        targets = non_protected.geometry
+        if targets.crs is None:
+            targets = targets.set_crs("EPSG:4326")
+        targets = project_geometries(targets, metric_crs)
+        buffers = np.concatenate(
+            [
+                _buffer_candidates(layer, targets, buffer_size, metric_crs)
+                for layer in infrastructure_layers
+            ]
+        )
+        record.features = len(buffers)
+    with stage("strtree/union"):
+        infrastructure_union = union_chunks(buffers, chunk_size)
+
+    attributes = dissolved_attributes(infrastructure_layers)
+
+    # Find intersection with infrastructure buffer
+    with stage("strtree/intersection") as record:
+        non_protected = _valid_polygons(non_protected).reset_index(drop=True)
+        geometries = shapely.intersection(
+            non_protected.geometry.to_numpy(), infrastructure_union
+        )
+        geometries = _polygonal(geometries)
+        keep = ~shapely.is_empty(geometries) & ~shapely.is_missing(geometries)
+        record.features = int(keep.sum())
+
+    suitable_areas = (
+        pd.DataFrame(non_protected.drop(columns=non_protected.geometry.name))[keep]
+        .reset_index(drop=True)
+        .merge(attributes.reset_index(drop=True), how="cross", suffixes=("_1", "_2"))
+    )
+    return gpd.GeoDataFrame(
+        suitable_areas, geometry=geometries[keep], crs=aoi_gdf.crs
+    ).reset_index(drop=True)
+
+
+def _strtree_difference(
+    aoi_gdf: gpd.GeoDataFrame, protected_areas: gpd.GeoDataFrame
+) -> gpd.GeoDataFrame:
+    """AOI minus the protected areas intersecting it, found with a spatial index."""
+    aoi = _valid_polygons(aoi_gdf)
+    protected = _valid_polygons(protected_areas).to_crs(aoi.crs)
+    protected_geometries = protected.geometry.to_numpy()
+    idx_aoi, idx_protected = STRtree(protected_geometries).query(
+        aoi.geometry.to_numpy(), predicate="intersects"
+    )
+    geometries = aoi.geometry.to_numpy().copy()
+    for i in np.unique(idx_aoi):
+        geometries[i] = shapely.difference(
+            geometries[i],
+            shapely.union_all(protected_geometries[idx_protected[idx_aoi == i]]),
+        )
+    geometries = _polygonal(geometries)
+    keep = ~shapely.is_empty(geometries) & ~shapely.is_missing(geometries)
+    non_protected = aoi[keep].copy()
+    non_protected[non_protected.geometry.name] = geometries[keep]
+    return non_protected.reset_index(drop=True)
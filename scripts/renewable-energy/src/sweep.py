@@ -0,0 +1,181 @@
+"""Suitable area and site count over a range of infrastructure distances."""
+
+import json
+import logging
+import math
+from typing import List, Optional, Sequence
+
+import geopandas as gpd
+import numpy as np
+from affine import Affine
+from scipy import ndimage
+
+from .downloads import DOWNLOAD_BUFFER
+from .raster_suitability import (
+    METERS_PER_DEGREE,
+    distance_to,
+    padded_grid,
+    pixel_size_m,
+    rasterize_layers,
+    vectorize_mask,
+)
+from .suitable_areas import load_layers, search_bbox
+from .utilities import local_metric_crs
+from .vector_io import delete_layer, write_layer
+
+logger = logging.getLogger(__name__)
+
+SWEEP_TABLE = "suitable_areas_sweep.json"
+# Pixel size of the sweep grid when there is no DEM to take it from
+DEFAULT_SWEEP_RESOLUTION = 30.0
+
+
+def sweep_layer(distance: float) -> str:
+    """Name of the suitable areas layer of a distance"""
+    return f"suitable_areas_{distance:g}m"
+
+
+def _metric_grid(aoi_gdf: gpd.GeoDataFrame, resolution: float) -> tuple:
+    """Grid covering the AOI in its local metric CRS"""
+    crs = local_metric_crs(aoi_gdf)
+    minx, miny, maxx, maxy = aoi_gdf.to_crs(crs).total_bounds
+    shape = (
+        max(math.ceil((maxy - miny) / resolution), 1),
+        max(math.ceil((maxx - minx) / resolution), 1),
+    )
+    return Affine(resolution, 0, minx, 0, -resolution, maxy), crs, shape
+
+
+def _row_areas(transform: Affine, crs, height: int) -> np.ndarray:
+    """Area in square meters of the pixels of every row of a grid"""
+    dy, dx = abs(transform.e), abs(transform.a)
+    if crs is not None and crs.is_geographic:
+        latitudes = transform.f + transform.e * (np.arange(height) + 0.5)
+        return (
+            dy * METERS_PER_DEGREE * dx * METERS_PER_DEGREE * np.cos(np.radians(latitudes))
+        )
+    return np.full(height, dy * dx)
+
+
+def threshold_sweep(
+    storage,
+    aoi_gdf: gpd.GeoDataFrame,
+    distances: Sequence[float],
+    exclusion: Optional[str] = None,
+    reference: str = "dem.tif",
+    resolution: float = DEFAULT_SWEEP_RESOLUTION,
+) -> List[dict]:
+    """
+    Suitable areas for several infrastructure distances, from one distance field.
+
+    Infrastructure is rasterized once and a single Euclidean distance
+    transform gives the distance of every pixel to it, like the raster
+    engine does. Every distance is then a threshold of the same field: the
+    areas of all of them come from one weighted histogram of the suitable
+    pixels, and only the site count and the polygons are computed per
+    distance.
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object where the data is saved
+    aoi_gdf : GeoDataFrame
+        GeoDataFrame with the area of interest
+    distances : sequence of float
+        Maximum distances to infrastructure in meters
+    exclusion : str, optional
+        Mask raster on the reference grid with extra areas to exclude, by
+        default None
+    reference : str, optional
+        Raster whose grid is used, by default "dem.tif". Without it, a grid in
+        the local metric CRS of the AOI is used.
+    resolution : float, optional
+        Pixel size in meters of that grid, by default 30
+
+    Returns
+    -------
+    list of dict
+        distance_m, area_km2, sites and layer of every distance, by
+        increasing distance. Also saved as suitable_areas_sweep.json, and the
+        suitable areas of every distance as a suitable_areas_<distance>m layer.
+    """
+    distances = sorted({float(distance) for distance in distances})
+    if not distances or distances[0] <= 0:
+        raise ValueError("Sweep distances must be positive")
+    if distances[-1] > DOWNLOAD_BUFFER:
+        logger.warning(
+            "Infrastructure is downloaded up to %d m from the AOI, sweep distances "
+            "beyond it can miss some",
+            DOWNLOAD_BUFFER,
+        )
+    if aoi_gdf.crs is None:
+        aoi_gdf = aoi_gdf.set_crs("EPSG:4326")
+    logger.info("Sweeping %d infrastructure distances...", len(distances))
+    protected_areas, roads, power_networks, pipelines = load_layers(
+        storage, bbox=search_bbox(aoi_gdf, distances[-1])
+    )
+
+    if storage.exists(reference):
+        ds = storage.read(reference)
+        transform, crs, shape = ds.transform, ds.crs, (ds.height, ds.width)
+        ds.close()
+    else:
+        logger.warning("%s not found, sweeping on a %g m grid", reference, resolution)
+        transform, crs, shape = _metric_grid(aoi_gdf, resolution)
+        exclusion = None
+    sampling = pixel_size_m(transform, crs, shape[0])
+    pad = math.ceil(distances[-1] / min(sampling)) + 1
+    transform, shape = padded_grid(transform, shape, pad)
+
+    infrastructure = rasterize_layers(
+        [roads, power_networks, pipelines], transform, shape, crs
+    )
+    distance = distance_to(infrastructure, sampling)
+    del infrastructure
+    protected = rasterize_layers([protected_areas], transform, shape, crs)
+    candidate = rasterize_layers([aoi_gdf], transform, shape, crs, all_touched=False)
+    candidate &= ~protected
+    del protected
+    if exclusion is not None and storage.exists(exclusion):
+        excluded = storage.read(exclusion)
+        candidate[pad:-pad, pad:-pad] &= ~excluded.read(1).astype(bool)
+        excluded.close()
+
+    # Pixels of every distance are those of the smaller ones plus a ring: the
+    # areas are the cumulative histogram of the candidate pixel distances
+    rows, cols = np.nonzero(candidate)
+    bins = np.searchsorted(distances, distance[rows, cols], side="left")
+    areas = np.cumsum(
+        np.bincount(
+            bins,
+            weights=_row_areas(transform, crs, shape[0])[rows],
+            minlength=len(distances) + 1,
+        )[: len(distances)]
+    )
+    del rows, cols, bins
+
+    table = []
+    connectivity = np.ones((3, 3), dtype=bool)
+    for threshold, area in zip(distances, areas):
+        suitable = candidate & (distance <= threshold)
+        _, sites = ndimage.label(suitable, structure=connectivity)
+        layer = sweep_layer(threshold)
+        if sites:
+            polygons = vectorize_mask(suitable, transform, crs).to_crs("EPSG:4326")
+            polygons["distance_m"] = threshold
+            write_layer(storage, polygons, layer)
+        else:
+            delete_layer(storage, layer)
+        table.append(
+            {
+                "distance_m": threshold,
+                "area_km2": round(float(area) / 1e6, 2),
+                "sites": int(sites),
+                "layer": layer if sites else None,
+            }
+        )
+        logger.info(
+            "%g m: %.2f km2 in %d sites", threshold, table[-1]["area_km2"], sites
+        )
+    storage.create(json.dumps(table), SWEEP_TABLE)
+    return table
@@ -0,0 +1,355 @@
+"""Slope, aspect and land-cover screening criteria computed in raster blocks."""
+
+import logging
+import os
+import tempfile
+from dataclasses import dataclass, field
+from typing import Iterator, List, Optional
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+import shapely
+from affine import Affine
+from rasterio import features
+from rasterio.enums import Resampling
+from rasterio.windows import Window, from_bounds
+
+from .raster_suitability import METERS_PER_DEGREE
+
+logger = logging.getLogger(__name__)
+
+SLOPE_RASTER = "slope.tif"
+ASPECT_RASTER = "aspect.tif"
+EXCLUSION_RASTER = "terrain_exclusion.tif"
+
+DEFAULT_BLOCK_SIZE = 512
+DEFAULT_MAX_SLOPE = 15.0
+# ESA WorldCover classes: tree cover, built-up, snow and ice, permanent water
+# bodies, herbaceous wetland and mangroves
+DEFAULT_EXCLUDED_LAND_COVER = [10, 50, 70, 80, 90, 95]
+
+SLOPE_NODATA = -9999.0
+FLAT_ASPECT = -1.0
+
+
+@dataclass
+class TerrainCriteria:
+    """Thresholds of the terrain screening."""
+
+    max_slope: float = DEFAULT_MAX_SLOPE
+    excluded_land_cover: List[int] = field(
+        default_factory=lambda: list(DEFAULT_EXCLUDED_LAND_COVER)
+    )
+    max_north_slope: Optional[float] = None
+    block_size: int = DEFAULT_BLOCK_SIZE
+
+    @classmethod
+    def from_vars(cls, vars) -> "TerrainCriteria":
+        """
+        Read the criteria from SPAIVars, falling back to the defaults.
+
+        Parameters
+        ----------
+        vars : SPAIVars
+            Project variables. Uses MAX_SLOPE, EXCLUDED_LAND_COVER,
+            MAX_NORTH_SLOPE and TERRAIN_BLOCK_SIZE.
+
+        Returns
+        -------
+        TerrainCriteria
+            The screening thresholds
+        """
+        criteria = cls()
+        if vars["MAX_SLOPE"] is not None:
+            criteria.max_slope = float(vars["MAX_SLOPE"])
+        if vars["EXCLUDED_LAND_COVER"] is not None:
+            criteria.excluded_land_cover = [int(c) for c in vars["EXCLUDED_LAND_COVER"]]
+        if vars["MAX_NORTH_SLOPE"] is not None:
+            criteria.max_north_slope = float(vars["MAX_NORTH_SLOPE"])
+        if vars["TERRAIN_BLOCK_SIZE"]:
+            criteria.block_size = int(vars["TERRAIN_BLOCK_SIZE"])
+        return criteria
+
+
+def block_windows(height: int, width: int, size: int) -> Iterator[Window]:
+    """
+    Split a raster into square block windows.
+
+    Parameters
+    ----------
+    height : int
+        Raster rows
+    width : int
+        Raster columns
+    size : int
+        Block side in pixels
+
+    Yields
+    ------
+    Window
+        Block window, smaller at the right and bottom edges
+    """
+    for row in range(0, height, size):
+        for col in range(0, width, size):
+            yield Window(col, row, min(size, width - col), min(size, height - row))
+
+
+def _read_with_halo(ds, window: Window) -> np.ndarray:
+    """Read a block with a one pixel halo, replicating the raster edges."""
+    row0, col0 = int(window.row_off), int(window.col_off)
+    row1, col1 = row0 + int(window.height), col0 + int(window.width)
+    top, left = max(row0 - 1, 0), max(col0 - 1, 0)
+    bottom, right = min(row1 + 1, ds.height), min(col1 + 1, ds.width)
+    data = ds.read(
+        1, window=Window(left, top, right - left, bottom - top), masked=True
+    ).astype("float64")
+    data = data.filled(np.nan)
+    pad = (
+        (int(row0 == top), int(row1 == bottom)),
+        (int(col0 == left), int(col1 == right)),
+    )
+    return np.pad(data, pad, mode="edge")
+
+
+def slope_aspect(
+    elevation: np.ndarray, dy: float, dx: np.ndarray
+) -> tuple:
+    """
+    Slope and aspect in degrees of a block read with a one pixel halo.
+
+    Parameters
+    ----------
+    elevation : ndarray
+        Elevations of the block plus a one pixel halo
+    dy : float
+        Row spacing in meters
+    dx : ndarray
+        Column spacing in meters of every block row
+
+    Returns
+    -------
+    tuple
+        (slope, aspect) arrays the size of the block. Aspect is clockwise from
+        north, FLAT_ASPECT where the terrain is flat.
+    """
+    dz_east = (elevation[1:-1, 2:] - elevation[1:-1, :-2]) / (2 * dx[:, np.newaxis])
+    dz_north = (elevation[:-2, 1:-1] - elevation[2:, 1:-1]) / (2 * dy)
+    slope = np.degrees(np.arctan(np.hypot(dz_east, dz_north)))
+    aspect = np.degrees(np.arctan2(-dz_east, -dz_north)) % 360
+    aspect[(dz_east == 0) & (dz_north == 0)] = FLAT_ASPECT
+    return slope, aspect
+
+
+def _land_cover_block(lc, ds, window: Window) -> np.ndarray:
+    """Land cover classes resampled (mode) onto a block of the DEM grid."""
+    bounds = ds.window_bounds(window)
+    lc_window = from_bounds(*bounds, transform=lc.transform)
+    return lc.read(
+        1,
+        window=lc_window,
+        out_shape=(int(window.height), int(window.width)),
+        resampling=Resampling.mode,
+        boundless=True,
+        fill_value=0,
+    )
+
+
+def _is_north_facing(aspect: np.ndarray) -> np.ndarray:
+    return (aspect >= 315) | ((aspect >= 0) & (aspect <= 45))
+
+
+def screen_terrain(
+    storage,
+    criteria: TerrainCriteria,
+    dem: str = "dem.tif",
+    land_cover: str = "land_cover.tif",
+) -> str:
+    """
+    Compute slope, aspect and the terrain exclusion mask block by block.
+
+    Only one block of every raster is in memory at a time. slope.tif and
+    aspect.tif are saved with the exclusion mask, which is True where the slope
+    is too steep or the land cover class is excluded.
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object where the data is saved
+    criteria : TerrainCriteria
+        Screening thresholds
+    dem : str, optional
+        DEM raster, by default "dem.tif"
+    land_cover : str, optional
+        Land cover raster, skipped if missing, by default "land_cover.tif"
+
+    Returns
+    -------
+    str
+        Name of the exclusion mask raster
+    """
+    logger.info("Screening terrain...")
+    ds = storage.read(dem)
+    lc = storage.read(land_cover) if storage.exists(land_cover) else None
+    if lc is None:
+        logger.warning("%s not found, land cover criteria skipped", land_cover)
+    excluded_classes = np.array(criteria.excluded_land_cover)
+
+    profile = {
+        "driver": "GTiff",
+        "height": ds.height,
+        "width": ds.width,
+        "count": 1,
+        "crs": ds.crs,
+        "transform": ds.transform,
+        "tiled": True,
+        "compress": "deflate",
+    }
+    tmp_dir = tempfile.mkdtemp()
+    paths = {
+        name: os.path.join(tmp_dir, name)
+        for name in (SLOPE_RASTER, ASPECT_RASTER, EXCLUSION_RASTER)
+    }
+    dy = abs(ds.transform.e)
+    if ds.crs is not None and ds.crs.is_geographic:
+        dy *= METERS_PER_DEGREE
+    try:
+        with rasterio.open(
+            paths[SLOPE_RASTER], "w", dtype="float32", nodata=SLOPE_NODATA, **profile
+        ) as slope_dst, rasterio.open(
+            paths[ASPECT_RASTER], "w", dtype="float32", nodata=SLOPE_NODATA, **profile
+        ) as aspect_dst, rasterio.open(
+            paths[EXCLUSION_RASTER], "w", dtype="uint8", **profile
+        ) as exclusion_dst:
+            for window in block_windows(ds.height, ds.width, criteria.block_size):
+                rows = np.arange(window.row_off, window.row_off + window.height)
+                dx = np.full(len(rows), abs(ds.transform.a))
+                if ds.crs is not None and ds.crs.is_geographic:
+                    latitudes = ds.transform.f + ds.transform.e * (rows + 0.5)
+                    dx = dx * METERS_PER_DEGREE * np.cos(np.radians(latitudes))
+
+                slope, aspect = slope_aspect(_read_with_halo(ds, window), dy, dx)
+                valid = ~np.isnan(slope)
+                excluded = valid & (slope > criteria.max_slope)
+                if criteria.max_north_slope is not None:
+                    excluded |= (
+                        valid
+                        & _is_north_facing(aspect)
+                        & (slope > criteria.max_north_slope)
+                    )
+                if lc is not None and len(excluded_classes):
+                    excluded |= np.isin(
+                        _land_cover_block(lc, ds, window), excluded_classes
+                    )
+
+                slope_dst.write(
+                    np.where(valid, slope, SLOPE_NODATA).astype("float32"), 1, window=window
+                )
+                aspect_dst.write(
+                    np.where(valid, aspect, SLOPE_NODATA).astype("float32"), 1, window=window
+                )
+                exclusion_dst.write(excluded.astype("uint8"), 1, window=window)
+        for name, path in paths.items():
+            storage.create(path, name)
+    finally:
+        ds.close()
+        if lc is not None:
+            lc.close()
+        for path in paths.values():
+            if os.path.exists(path):
+                os.remove(path)
+        os.rmdir(tmp_dir)
+    logger.info("Terrain screened successfully")
+    return EXCLUSION_RASTER
+
+
+def _pixels_to_crs(geometries: np.ndarray, transform: Affine) -> np.ndarray:
+    """Apply a geotransform to geometries in pixel coordinates."""
+    a, b, c, d, e, f = transform[:6]
+    return shapely.transform(
+        geometries,
+        lambda xy: np.column_stack(
+            [a * xy[:, 0] + b * xy[:, 1] + c, d * xy[:, 0] + e * xy[:, 1] + f]
+        ),
+    )
+
+
+def exclusion_polygons(
+    storage,
+    name: str = EXCLUSION_RASTER,
+    block_size: int = DEFAULT_BLOCK_SIZE,
+    within: Optional[gpd.GeoDataFrame] = None,
+) -> gpd.GeoDataFrame:
+    """
+    Polygonize an exclusion mask block by block.
+
+    Polygons are not merged across block edges. Blocks are numbered like the
+    squares of a checkerboard: the polygons of blocks of the same parity
+    never share an edge, so each parity is a valid multipolygon that can be
+    subtracted without unioning them. With within, only the blocks those
+    geometries intersect are read, and only the excluded pixels they touch are
+    polygonized, so the work is bounded by their footprint instead of the
+    whole raster.
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object where the data is saved
+    name : str, optional
+        Exclusion mask raster, by default "terrain_exclusion.tif"
+    block_size : int, optional
+        Block side in pixels, by default 512
+    within : GeoDataFrame, optional
+        Geometries the excluded areas are needed in, by default None, the
+        whole raster
+
+    Returns
+    -------
+    GeoDataFrame
+        Excluded areas, in EPSG:4326, with the parity of their block
+    """
+    ds = storage.read(name)
+    geometries, parities = [], []
+    try:
+        tree = None
+        if within is not None:
+            targets = within.geometry
+            if within.crs is not None and ds.crs is not None:
+                targets = targets.to_crs(ds.crs)
+            targets = targets[~(targets.isna() | targets.is_empty)].to_numpy()
+            tree = shapely.STRtree(targets)
+        for window in block_windows(ds.height, ds.width, block_size):
+            if tree is not None:
+                hits = tree.query(shapely.box(*ds.window_bounds(window)))
+                if not len(hits):
+                    continue
+            mask = ds.read(1, window=window).astype(bool)
+            if tree is not None and mask.any():
+                mask &= features.rasterize(
+                    tree.geometries.take(hits),
+                    out_shape=mask.shape,
+                    transform=ds.window_transform(window),
+                    all_touched=True,
+                    dtype="uint8",
+                ).astype(bool)
+            if not mask.any():
+                continue
+            # Polygonized in pixel coordinates of the whole raster, so the
+            # corners shared by neighbouring blocks are exactly the same
+            row, col = int(window.row_off), int(window.col_off)
+            shapes = features.shapes(
+                mask.astype(np.uint8),
+                mask=mask,
+                transform=Affine.translation(col, row),
+            )
+            parity = (row // block_size + col // block_size) % 2
+            for geometry, _ in shapes:
+                geometries.append(shapely.geometry.shape(geometry))
+                parities.append(parity)
+        transform, crs = ds.transform, ds.crs
+    finally:
+        ds.close()
+    geometries = _pixels_to_crs(np.array(geometries, dtype=object), transform)
+    return gpd.GeoDataFrame(
+        {"parity": np.array(parities, dtype="int64")}, geometry=geometries, crs=crs
+    ).to_crs("EPSG:4326")
@@ -0,0 +1,374 @@
+"""Split large AOIs into overlapping tiles processed in parallel."""
+
+import logging
+import math
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, List, Optional
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from pyproj import CRS, Transformer
+
+from .instrumentation import recorder, stage
+from .utilities import default_storage, local_metric_crs
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TILE_SIZE = 50000
+TILE_ID = "_aoi"
+# Same relative margin as the candidate search of the strtree engine
+_OVERLAP_MARGIN = 0.01
+# Vertices of every tile edge, which aren't straight lines in EPSG:4326
+_EDGE_SEGMENTS = 16
+# Distance to its tile edge, relative to the tile, of a polygon on a seam
+_SEAM_TOLERANCE = 1e-6
+
+# Storage of the tiles run in a worker process, set by _init_worker
+_worker_storage = None
+
+
+def tile_grid(
+    aoi_gdf: gpd.GeoDataFrame,
+    tile_size: float,
+    overlap: float,
+    metric_crs: Optional[CRS] = None,
+) -> gpd.GeoDataFrame:
+    """
+    Grid of tiles covering an AOI.
+
+    Tiles are square in the metric CRS the buffers are computed in. Their
+    edges are densified and projected to EPSG:4326 from a single mesh, so
+    neighbouring tiles share their edges exactly.
+
+    Parameters
+    ----------
+    aoi_gdf : GeoDataFrame
+        GeoDataFrame with the area of interest
+    tile_size : float
+        Side of the tiles, in meters
+    overlap : float
+        Extra margin around every tile, in meters
+    metric_crs : CRS, optional
+        CRS of the grid, by default the local_metric_crs of the AOI
+
+    Returns
+    -------
+    GeoDataFrame
+        The tiles intersecting the AOI, with the "tile" geometry and the
+        "expanded" tile grown by the overlap
+    """
+    if metric_crs is None:
+        metric_crs = local_metric_crs(aoi_gdf)
+    to_metric = Transformer.from_crs(aoi_gdf.crs, metric_crs, always_xy=True)
+    to_wgs84 = Transformer.from_crs(metric_crs, "EPSG:4326", always_xy=True)
+    minx, miny, maxx, maxy = to_metric.transform_bounds(*aoi_gdf.total_bounds)
+    columns = max(math.ceil((maxx - minx) / tile_size), 1)
+    rows = max(math.ceil((maxy - miny) / tile_size), 1)
+
+    xs = _edges(minx, maxx, columns, tile_size)
+    ys = _edges(miny, maxy, rows, tile_size)
+    lon, lat = to_wgs84.transform(*np.meshgrid(xs, ys))
+    k = _EDGE_SEGMENTS
+
+    tiles, expanded = [], []
+    for row in range(rows):
+        for column in range(columns):
+            i0, i1 = row * k, (row + 1) * k
+            j0, j1 = column * k, (column + 1) * k
+            ring = (
+                [(i0, j) for j in range(j0, j1)]
+                + [(i, j1) for i in range(i0, i1)]
+                + [(i1, j) for j in range(j1, j0, -1)]
+                + [(i, j0) for i in range(i1, i0, -1)]
+            )
+            rows_idx, columns_idx = np.array(ring).T
+            tiles.append(
+                shapely.Polygon(
+                    np.column_stack(
+                        [lon[rows_idx, columns_idx], lat[rows_idx, columns_idx]]
+                    )
+                )
+            )
+            x0, x1, y0, y1 = xs[j0], xs[j1], ys[i0], ys[i1]
+            expanded.append(
+                shapely.box(
+                    *to_wgs84.transform_bounds(
+                        x0 - overlap, y0 - overlap, x1 + overlap, y1 + overlap
+                    )
+                )
+            )
+    grid = gpd.GeoDataFrame(
+        {"expanded": gpd.GeoSeries(expanded, crs="EPSG:4326")},
+        geometry=gpd.GeoSeries(tiles, crs="EPSG:4326"),
+    ).to_crs(aoi_gdf.crs)
+    aoi = shapely.union_all(aoi_gdf.geometry.to_numpy())
+    return grid[grid.intersects(aoi)].reset_index(drop=True)
+
+
+def _edges(start: float, stop: float, count: int, size: float) -> np.ndarray:
+    """Coordinates of count tiles of a size along an axis, _EDGE_SEGMENTS per tile"""
+    breaks = np.minimum(start + np.arange(count + 1) * size, stop)
+    breaks[-1] = stop
+    segments = [
+        np.linspace(a, b, _EDGE_SEGMENTS, endpoint=False)
+        for a, b in zip(breaks[:-1], breaks[1:])
+    ]
+    return np.concatenate([*segments, [stop]])
+
+
+def needs_tiling(
+    aoi_gdf: gpd.GeoDataFrame,
+    tile_size: Optional[float],
+    metric_crs: Optional[CRS] = None,
+) -> bool:
+    """Whether the AOI extent is larger than a tile in any direction."""
+    if not tile_size:
+        return False
+    if metric_crs is None:
+        metric_crs = local_metric_crs(aoi_gdf)
+    minx, miny, maxx, maxy = aoi_gdf.to_crs(metric_crs).total_bounds
+    return max(maxx - minx, maxy - miny) > tile_size
+
+
+def _clip_layer(
+    layer: Optional[gpd.GeoDataFrame], extent: shapely.Geometry, clip: bool
+) -> Optional[gpd.GeoDataFrame]:
+    """Geometries of a layer intersecting a tile, optionally clipped to it."""
+    if layer is None or layer.empty:
+        return None
+    geometries = layer.geometry.to_numpy()
+    geometries = geometries[layer.sindex.query(extent, predicate="intersects")]
+    if clip:
+        geometries = shapely.intersection(geometries, extent)
+        geometries = geometries[~shapely.is_empty(geometries)]
+    return gpd.GeoDataFrame(geometry=geometries, crs=layer.crs)
+
+
+def _init_worker(storage_factory: Callable[[], Any]) -> None:
+    """Create the storage the tiles of a worker process read their layers from"""
+    global _worker_storage
+    _worker_storage = storage_factory()
+
+
+def _tile_suitable_areas(
+    engine,
+    load_layers: Callable[..., tuple],
+    aoi_tile: gpd.GeoDataFrame,
+    expanded: shapely.Geometry,
+    buffer_size: int,
+    metric_crs: CRS,
+    storage=None,
+) -> tuple:
+    """Suitable areas of a tile, with the records of its stages"""
+    storage = _worker_storage if storage is None else storage
+    # Worker processes run several tiles, every tile returns its own stages
+    with recorder.collect() as records, recorder.within([]):
+        with stage("load_layers") as record:
+            protected_areas, *infrastructure_layers = load_layers(
+                storage, bbox=expanded.bounds
+            )
+            protected_areas = _clip_layer(protected_areas, expanded, clip=True)
+            infrastructure_layers = [
+                _clip_layer(layer, expanded, clip=False)
+                for layer in infrastructure_layers
+            ]
+            record.features = sum(
+                len(layer)
+                for layer in (protected_areas, *infrastructure_layers)
+                if layer is not None
+            )
+        with stage("suitable_areas") as record:
+            result = engine(
+                aoi_tile,
+                protected_areas,
+                infrastructure_layers,
+                buffer_size,
+                metric_crs=metric_crs,
+            )
+            record.features = len(result)
+    return result, [record.to_dict() for record in records]
+
+
+def stitch_tiles(
+    results: List[gpd.GeoDataFrame], tiles: gpd.GeoSeries
+) -> gpd.GeoSeries:
+    """
+    Merge the results of the tiles into one geometry per AOI feature.
+
+    Only the polygons touching the edge of their tile can continue in the
+    next tile, so only they are unioned. The polygons inside a tile are
+    disjoint from everything else and are collected as they are.
+
+    Parameters
+    ----------
+    results : list of GeoDataFrame
+        Suitable areas of every tile, with the TILE_ID of their AOI feature
+    tiles : GeoSeries
+        Tile of every result
+
+    Returns
+    -------
+    GeoSeries
+        Geometry of every AOI feature with suitable areas, indexed by TILE_ID
+    """
+    ids = np.concatenate([result[TILE_ID].to_numpy() for result in results])
+    geometries = np.concatenate([result.geometry.to_numpy() for result in results])
+    edges = np.repeat(
+        shapely.boundary(tiles.to_numpy()), [len(result) for result in results]
+    )
+    # A multipolygon can have parts on a seam and parts inside its tile
+    parts, index = shapely.get_parts(geometries, return_index=True)
+    ids, edges = ids[index], edges[index]
+    # Vertices clipped on a tile edge may be slightly off it
+    minx, miny, maxx, maxy = shapely.bounds(edges).T
+    tolerance = np.maximum(maxx - minx, maxy - miny) * _SEAM_TOLERANCE
+    seam = shapely.dwithin(parts, edges, tolerance)
+
+    merged_ids, merged = [], []
+    for feature in np.unique(ids[seam]):
+        union = shapely.union_all(parts[seam & (ids == feature)])
+        polygons = shapely.get_parts(union)
+        merged_ids.append(np.full(len(polygons), feature))
+        merged.append(polygons)
+    ids = np.concatenate([ids[~seam], *merged_ids])
+    parts = np.concatenate([parts[~seam], *merged])
+
+    order = np.argsort(ids, kind="stable")
+    ids, parts = ids[order], parts[order]
+    features, starts, counts = np.unique(ids, return_index=True, return_counts=True)
+    geometries = shapely.multipolygons(
+        parts, indices=np.repeat(np.arange(len(features)), counts)
+    )
+    # Single polygons are not wrapped, like dissolve() returns them
+    single = counts == 1
+    geometries[single] = parts[starts[single]]
+    return gpd.GeoSeries(geometries, index=features, crs=tiles.crs)
+
+
+def tiled_suitable_areas(
+    engine,
+    load_layers: Callable[..., tuple],
+    storage,
+    aoi_gdf: gpd.GeoDataFrame,
+    buffer_size: int,
+    tile_size: float = DEFAULT_TILE_SIZE,
+    max_workers: Optional[int] = None,
+    metric_crs: Optional[CRS] = None,
+    storage_factory: Callable[[], Any] = default_storage,
+) -> gpd.GeoDataFrame:
+    """
+    Run a vector suitability engine tile by tile and stitch the results.
+
+    The AOI is cut along a grid of tiles. Every tile only reads the features
+    of the layers within the tile plus an overlap equal to the buffer
+    distance, so its result is exact. Tiles run in parallel worker processes,
+    which read the layers themselves, and the polygons of their results that
+    meet at the seams are unioned into one geometry per AOI feature. The
+    stages of every tile are recorded as tile/<index in the grid>/<stage>.
+
+    Parameters
+    ----------
+    engine : callable
+        Vector engine, overlay_suitable_areas or strtree_suitable_areas
+    load_layers : callable
+        Reads (protected_areas, *infrastructure_layers) in EPSG:4326 from a
+        storage, only the features intersecting a bbox
+    storage : Storage
+        Storage object where the data is saved, read by the tiles run in the
+        calling process
+    aoi_gdf : GeoDataFrame
+        GeoDataFrame with the area of interest
+    buffer_size : int
+        Maximum distance to infrastructure in meters
+    tile_size : float, optional
+        Side of the tiles in meters, by default 50000
+    max_workers : int, optional
+        Number of worker processes, by default the number of CPUs. With 1,
+        tiles run one after the other in the calling process.
+    metric_crs : CRS, optional
+        CRS the tiles and buffers are computed in, by default the
+        local_metric_crs of the AOI
+    storage_factory : callable, optional
+        Creates the storage in the worker processes, by default the project
+        data storage
+
+    Returns
+    -------
+    GeoDataFrame
+        Areas that meet the criteria, as the untiled engine returns them. The
+        infrastructure attributes are the first values found in the tiles.
+    """
+    if metric_crs is None:
+        metric_crs = local_metric_crs(aoi_gdf)
+    overlap = buffer_size * (1 + _OVERLAP_MARGIN)
+    grid = tile_grid(aoi_gdf, tile_size, overlap, metric_crs)
+    logger.info("Finding suitable areas in %d tiles...", len(grid))
+
+    aoi = gpd.GeoDataFrame(
+        {TILE_ID: np.arange(len(aoi_gdf))},
+        geometry=aoi_gdf.geometry.to_numpy(),
+        crs=aoi_gdf.crs,
+    )
+    tiles, jobs = [], []
+    for i, (tile, expanded) in enumerate(zip(grid.geometry, grid["expanded"])):
+        aoi_tile = aoi.clip(tile)
+        aoi_tile = aoi_tile[aoi_tile.geometry.type.isin(["Polygon", "MultiPolygon"])]
+        if aoi_tile.empty:
+            continue
+        tiles.append(i)
+        jobs.append((aoi_tile.reset_index(drop=True), expanded))
+
+    if max_workers == 1:
+        # Already in a worker process, e.g. a batch job: no nested pool
+        results = [
+            _tile_suitable_areas(
+                engine, load_layers, *job, buffer_size, metric_crs, storage
+            )
+            for job in jobs
+        ]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_init_worker,
+            initargs=(storage_factory,),
+        ) as executor:
+            futures = [
+                executor.submit(
+                    _tile_suitable_areas,
+                    engine,
+                    load_layers,
+                    *job,
+                    buffer_size,
+                    metric_crs,
+                )
+                for job in jobs
+            ]
+            results = [future.result() for future in futures]
+    for tile, (_, records) in zip(tiles, results):
+        recorder.merge(records, f"tile/{tile}")
+    results = [
+        (result, tile) for tile, (result, _) in zip(tiles, results) if not result.empty
+    ]
+    if not results:
+        return gpd.GeoDataFrame(geometry=[], crs=aoi_gdf.crs)
+
+    results, tiles = zip(*results)
+    stitched = stitch_tiles(list(results), grid.geometry.iloc[list(tiles)])
+    attributes = pd.concat(
+        [
+            pd.DataFrame(result.drop(columns=[TILE_ID, result.geometry.name]))
+            for result in results
+        ]
+    )
+    attributes = attributes.groupby(np.zeros(len(attributes), dtype="int64")).first()
+    suitable_areas = (
+        pd.DataFrame(aoi_gdf.drop(columns=aoi_gdf.geometry.name))
+        .iloc[stitched.index]
+        .reset_index(drop=True)
+        .merge(attributes.reset_index(drop=True), how="cross", suffixes=("_1", "_2"))
+    )
+    return gpd.GeoDataFrame(
+        suitable_areas, geometry=stitched.to_numpy(), crs=aoi_gdf.crs
+    )
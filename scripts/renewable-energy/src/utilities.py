@@ -1,4 +1,159 @@
+import os
+import tempfile
+from functools import lru_cache
+from typing import Any, List, Optional, Sequence, Union
+
 import geopandas as gpd
+import numpy as np
+import rasterio
+import shapely
+from pyproj import CRS, Transformer
+from spai.storage import Storage
+
+# GeoSeries.buffer resolution
+BUFFER_QUAD_SEGS = 16
+# Widest AOI, in degrees of longitude, buffered in a single UTM zone
+MAX_UTM_SPAN = 6.0
+MAX_UTM_LATITUDE = 80.0
+
+
+def local_metric_crs(gdf: gpd.GeoDataFrame) -> CRS:
+    """
+    Projected CRS in meters where distances around a GeoDataFrame are true.
+
+    Parameters
+    ----------
+    gdf : GeoDataFrame
+        GeoDataFrame with the area of interest
+
+    Returns
+    -------
+    CRS
+        UTM zone of the GeoDataFrame, or an azimuthal equidistant CRS centered
+        on it when it spans more than a zone or reaches the polar regions
+    """
+    crs = gdf.crs or "EPSG:4326"
+    minx, miny, maxx, maxy = _transformer(crs, "EPSG:4326").transform_bounds(
+        *gdf.total_bounds
+    )
+    if maxx - minx <= MAX_UTM_SPAN and max(abs(miny), abs(maxy)) <= MAX_UTM_LATITUDE:
+        utm = gpd.GeoSeries(
+            [shapely.box(minx, miny, maxx, maxy)], crs="EPSG:4326"
+        ).estimate_utm_crs()
+        if utm is not None:
+            return utm
+    return CRS.from_proj4(
+        f"+proj=aeqd +lat_0={(miny + maxy) / 2} +lon_0={(minx + maxx) / 2} "
+        "+datum=WGS84 +units=m +no_defs"
+    )
+
+
+@lru_cache(maxsize=64)
+def _cached_transformer(source: str, target: str) -> Transformer:
+    return Transformer.from_crs(source, target, always_xy=True)
+
+
+def _transformer(source: Any, target: Any) -> Transformer:
+    return _cached_transformer(CRS(source).to_wkt(), CRS(target).to_wkt())
+
+
+def _project(geometries: np.ndarray, source: Any, target: Any) -> np.ndarray:
+    transformer = _transformer(source, target)
+    return shapely.transform(geometries, transformer.transform, interleaved=False)
+
+
+def project_geometries(geometries: gpd.GeoSeries, crs: Any) -> np.ndarray:
+    """
+    Geometries of a GeoSeries projected to a CRS, in a single batched transform.
+
+    Parameters
+    ----------
+    geometries : GeoSeries
+        Geometries to project, in EPSG:4326 if they have no CRS
+    crs : Any
+        Target CRS
+
+    Returns
+    -------
+    ndarray
+        The projected geometries
+    """
+    values = np.asarray(geometries.values)
+    source = CRS(geometries.crs or "EPSG:4326")
+    target = CRS(crs)
+    if source == target:
+        return values
+    return _project(values, source, target)
+
+
+def unproject_geometries(geometries: np.ndarray, crs: Any) -> np.ndarray:
+    """Geometries in a CRS projected back to EPSG:4326"""
+    if CRS(crs) == CRS("EPSG:4326"):
+        return geometries
+    return _project(geometries, crs, "EPSG:4326")
+
+
+def buffer_layers(
+    layers: Sequence[gpd.GeoDataFrame],
+    distances: Union[float, Sequence[float]],
+    crs: Optional[Any] = None,
+) -> List[gpd.GeoDataFrame]:
+    """
+    Buffer several layers by distances in meters, in a single vectorized pass.
+
+    Geometries are projected to a local metric CRS, buffered together and
+    projected back to EPSG:4326 at once.
+
+    Parameters
+    ----------
+    layers : sequence of GeoDataFrame
+        Layers to buffer, in EPSG:4326 if they have no CRS
+    distances : float or sequence of float
+        Buffer distance in meters, for all layers or for every layer
+    crs : Any, optional
+        Metric CRS of the buffers, by default the local_metric_crs of all layers
+
+    Returns
+    -------
+    list of GeoDataFrame
+        Every layer with its buffered geometries, in EPSG:4326
+    """
+    layers = [
+        layer if layer.crs is not None else layer.set_crs("EPSG:4326")
+        for layer in layers
+    ]
+    if not layers:
+        return []
+    if np.ndim(distances) == 0:
+        distances = [distances] * len(layers)
+    if crs is None:
+        extent = gpd.GeoDataFrame(
+            geometry=[
+                shapely.box(
+                    *_transformer(layer.crs, "EPSG:4326").transform_bounds(
+                        *layer.total_bounds
+                    )
+                )
+                for layer in layers
+                if not layer.empty
+            ],
+            crs="EPSG:4326",
+        )
+        crs = local_metric_crs(extent) if not extent.empty else "EPSG:4326"
+    sizes = [len(layer) for layer in layers]
+    projected = np.concatenate(
+        [project_geometries(layer.geometry, crs) for layer in layers]
+    )
+    buffered = shapely.buffer(
+        projected, np.repeat(distances, sizes), quad_segs=BUFFER_QUAD_SEGS
+    )
+    buffered = unproject_geometries(buffered, crs)
+    results = []
+    for layer, part in zip(layers, np.split(buffered, np.cumsum(sizes)[:-1])):
+        layer = layer.to_crs("EPSG:4326") if layer.crs != "EPSG:4326" else layer.copy()
+        layer[layer.geometry.name] = part
+        results.append(layer)
+    return results
 
 
 def create_buffer(gdf: gpd.GeoDataFrame, buffer_size: int) -> gpd.GeoDataFrame:
@@ -15,13 +170,91 @@ def create_buffer(gdf: gpd.GeoDataFrame, buffer_size: int) -> gpd.GeoDataFrame:
     Returns
     -------
     GeoDataFrame
-        The GeoDataFrame with the buffer.
+        The GeoDataFrame with the buffer, in EPSG:4326.
+    """
+    return buffer_layers([gdf], buffer_size)[0]
+
+
+def area_km2(gdf: gpd.GeoDataFrame) -> float:
+    """
+    Total area of a GeoDataFrame in square kilometers.
+
+    Parameters
+    ----------
+    gdf : GeoDataFrame
+        Polygons to measure, in EPSG:4326 if they have no CRS
+
+    Returns
+    -------
+    float
+        Area measured in the local_metric_crs of the polygons, rounded to 2
+        decimals. 0 if there are none.
     """
-    if not gdf.crs:
+    if gdf is None or gdf.empty:
+        return 0.0
+    if gdf.crs is None:
         gdf = gdf.set_crs("EPSG:4326")
-    gdf_3857 = gdf.to_crs("EPSG:3857")
-    # Create a new geodataframe with the buffer
-    gdf_3857["geometry"] = gdf_3857.geometry.buffer(buffer_size)
-    gdf = gdf_3857.to_crs("EPSG:4326")
+    area = shapely.area(project_geometries(gdf.geometry, local_metric_crs(gdf)))
+    return round(float(area.sum()) / 1e6, 2)
+
+
+def default_storage():
+    """Data storage of the project, created in every worker process."""
+    return Storage()["data"]
+
 
-    return gdf
\ No newline at end of file
+def write_raster(
+    storage,
+    data: np.ndarray,
+    name: str,
+    transform: Any,
+    crs: Any,
+    nodata: Optional[float] = None,
+) -> str:
+    """
+    Write an array as a tiled, compressed GeoTIFF to storage.
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object to save the raster
+    data : ndarray
+        2D array, or 3D array with bands first
+    name : str
+        The name of the file
+    transform : Affine
+        Geotransform of the array
+    crs : Any
+        Coordinate reference system of the array
+    nodata : float, optional
+        Nodata value, by default None
+
+    Returns
+    -------
+    str
+        Path of the stored raster
+    """
+    data = data.astype(np.uint8) if data.dtype == bool else data
+    bands = data if data.ndim == 3 else data[np.newaxis]
+    fd, tmp_path = tempfile.mkstemp(suffix=".tif")
+    os.close(fd)
+    try:
+        with rasterio.open(
+            tmp_path,
+            "w",
+            driver="GTiff",
+            height=bands.shape[1],
+            width=bands.shape[2],
+            count=bands.shape[0],
+            dtype=bands.dtype,
+            crs=crs,
+            transform=transform,
+            nodata=nodata,
+            tiled=True,
+            compress="deflate",
+        ) as dst:
+            dst.write(bands)
+        return storage.create(tmp_path, name)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
@@ -0,0 +1,324 @@
+"""Vector layers stored as GeoParquet, FlatGeobuf or GeoJSON, with bbox reads."""
+
+import io
+import json
+import logging
+import os
+import tempfile
+from functools import lru_cache
+from typing import Optional, Tuple
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import pyproj
+import shapely
+
+logger = logging.getLogger(__name__)
+
+GEOPARQUET = "parquet"
+FLATGEOBUF = "fgb"
+GEOJSON = "geojson"
+# Formats in the order layers are looked up when reading
+VECTOR_FORMATS = (GEOPARQUET, FLATGEOBUF, GEOJSON)
+DEFAULT_VECTOR_FORMAT = GEOPARQUET
+# Rows per GeoParquet row group, the unit of bbox filtering and streamed reads
+PARQUET_ROW_GROUP_SIZE = 65536
+
+_NESTED_TYPES = (list, dict, tuple, np.ndarray)
+# pandas inferred dtypes of object columns without nested values
+_SCALAR_DTYPES = {"string", "empty", "bytes", "boolean", "integer", "floating"}
+
+_vector_format = DEFAULT_VECTOR_FORMAT
+
+
+def set_vector_format(vector_format: Optional[str]) -> None:
+    """
+    Set the format new layers are written in.
+
+    Parameters
+    ----------
+    vector_format : str or None
+        "parquet", "fgb" or "geojson", None for the default GeoParquet
+    """
+    global _vector_format
+    vector_format = (vector_format or DEFAULT_VECTOR_FORMAT).lower()
+    if vector_format not in VECTOR_FORMATS:
+        raise ValueError(
+            f"Unknown vector format '{vector_format}', use one of {VECTOR_FORMATS}"
+        )
+    _vector_format = vector_format
+
+
+def get_vector_format() -> str:
+    return _vector_format
+
+
+def layer_stem(name: str) -> str:
+    """Layer name without a vector format extension"""
+    stem, ext = os.path.splitext(name)
+    return stem if ext.lstrip(".") in VECTOR_FORMATS else name
+
+
+def layer_path(name: str, vector_format: Optional[str] = None) -> str:
+    """Storage name of a layer in a format, by default the configured one"""
+    return f"{layer_stem(name)}.{vector_format or _vector_format}"
+
+
+def find_layer(storage, name: str) -> Optional[str]:
+    """
+    Storage name of an existing layer, in any format.
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object where the data is saved
+    name : str
+        Layer name, with or without extension
+
+    Returns
+    -------
+    str or None
+        Name of the stored layer, None if there is none
+    """
+    for vector_format in (_vector_format, *VECTOR_FORMATS):
+        path = layer_path(name, vector_format)
+        if storage.exists(path):
+            return path
+    return None
+
+
+def layer_exists(storage, name: str) -> bool:
+    return find_layer(storage, name) is not None
+
+
+def sanitize_tags(gdf: gpd.GeoDataFrame, drop_empty: bool = True) -> gpd.GeoDataFrame:
+    """
+    Tag columns ready to be written in any vector format.
+
+    List, dict and array values, returned by osmnx for repeated OSM tags, are
+    converted to strings. Only the columns that hold them are converted.
+
+    Parameters
+    ----------
+    gdf : GeoDataFrame
+        Layer to sanitize
+    drop_empty : bool, optional
+        Drop the columns with no values, by default True
+
+    Returns
+    -------
+    GeoDataFrame
+        The sanitized layer, the same object if nothing changed
+    """
+    geometry = gdf.geometry.name
+    nested = {}
+    for column in gdf.columns:
+        if column == geometry or gdf[column].dtype != object:
+            continue
+        values = gdf[column]
+        # Columns of scalars are told apart without a Python loop
+        if pd.api.types.infer_dtype(values, skipna=True) in _SCALAR_DTYPES:
+            continue
+        is_nested = values.map(type).isin(_NESTED_TYPES)
+        if is_nested.any():
+            nested[column] = values.where(~is_nested, values[is_nested].astype(str))
+    if nested:
+        gdf = gdf.assign(**nested)
+    if drop_empty:
+        empty = gdf.columns[gdf.isna().all()].drop(geometry, errors="ignore")
+        if len(empty):
+            gdf = gdf.drop(columns=empty)
+    return gdf
+
+
+def _make_folder(storage, path: str) -> None:
+    """Create the local folder of a file, which storages only do for data"""
+    try:
+        folder = os.path.dirname(os.path.join(storage.path, path))
+    except AttributeError:
+        # Object storages have no folders
+        return
+    os.makedirs(folder, exist_ok=True)
+
+
+def write_layer(
+    storage, gdf: gpd.GeoDataFrame, name: str, vector_format: Optional[str] = None
+) -> str:
+    """
+    Save a layer, replacing its copies in other formats.
+
+    GeoParquet files get a bbox covering column and FlatGeobuf files a
+    spatial index, so that reads can skip the features out of a bbox.
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object where the data is saved
+    gdf : GeoDataFrame
+        Layer to save
+    name : str
+        Layer name, with or without extension
+    vector_format : str, optional
+        Format of the layer, by default the configured one
+
+    Returns
+    -------
+    str
+        Storage name of the saved layer
+    """
+    vector_format = vector_format or _vector_format
+    path = layer_path(name, vector_format)
+    if vector_format == GEOJSON:
+        storage.create(gdf, path)
+    else:
+        tmp_dir = tempfile.mkdtemp()
+        tmp_path = os.path.join(tmp_dir, os.path.basename(path))
+        try:
+            if vector_format == GEOPARQUET:
+                sanitize_tags(gdf, drop_empty=False).to_parquet(
+                    tmp_path,
+                    write_covering_bbox=True,
+                    row_group_size=PARQUET_ROW_GROUP_SIZE,
+                )
+            else:
+                sanitize_tags(gdf, drop_empty=False).to_file(
+                    tmp_path, driver="FlatGeobuf", engine="pyogrio"
+                )
+            _make_folder(storage, path)
+            storage.create(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            os.rmdir(tmp_dir)
+    for other in VECTOR_FORMATS:
+        stale = layer_path(name, other)
+        if other != vector_format and storage.exists(stale):
+            storage.delete(stale)
+    return path
+
+
+def delete_layer(storage, name: str) -> None:
+    """Delete a layer in every format it is stored in"""
+    for vector_format in VECTOR_FORMATS:
+        path = layer_path(name, vector_format)
+        if storage.exists(path):
+            storage.delete(path)
+
+
+@lru_cache(maxsize=32)
+def _parse_crs(crs_json: str) -> Optional[pyproj.CRS]:
+    # The PROJJSON of GeoParquet files has no datum ensemble member ids, and
+    # takes pyproj tens of milliseconds to resolve: parse every CRS once
+    crs = json.loads(crs_json)
+    return pyproj.CRS.from_user_input(crs) if crs is not None else None
+
+
+def _read_geoparquet(source, bbox: Optional[tuple] = None) -> gpd.GeoDataFrame:
+    """
+    Read a GeoParquet file with WKB geometries, like geopandas.read_parquet
+
+    Parameters
+    ----------
+    source : str or file-like
+        Local path or content of the file
+    bbox : tuple, optional
+        Only read the row groups and rows whose bbox covering column
+        intersects minx, miny, maxx, maxy
+
+    Returns
+    -------
+    GeoDataFrame
+        The layer, with its bbox covering column dropped
+
+    Raises
+    ------
+    ValueError
+        If the file geometries aren't WKB, or bbox is set and the file has no
+        bbox covering column
+    """
+    schema = pq.read_schema(source)
+    if isinstance(source, io.IOBase):
+        source.seek(0)
+    geo = json.loads(schema.metadata[b"geo"])
+    column = geo["primary_column"]
+    meta = geo["columns"][column]
+    if meta.get("encoding", "WKB").upper() != "WKB":
+        raise ValueError(f"Unsupported GeoParquet encoding {meta['encoding']}")
+    covering = meta.get("covering", {}).get("bbox")
+    filters = None
+    if bbox is not None:
+        if covering is None:
+            raise ValueError("GeoParquet file without a bbox covering column")
+        minx, miny, maxx, maxy = bbox
+        field = covering["xmin"][0]
+        filters = (
+            (pc.field(field, "xmin") <= maxx)
+            & (pc.field(field, "ymin") <= maxy)
+            & (pc.field(field, "xmax") >= minx)
+            & (pc.field(field, "ymax") >= miny)
+        )
+    table = pq.read_table(source, filters=filters)
+    if covering is not None:
+        table = table.drop_columns([covering["xmin"][0]])
+    df = table.drop_columns([column]).to_pandas()
+    crs = _parse_crs(json.dumps(meta.get("crs", "OGC:CRS84"), sort_keys=True))
+    geometry = gpd.GeoSeries.from_wkb(
+        table.column(column).to_numpy(zero_copy_only=False), index=df.index, crs=crs
+    )
+    return gpd.GeoDataFrame(df, geometry=geometry.rename(column))
+
+
+def _source(storage, path: str):
+    """Local path of a stored file, or its content"""
+    local = storage.get_path(path)
+    if os.path.isfile(local):
+        return local
+    return io.BytesIO(storage.read_object(path).getvalue())
+
+
+def read_layer(
+    storage,
+    name: str,
+    bbox: Optional[Tuple[float, float, float, float]] = None,
+) -> Optional[gpd.GeoDataFrame]:
+    """
+    Read a layer stored in any format.
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object where the data is saved
+    name : str
+        Layer name, with or without extension
+    bbox : tuple, optional
+        Only read the features intersecting minx, miny, maxx, maxy, in the
+        CRS of the layer
+
+    Returns
+    -------
+    GeoDataFrame or None
+        The layer, None if it doesn't exist
+    """
+    path = find_layer(storage, name)
+    if path is None:
+        return None
+    source = _source(storage, path)
+    if path.endswith(f".{GEOPARQUET}"):
+        try:
+            gdf = _read_geoparquet(source, bbox=bbox)
+        except ValueError:
+            # Files of other writers are read and filtered by geopandas
+            if isinstance(source, io.IOBase):
+                source.seek(0)
+            gdf = gpd.read_parquet(source)
+    else:
+        gdf = gpd.read_file(source, bbox=bbox, engine="pyogrio")
+    if gdf.crs is None:
+        gdf = gdf.set_crs("EPSG:4326")
+    if bbox is not None:
+        # Formats filter on envelopes or on geometries, keep the same features
+        gdf = gdf[gdf.intersects(shapely.box(*bbox))]
+    return gdf
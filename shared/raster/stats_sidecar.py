@@ -0,0 +1,213 @@
+"""
+Raster band statistics and their sidecars, shared by the pipeline and the API
+
+The pipeline saves the statistics of every raster it writes in a sidecar, with
+the version of the raster they were computed on. The API serves the sidecar
+while the raster keeps that version, and computes the same statistics from the
+raster otherwise.
+"""
+
+import json
+import os
+from typing import Iterator, List, Optional
+
+import numpy as np
+
+STATS_SUFFIX = ".stats.json"
+HISTOGRAM_BINS = 256
+PERCENTILES = (2, 5, 25, 50, 75, 95, 98)
+
+
+def stats_path(name: str) -> str:
+    """Name of the statistics sidecar of a raster"""
+    return name.rsplit(".", 1)[0] + STATS_SUFFIX
+
+
+def object_version(storage, name: str) -> Optional[str]:
+    """
+    Version token of a storage object, changing whenever the object is rewritten
+
+    Parameters
+    ----------
+    storage : Storage
+        Storage object where the data is saved
+    name : str
+        Object name
+
+    Returns
+    -------
+    version : str or None
+        ETag and modification time for S3, modification time and size for local
+        storage, None if the object doesn't exist
+    """
+    client = getattr(storage, "client", None)
+    if client is not None and not getattr(storage, "managed", False):
+        try:
+            stat = client.stat_object(storage.bucket, name)
+        except Exception:
+            return None
+        return f"{stat.etag}-{stat.last_modified}"
+    if getattr(storage, "managed", False):
+        if not storage.exists(name):
+            return None
+        return json.dumps(storage.object_info(name), sort_keys=True, default=str)
+    try:
+        stat = os.stat(storage.get_path(name))
+    except FileNotFoundError:
+        return None
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+
+def _valid_blocks(ds, band: int) -> Iterator[np.ndarray]:
+    """Finite, unmasked values of every block of a band"""
+    for _, window in ds.block_windows(band):
+        values = ds.read(band, window=window, masked=True).astype("float64")
+        values = values.compressed()
+        values = values[np.isfinite(values)]
+        if len(values):
+            yield values
+
+
+def histogram_percentiles(
+    counts: np.ndarray, minimum: float, maximum: float, percentiles=PERCENTILES
+) -> dict:
+    """
+    Percentiles of a histogram with equal bins, interpolated within the bins.
+
+    Parameters
+    ----------
+    counts : ndarray
+        Values in every bin
+    minimum : float
+        Lower edge of the first bin
+    maximum : float
+        Upper edge of the last bin
+    percentiles : sequence of float, optional
+        Percentiles to compute, by default 2, 5, 25, 50, 75, 95 and 98
+
+    Returns
+    -------
+    dict
+        Value of every percentile, keyed "p<percentile>"
+    """
+    edges = np.linspace(minimum, maximum, len(counts) + 1)
+    cumulative = np.concatenate([[0], np.cumsum(counts)])
+    targets = np.asarray(percentiles, dtype="float64") / 100 * cumulative[-1]
+    values = np.interp(targets, cumulative, edges)
+    return {f"p{p:g}": float(value) for p, value in zip(percentiles, values)}
+
+
+def band_stats(ds, band: int = 1, bins: int = HISTOGRAM_BINS) -> dict:
+    """
+    Statistics of a raster band, read block by block.
+
+    Means and variances of the blocks are merged with Chan's parallel
+    algorithm, so only one block is in memory at a time. A second pass over
+    the blocks counts the values in equal bins between the minimum and the
+    maximum, and the percentiles are interpolated from that histogram.
+
+    Parameters
+    ----------
+    ds : DatasetReader
+        Open raster
+    band : int, optional
+        Band index, by default 1
+    bins : int, optional
+        Bins of the histogram, by default 256
+
+    Returns
+    -------
+    dict
+        band, count of valid pixels, min, max, mean, std, percentiles and
+        histogram, with the counts of the bins between min and max. None if
+        there is no valid pixel.
+    """
+    count, mean, m2 = 0, 0.0, 0.0
+    minimum, maximum = np.inf, -np.inf
+    for values in _valid_blocks(ds, band):
+        n = len(values)
+        block_mean = values.mean()
+        block_m2 = ((values - block_mean) ** 2).sum()
+        delta = block_mean - mean
+        total = count + n
+        mean += delta * n / total
+        m2 += block_m2 + delta**2 * count * n / total
+        count = total
+        minimum = min(minimum, values.min())
+        maximum = max(maximum, values.max())
+    if not count:
+        return {
+            "band": band,
+            "count": 0,
+            "min": None,
+            "max": None,
+            "mean": None,
+            "std": None,
+            "percentiles": None,
+            "histogram": None,
+        }
+    counts = np.zeros(bins, dtype="int64")
+    for values in _valid_blocks(ds, band):
+        counts += np.histogram(values, bins=bins, range=(minimum, maximum))[0]
+    return {
+        "band": band,
+        "count": int(count),
+        "min": float(minimum),
+        "max": float(maximum),
+        "mean": float(mean),
+        "std": float(np.sqrt(m2 / count)),
+        "percentiles": histogram_percentiles(counts, minimum, maximum),
+        "histogram": {
+            "min": float(minimum),
+            "max": float(maximum),
+            "counts": counts.tolist(),
+        },
+    }
+
+
+def raster_stats(ds) -> List[dict]:
+    """Statistics of every band of an open raster"""
+    return [band_stats(ds, band) for band in ds.indexes]
+
+
+def sidecar(stats: List[dict], version: Optional[str]) -> str:
+    """
+    Sidecar document of the statistics of a raster version
+
+    Parameters
+    ----------
+    stats : list of dict
+        Statistics of every band
+    version : str or None
+        object_version of the raster they were computed on
+
+    Returns
+    -------
+    str
+        JSON document
+    """
+    return json.dumps({"version": version, "bands": stats})
+
+
+def sidecar_stats(document, version: Optional[str]) -> Optional[List[dict]]:
+    """
+    Statistics of a sidecar document if they belong to a raster version
+
+    Parameters
+    ----------
+    document : dict or list
+        Parsed sidecar
+    version : str or None
+        Current object_version of the raster
+
+    Returns
+    -------
+    list of dict or None
+        Statistics of every band, None if the sidecar was computed on another
+        version of the raster, or has no version
+    """
+    if not isinstance(document, dict) or version is None:
+        return None
+    if document.get("version") != version:
+        return None
+    return document.get("bands")